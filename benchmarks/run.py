@@ -0,0 +1,215 @@
+"""
+Benchmarks of fortranmagic: extension loading, cold builds, cache hits
+and call overhead.
+
+Every measurement runs in a fresh Python process with its own
+`IPYTHONDIR`, so nothing is shared between runs except what the
+benchmark itself sets up (e.g. the cache directory of the warm runs).
+
+Usage::
+
+    python benchmarks/run.py              # compare with benchmarks/baseline.json
+    python benchmarks/run.py --save       # store a new baseline
+    python benchmarks/run.py --only call --repeat 10
+
+The exit status is 1 if a benchmark is slower than its baseline by more
+than `--threshold` (relative) and `--min-delta` (seconds).
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import textwrap
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+BASELINE = os.path.join(HERE, "baseline.json")
+
+# Number of subroutines of the generated Fortran cells
+SIZES = (1, 10, 100)
+
+PRELUDE = """
+import sys, time
+sys.path.insert(0, {root!r})
+import IPython.core.interactiveshell as ici
+ish = ici.InteractiveShell()
+ish.run_cell("%load_ext fortranmagic")
+cell = {cell!r}
+"""
+
+# Each script prints the elapsed time of its measured section
+SCRIPTS = {
+    "load_ext": """
+import sys, time
+sys.path.insert(0, {root!r})
+import IPython.core.interactiveshell as ici
+ish = ici.InteractiveShell()
+t = time.perf_counter()
+import fortranmagic
+fortranmagic.load_ipython_extension(ish)
+print(time.perf_counter() - t)
+""",
+    "build": PRELUDE
+    + """
+t = time.perf_counter()
+assert ish.run_cell(cell).success
+print(time.perf_counter() - t)
+""",
+    "call": PRELUDE
+    + """
+import timeit
+assert ish.run_cell(cell).success
+f = ish.user_ns["s0"]
+n = 100000
+print(min(timeit.repeat(lambda: f(1.0), number=n, repeat=5)) / n)
+""",
+}
+
+
+def fortran_cell(size):
+    """`%%fortran` cell of `size` small subroutines."""
+
+    routines = (
+        f"subroutine s{i}(x, y)\n"
+        "    real(8), intent(in) :: x\n"
+        "    real(8), intent(out) :: y\n"
+        f"    y = {i} + 2 * x\n"
+        f"end subroutine s{i}\n"
+        for i in range(size)
+    )
+    return "%%fortran\n" + "\n".join(routines)
+
+
+def measure(script, ipython_dir, **fmt):
+    """Run `script` in a new process, return the time it prints."""
+
+    env = {**os.environ, "IPYTHONDIR": ipython_dir}
+    code = textwrap.dedent(SCRIPTS[script]).format(root=ROOT, **fmt)
+    r = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=False)
+    if r.returncode:
+        raise RuntimeError(f"benchmark {script!r} failed:\n{r.stderr}")
+    return float(r.stdout.split()[-1])
+
+
+def bench_load_ext(repeat):
+    with tempfile.TemporaryDirectory() as ipython_dir:
+        return {"load_ext": [measure("load_ext", ipython_dir) for _ in range(repeat)]}
+
+
+def bench_build(repeat):
+    """Cold builds (new cache) & warm hits (cache of the first build)."""
+
+    results = {}
+    for size in SIZES:
+        cell = fortran_cell(size)
+        cold, warm = [], []
+        for _ in range(repeat):
+            with tempfile.TemporaryDirectory() as ipython_dir:
+                cold.append(measure("build", ipython_dir, cell=cell))
+                warm.append(measure("build", ipython_dir, cell=cell))
+        results[f"cold_build[{size}]"] = cold
+        results[f"warm_hit[{size}]"] = warm
+    return results
+
+
+def bench_call(repeat):
+    with tempfile.TemporaryDirectory() as ipython_dir:
+        return {"call": [measure("call", ipython_dir, cell=fortran_cell(1)) for _ in range(repeat)]}
+
+
+BENCHMARKS = {"load_ext": bench_load_ext, "build": bench_build, "call": bench_call}
+
+
+def environment():
+    """Versions the timings depend on."""
+
+    import numpy as np
+
+    fc = shutil.which(os.environ.get("FC", "gfortran"))
+    version = None
+    if fc:
+        r = subprocess.run([fc, "--version"], capture_output=True, text=True, check=False)
+        version = r.stdout.splitlines()[0] if r.stdout else None
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "system": platform.system(),
+        "fc": version,
+    }
+
+
+def summarize(samples):
+    return {"median": statistics.median(samples), "min": min(samples), "n": len(samples)}
+
+
+def compare(results, baseline, threshold, min_delta):
+    """Report lines & names of the regressions of `results` to `baseline`."""
+
+    lines, regressions = [], []
+    for name, stats in results.items():
+        # The minimum is the least noisy estimate of the cost
+        line = f"{name:<16} {stats['min']:11.4g} s (median {stats['median']:.4g} s)"
+        base = baseline.get(name)
+        if base:
+            ratio = stats["min"] / base["min"]
+            line += f"  baseline {base['min']:11.4g} s  x{ratio:5.2f}"
+            if ratio > 1 + threshold and stats["min"] - base["min"] > min_delta:
+                regressions.append(name)
+                line += "  REGRESSION"
+        lines.append(line)
+    for size in SIZES:
+        cold, warm = results.get(f"cold_build[{size}]"), results.get(f"warm_hit[{size}]")
+        if cold and warm:
+            lines.append(f"cache speedup[{size}]: x{cold['min'] / warm['min']:.1f}")
+    return lines, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", action="append", choices=sorted(BENCHMARKS), help="Run only these benchmarks")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per benchmark (default: %(default)s)")
+    parser.add_argument("--save", action="store_true", help="Store the results as the new baseline")
+    parser.add_argument("--baseline", default=BASELINE, help="Baseline file (default: %(default)s)")
+    parser.add_argument("--output", help="Also write the results to this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Tolerated relative slowdown")
+    parser.add_argument("--min-delta", type=float, default=0.0, help="Tolerated absolute slowdown, seconds")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name in args.only or BENCHMARKS:
+        for key, samples in BENCHMARKS[name](args.repeat).items():
+            results[key] = summarize(samples)
+
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    lines, regressions = compare(results, baseline.get("results", {}), args.threshold, args.min_delta)
+    print("\n".join(lines))
+
+    report = {"environment": environment(), "results": results}
+    if baseline.get("environment") not in (None, report["environment"]):
+        print("Warning: the baseline was measured in another environment", file=sys.stderr)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.save:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({**report, "results": {**baseline.get("results", {}), **results}}, f, indent=2)
+            f.write("\n")
+        return 0
+    if regressions:
+        print(f"{len(regressions)} regression(s): {', '.join(regressions)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -11,25 +11,95 @@ Author:
 * Martín Gaitán <gaitan@gmail.com>
 """
 
+import argparse
+import base64
+import builtins
+import contextlib
 import errno
+import functools
 import hashlib
 import importlib.machinery
 import importlib.util
+import io
+import itertools
+import json
+import keyword
+import math
+import mmap
+import multiprocessing
 import os
+import platform
+import queue
 import random
+import re
+import shlex
 import shutil
+import signal
+import subprocess
 import sys
-from subprocess import PIPE, Popen
+import sysconfig
+import tempfile
+import threading
+import time
+import types
+import weakref
+import zipfile
+from subprocess import DEVNULL, PIPE, Popen, TimeoutExpired
 
 from IPython.core import display, magic_arguments
+from IPython.core.error import UsageError
 from IPython.core.magic import Magics, cell_magic, line_magic, magics_class
 from IPython.paths import get_ipython_cache_dir
-from IPython.utils.io import capture_output
-from numpy.f2py import f2py2e
+from IPython.utils.process import arg_split
 
 __version__ = "1.0.0a2"
 _VERBOSITY_DEBUG = 2
 
+# `%%fortran` options handled by the magic, not passed to f2py
+_MAGIC_OPTIONS = (
+    "f77flags",
+    "f90flags",
+    "timeout",
+    "worker",
+    "batch",
+    "ufunc",
+    "remote_cache",
+    "compiler_launcher",
+    "backend",
+    "autotune",
+    "kinds",
+    "work",
+    "memoize",
+)
+
+_ANSI_RE = re.compile(r"\x1b\[[0-9;]*[A-Za-z]")
+_NINJA_RE = re.compile(r"^\[(\d+)/(\d+)\]\s")
+_ERROR_RE = re.compile(r"^(?:Error|ERROR)\b|\berror:")
+_LOCATION_RE = re.compile(r"^\S+:\d+:(?:\d+:)?$")
+_TOOLS = (
+    ("fc", "FC", ("gfortran", "flang-new", "flang", "ifx", "ifort", "nvfortran", "pgfortran", "g95")),
+    ("cc", "CC", ("cc", "gcc", "clang", "icx")),
+    ("pkg-config", "PKG_CONFIG", ("pkg-config", "pkgconf")),
+    # Compiler cache prepended to FC & CC
+    ("launcher", "FORTRANMAGIC_LAUNCHER", ("sccache", "ccache")),
+)
+_TOOLCHAIN_ENVIRON = (
+    "PATH",
+    "FC",
+    "CC",
+    "PKG_CONFIG",
+    "PKG_CONFIG_PATH",
+    "PKG_CONFIG_LIBDIR",
+    "FORTRANMAGIC_LAUNCHER",
+)
+_NEW_PROCESS_GROUP = (
+    {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP} if os.name == "nt" else {"start_new_session": True}
+)
+_BUILD_PHASES = (
+    ("Reading fortran codes", "generating wrappers"),
+    ("The Meson build system", "configuring"),
+)
+
 
 def _imp_load_dynamic(name, path):
     loader = importlib.machinery.ExtensionFileLoader(name, path)
@@ -39,6 +109,2088 @@ def _imp_load_dynamic(name, path):
     return module
 
 
+def _read_json(path):
+    """Content of a JSON cache file, ``{}`` if missing or broken."""
+
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def _write_json(path, data) -> None:
+    """Atomically replace a JSON cache file, ignoring errors."""
+
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
+@functools.cache
+def _f2py_version():
+    """Version of `numpy.f2py`.
+
+    Importing `numpy.f2py` is slow, so the version is resolved once and
+    kept in `get_ipython_cache_dir()/fortranmagic/f2py_version.json`,
+    keyed by the location and the modification time of NumPy.
+    """
+
+    spec = importlib.util.find_spec("numpy")
+    numpy_dir = os.path.dirname(spec.origin) if spec is not None and spec.origin else ""
+    try:
+        stamp = os.stat(os.path.join(numpy_dir, "version.py")).st_mtime_ns
+    except OSError:
+        stamp = None
+    cache_file = os.path.join(get_ipython_cache_dir(), "fortranmagic", "f2py_version.json")
+    versions = _read_json(cache_file)
+
+    cached = versions.get(numpy_dir)
+    if stamp is not None and isinstance(cached, dict) and cached.get("stamp") == stamp:
+        return cached["version"]
+
+    from numpy.f2py import f2py2e  # noqa: PLC0415
+
+    version = f2py2e.f2py_version
+    if stamp is not None:
+        versions[numpy_dir] = {"stamp": stamp, "version": version}
+        _write_json(cache_file, versions)
+    return version
+
+
+def _probe(command):
+    """First non-empty output line of `command`, `None` if it fails."""
+
+    try:
+        p = subprocess.run(command, capture_output=True, text=True, stdin=DEVNULL, timeout=60, check=False)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    if p.returncode:
+        return None
+    return next((line.strip() for line in (p.stdout + p.stderr).splitlines() if line.strip()), "")
+
+
+def _probe_all(command):
+    """All output lines of `command`, ``[]`` if it fails."""
+
+    try:
+        p = subprocess.run(command, capture_output=True, text=True, stdin=DEVNULL, timeout=60, check=False)
+    except (OSError, subprocess.SubprocessError):
+        return []
+    return p.stdout.splitlines() if p.returncode == 0 else []
+
+
+def _find_program(variable, candidates):
+    """Absolute path of the program named by `variable` or the first found candidate."""
+
+    if os.environ.get(variable):
+        candidates = shlex.split(os.environ[variable])[:1]
+    return next(filter(None, map(shutil.which, candidates)), None)
+
+
+def _probe_resource(pkg_config, name):
+    """pkg-config data of a `--link` resource."""
+
+    version = _probe([pkg_config, "--modversion", name]) if pkg_config else None
+    if version is None:
+        return {"found": False}
+    return {
+        "found": True,
+        "version": version,
+        "cflags": _probe([pkg_config, "--cflags", name]),
+        "libs": _probe([pkg_config, "--libs", name]),
+    }
+
+
+def _probe_toolchain():
+    """Probe compilers and pkg-config resources of the current environment."""
+
+    toolchain = {}
+    for tool, variable, candidates in _TOOLS:
+        path = _find_program(variable, candidates)
+        toolchain[tool] = {"path": path, "version": path and _probe([path, "--version"])}
+
+    pkg_config = toolchain["pkg-config"]["path"]
+    packages = _probe_all([pkg_config, "--list-all"]) if pkg_config else []
+    toolchain["packages"] = sorted({line.split()[0] for line in packages if line.strip()})
+    toolchain["resources"] = {name: _probe_resource(pkg_config, name) for name in ("blas", "lapack")}
+    toolchain["stamps"] = _tool_stamps(toolchain)
+    return toolchain
+
+
+def _tool_stamps(toolchain):
+    """``{tool: [mtime, size]}`` of the programs found, changed by an upgrade in place."""
+
+    stamps = {}
+    for tool, _, _ in _TOOLS:
+        path = toolchain.get(tool, {}).get("path")
+        try:
+            st = os.stat(path) if path else None
+        except OSError:
+            st = None
+        stamps[tool] = st and [st.st_mtime_ns, st.st_size]
+    return stamps
+
+
+def _toolchain_key():
+    """Key of the environment that determines the discovered toolchain."""
+
+    data = [sys.executable, [t for t, _, _ in _TOOLS], *(os.environ.get(v, "") for v in _TOOLCHAIN_ENVIRON)]
+    return hashlib.md5(json.dumps(data).encode("utf-8")).hexdigest()
+
+
+_TOOLCHAINS = {}
+
+
+def _toolchain(refresh=False):
+    """Discovered compilers and pkg-config resources.
+
+    The environment is probed once; the result is memoized and kept in
+    `get_ipython_cache_dir()/fortranmagic/toolchain.json`, keyed by
+    `PATH`, `FC`, `CC` and the pkg-config variables. It is probed again
+    when the modification time or size of a program found changes.
+    """
+
+    key = _toolchain_key()
+    if not refresh and key in _TOOLCHAINS and _TOOLCHAINS[key]["stamps"] == _tool_stamps(_TOOLCHAINS[key]):
+        return _TOOLCHAINS[key]
+    cache_file = os.path.join(get_ipython_cache_dir(), "fortranmagic", "toolchain.json")
+    toolchains = _read_json(cache_file)
+    cached = toolchains.get(key)
+    if refresh or cached is None or cached.get("stamps") != _tool_stamps(cached):
+        toolchains[key] = _probe_toolchain()
+        _write_json(cache_file, toolchains)
+    _TOOLCHAINS[key] = toolchains[key]
+    return _TOOLCHAINS[key]
+
+
+def _toolchain_resource(name):
+    """pkg-config data of a resource, probed once and cached with the toolchain."""
+
+    toolchain = _toolchain()
+    if name not in toolchain["resources"]:
+        toolchain["resources"][name] = _probe_resource(toolchain["pkg-config"]["path"], name)
+        cache_file = os.path.join(get_ipython_cache_dir(), "fortranmagic", "toolchain.json")
+        toolchains = _read_json(cache_file)
+        toolchains[_toolchain_key()] = toolchain
+        _write_json(cache_file, toolchains)
+    return toolchain["resources"][name]
+
+
+def _launcher_stats(launcher):
+    """``(hits, misses)`` counters of a ccache or sccache `launcher`, `None` if unknown."""
+
+    name = os.path.basename(launcher).lower()
+    if name.startswith("sccache"):
+        try:
+            stats = json.loads("\n".join(_probe_all([launcher, "--show-stats", "--stats-format", "json"])))["stats"]
+        except (ValueError, KeyError):
+            return None
+        return tuple(sum(stats.get(k, {}).get("counts", {}).values()) for k in ("cache_hits", "cache_misses"))
+    if name.startswith("ccache"):
+        counters = dict(line.split("\t", 1) for line in _probe_all([launcher, "--print-stats"]) if "\t" in line)
+        if not counters:
+            return None
+        hits = int(counters.get("direct_cache_hit", 0)) + int(counters.get("preprocessed_cache_hit", 0))
+        return hits, int(counters.get("cache_miss", 0))
+    return None
+
+
+def _compiler_environ(toolchain, launcher, stage):
+    """`FC`, `CC` & compiler cache variables of a build in `stage`.
+
+    The build directory & meson's private include directory contain the
+    module name: they are left out of the compiler cache hashes, so
+    identical sources (e.g. `fortranobject.c`) hit across modules.
+    """
+
+    env = {}
+    for tool in ("fc", "cc"):
+        variable = tool.upper()
+        command = os.environ.get(variable) or toolchain[tool]["path"]
+        if command and launcher and os.path.basename(shlex.split(command)[0]) not in ("ccache", "sccache"):
+            command = f"{shlex.quote(launcher)} {command}"
+        if command and command != os.environ.get(variable):
+            env[variable] = command
+    if launcher:
+        cache_environ = {
+            "CCACHE_BASEDIR": stage,
+            "CCACHE_NOHASHDIR": "true",
+            "CCACHE_IGNOREOPTIONS": "-I_fortran_magic_*",
+            "SCCACHE_BASEDIRS": stage,
+        }
+        env.update({k: v for k, v in cache_environ.items() if k not in os.environ})
+    return env
+
+
+def _tool_command(env, toolchain, tool):
+    """Command line of the compiler `tool` ('fc' or 'cc') of a build, or None."""
+
+    command = env.get(tool.upper()) or os.environ.get(tool.upper()) or toolchain[tool]["path"]
+    return shlex.split(command) if command else None
+
+
+# Fortran wrappers generated by f2py, besides `<module>module.c`
+_F2PY_WRAPPERS = ("-f2pywrappers.f", "-f2pywrappers2.f90")
+# What the wrappers of a procedure or module depend on, with some of its `vars`
+_INTERFACE_KEYS = (
+    "block",
+    "name",
+    "args",
+    "result",
+    "prefix",
+    "implicit",
+    "common",
+    "entry",
+    "f2pyenhancements",
+    "callstatement",
+    "callprotoargument",
+)
+
+
+def _interface(block):
+    """Part of a `crackfortran` block the f2py wrappers depend on: not the local variables."""
+
+    if block.get("externals"):
+        # The signature of a callback may be inferred from its calls
+        raise ValueError(f"{block['name']}: callback arguments")
+    names = {*block.get("args", []), block.get("result", block.get("name"))}
+    # The members of the common blocks and the arguments of the entry points are wrapped too
+    for members in [*block.get("common", {}).values(), *block.get("entry", {}).values()]:
+        names.update(_NAME_RE.match(m.strip())[0] for m in members if _NAME_RE.match(m.strip()))
+    variables = {
+        k: v
+        for k, v in block.get("vars", {}).items()
+        if block["block"] == "module" or k in names or "parameter" in v.get("attrspec", [])
+    }
+    return {
+        **{k: block[k] for k in _INTERFACE_KEYS if k in block},
+        "vars": variables,
+        "body": [_interface(b) for b in block.get("body", [])],
+    }
+
+
+def _wrapper_key(fsources, f2py_args, skip, debug, toolchain):
+    """Key of the f2py wrappers of `fsources`, from their interface only, or None."""
+
+    blocks = []
+    try:
+        for source in fsources:
+            with open(source, encoding="utf-8") as f:
+                blocks += [_interface(b) for b in _crack(f.read(), os.path.splitext(source)[1])]
+    except Exception:  # noqa: BLE001
+        return None
+    key = (
+        blocks,
+        f2py_args,
+        skip,
+        debug,
+        sys.version,
+        _f2py_version(),
+        toolchain["cc"],
+        os.environ.get("CFLAGS", ""),
+    )
+    return hashlib.md5(json.dumps(key, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _store_wrappers(directory, paths) -> None:
+    """Copy the existing `paths` to the cache `directory`, atomically."""
+
+    tmp = f"{directory}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(tmp)
+        for path in paths:
+            if os.path.isfile(path):
+                shutil.copy(path, tmp)
+        os.rename(tmp, directory)
+    except OSError:
+        # e.g. stored meanwhile by another build
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _direct_build(module_name, stage, sources, fflags, debug, env, toolchain, wrapper=None, compiled=False):  # noqa: PLR0913, PLR0917
+    """Compiler commands building the f2py wrappers in `stage` without meson.
+
+    Return ``(commands, fortranobject)``: the commands to run in `stage`
+    once f2py has generated the wrappers of `sources` there. They mirror
+    the meson release (or debug) build of f2py and honour `FFLAGS`,
+    `CFLAGS` & `LDFLAGS`. The object of `fortranobject.c`, the same for
+    every module, is kept in the fortranmagic cache directory: if it is
+    missing, it is compiled in `stage` and its cache path returned as
+    `fortranobject`, to be moved there after a successful build.
+
+    The wrappers may be those of an f2py module named `wrapper`, its
+    init function is then linked as the one of `module_name`. With
+    `compiled`, the object of its C wrapper is already in `stage`.
+    """
+
+    import numpy as np  # noqa: PLC0415
+
+    fc, cc = _tool_command(env, toolchain, "fc"), _tool_command(env, toolchain, "cc")
+    numpy_include = np.get_include()
+    f2py_src = os.path.join(os.path.dirname(os.path.dirname(numpy_include)), "f2py", "src")
+    paths = sysconfig.get_paths()
+    includes = [f"-I{d}" for d in dict.fromkeys((numpy_include, f2py_src, paths["include"], paths["platinclude"]))]
+    flags = ["-fPIC", *(["-g"] if debug else ["-O3"])]
+    cflags = [*flags, "-fno-strict-aliasing", *includes, *shlex.split(os.environ.get("CFLAGS", ""))]
+
+    wrapper = wrapper or module_name
+    wrappers = [os.path.join(stage, wrapper + s) for s in _F2PY_WRAPPERS]
+    fsources = [s for s in sources if not s.endswith(".c")] + [w for w in wrappers if os.path.isfile(w)]
+    csources = [os.path.join(stage, wrapper + "module.c")] + [s for s in sources if s.endswith(".c")]
+    # `<module>_ufunc.f90` & `<module>_ufunc.c` would compile to the same object
+    fobjects = [os.path.splitext(os.path.basename(s))[0] + ".o" for s in fsources]
+    cobjects = [os.path.basename(s) + ".o" for s in csources]
+
+    key = (cc, toolchain["cc"]["version"], np.__version__, includes, cflags)
+    cached = os.path.join(
+        get_ipython_cache_dir(),
+        "fortranmagic",
+        f"fortranobject-{hashlib.md5(str(key).encode('utf-8')).hexdigest()}.o",
+    )
+    commands = [
+        [*fc, "-c", *flags, *shlex.split(os.environ.get("FFLAGS", "")), *shlex.split(fflags or ""), *fsources],
+        *(
+            [*cc, "-c", *cflags, source, "-o", o]
+            for source, o in zip(csources[compiled:], cobjects[compiled:], strict=True)
+        ),
+    ]
+    fortranobject = None
+    if not os.path.isfile(cached):
+        commands.append([*cc, "-c", *cflags, os.path.join(f2py_src, "fortranobject.c")])
+        fortranobject, cached = cached, "fortranobject.o"
+    link = ["-undefined", "dynamic_lookup"] if sys.platform == "darwin" else []
+    if wrapper != module_name:
+        if sys.platform == "darwin":
+            link.append(f"-Wl,-alias,_PyInit_{wrapper},_PyInit_{module_name}")
+        else:
+            link.append(f"-Wl,--defsym,PyInit_{module_name}=PyInit_{wrapper}")
+    ldflags = shlex.split(os.environ.get("LDFLAGS", ""))
+    target = module_name + importlib.machinery.EXTENSION_SUFFIXES[0]
+    commands.append([*fc, "-shared", *link, *fobjects, *cobjects, cached, "-o", target, *ldflags])
+    return commands, fortranobject
+
+
+def _read_lines(pipe, stream, lines):
+    """Put the lines of `pipe` in the `lines` queue, then ``(stream, None)``."""
+
+    with pipe:
+        for line in iter(pipe.readline, b""):
+            lines.put((stream, line))
+    lines.put((stream, None))
+
+
+def _terminate(p, grace=5.0) -> None:
+    """Terminate the process group of `p` (started in a new session/group)."""
+
+    try:
+        if os.name == "nt":
+            subprocess.run(["taskkill", "/F", "/T", "/PID", str(p.pid)], stdout=DEVNULL, stderr=DEVNULL, check=False)
+        else:
+            os.killpg(p.pid, signal.SIGTERM)
+            with contextlib.suppress(TimeoutExpired):
+                p.wait(timeout=grace)
+            # Grandchildren may outlive f2py itself
+            os.killpg(p.pid, signal.SIGKILL)
+    except OSError:
+        pass
+    p.wait()
+
+
+class _BuildOutput:
+    """Output of a build, consumed line by line while it runs.
+
+    Lines go to the build log and are either echoed at once or spooled
+    (to disk beyond 1 MiB) to be replayed on failure. The build phase
+    (`compiling 3/12`) and the first error are reported as soon as they
+    appear: in place in a notebook frontend or on a terminal `stderr`.
+    Otherwise only the first error is printed, on `stderr`.
+    """
+
+    def __init__(self, log=None, echo=False, live=False) -> None:
+        self.echo = echo
+        self.first_error = None
+        self._location = None
+        # A progress line rewritten in place on a terminal
+        self._tty = not (live or echo) and getattr(sys.stderr, "isatty", lambda: False)()
+        self._line = False
+        self._log = open(log, "a", encoding="utf-8") if log else None  # noqa: SIM115
+        self._spool = {
+            stream: tempfile.SpooledTemporaryFile(max_size=2**20, mode="w+", encoding="utf-8")  # noqa: SIM115
+            for stream in ("out", "err")
+        }
+        self._status = display.DisplayHandle() if live else None
+        if self._status is not None:
+            self._status.display(display.Pretty("f2py: starting"))
+
+    def _report(self, text) -> None:
+        if self._status is not None:
+            self._status.update(display.Pretty("f2py: " + text))
+        elif self._tty:
+            sys.stderr.write("\r\x1b[Kf2py: " + text)
+            sys.stderr.flush()
+            self._line = True
+
+    def _clear(self) -> None:
+        if self._line:
+            sys.stderr.write("\r\x1b[K")
+            sys.stderr.flush()
+            self._line = False
+
+    def feed(self, stream, line) -> None:
+        if self._log is not None:
+            self._log.write(line)
+            self._log.flush()
+        if self.echo:
+            target = sys.stdout if stream == "out" else sys.stderr
+            target.write(line)
+            target.flush()
+        else:
+            self._spool[stream].write(line)
+
+        plain = _ANSI_RE.sub("", line).strip()
+        m = _NINJA_RE.match(plain)
+        if m:
+            self._report(f"compiling {m.group(1)}/{m.group(2)}")
+        for prefix, phase in _BUILD_PHASES:
+            if plain.startswith(prefix):
+                self._report(phase)
+        if self.first_error is None and _ERROR_RE.search(plain):
+            self.first_error = plain if self._location is None else f"{self._location} {plain}"
+            if self._status is not None:
+                self._report("error: " + self.first_error)
+            elif not self.echo:
+                self._clear()
+                print("f2py: error:", self.first_error, file=sys.stderr, flush=True)
+        if _LOCATION_RE.match(plain):
+            self._location = plain
+
+    def close(self, success) -> None:
+        self._clear()
+        if self._log is not None:
+            self._log.close()
+        if success or self.echo:
+            for spool in self._spool.values():
+                spool.close()
+        if success and self._status is not None:
+            self._status.update(display.Pretty(""))
+
+    def replay(self) -> None:
+        """Print the spooled output, `stderr` first."""
+
+        for stream, target in (("err", sys.stderr), ("out", sys.stdout)):
+            spool = self._spool[stream]
+            spool.seek(0)
+            shutil.copyfileobj(spool, target)
+            spool.close()
+            target.flush()
+
+
+def _transport_dir():
+    """Directory for arrays shared with the worker: RAM backed if possible."""
+
+    shm = "/dev/shm"
+    return tempfile.mkdtemp(prefix="fortranmagic-", dir=shm if os.path.isdir(shm) else None)
+
+
+def _share(value, directory):
+    """Encode `value` for the worker pipe; arrays are copied to mapped files."""
+
+    np = sys.modules.get("numpy")
+    if isinstance(value, tuple):
+        return ("tuple", [_share(v, directory) for v in value])
+    if np is None or not isinstance(value, np.ndarray) or value.dtype.hasobject or value.size == 0:
+        return ("obj", value)
+    order = "F" if value.flags.f_contiguous and not value.flags.c_contiguous else "C"
+    fd, path = tempfile.mkstemp(suffix=".npy", dir=directory)
+    os.close(fd)
+    shared = np.memmap(path, dtype=value.dtype, mode="w+", shape=value.shape, order=order)
+    shared[...] = value
+    del shared
+    return ("mmap", path, value.shape, value.dtype.str, order)
+
+
+def _unshare(spec):
+    """Decode a `_share` spec; a received mapped file is mapped and unlinked."""
+
+    kind = spec[0]
+    if kind == "tuple":
+        return tuple(_unshare(v) for v in spec[1])
+    if kind == "obj":
+        return spec[1]
+    import numpy as np  # noqa: PLC0415
+
+    _, path, shape, dtype, order = spec
+    array = np.memmap(path, dtype=dtype, mode="r+", shape=tuple(shape), order=order)
+    with contextlib.suppress(OSError):  # Windows can't remove a mapped file
+        os.remove(path)
+    return array.view(np.ndarray)
+
+
+def _is_value(v):
+    np = sys.modules.get("numpy")
+    return (
+        v is None
+        or isinstance(v, (bool, int, float, complex, str, bytes))
+        or (np is not None and isinstance(v, (np.ndarray, np.generic)))
+    )
+
+
+def _worker_main(conn, directory) -> None:
+    """Serve the requests of a `_Worker` until `stop` or a closed pipe."""
+
+    import numpy as np  # noqa: PLC0415
+
+    modules = {}
+
+    def resolve(module, attr):
+        obj = modules[module]
+        for a in attr.split("."):
+            obj = getattr(obj, a)
+        return obj
+
+    def reply_for(v):
+        return ("proxy", v.__doc__) if not _is_value(v) else _share(v, directory)
+
+    def argument(spec):
+        # Arrays are mapped in place: the routine works on shared memory
+        if spec[0] == "mmap":
+            _, path, shape, dtype, order = spec
+            return np.memmap(path, dtype=dtype, mode="r+", shape=tuple(shape), order=order)
+        return _unshare(spec)
+
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        op = request[0]
+        if op == "stop":
+            break
+        if op not in ("load", "call", "getattr", "setattr"):
+            conn.send(("error", "ValueError", f"Unknown request: {op!r}"))
+            continue
+        try:
+            if op == "load":
+                _, module, path = request
+                modules[module] = _imp_load_dynamic(module, path)
+                reply = [(k, reply_for(v)) for k, v in vars(modules[module]).items() if not k.startswith("__")]
+            elif op == "call":
+                _, module, attr, args, kwargs = request
+                args = [argument(a) for a in args]
+                kwargs = {k: argument(v) for k, v in kwargs.items()}
+                reply = _share(resolve(module, attr)(*args, **kwargs), directory)
+            elif op == "getattr":
+                reply = reply_for(resolve(*request[1:]))
+            else:
+                _, module, attr, spec = request
+                owner, _, name = attr.rpartition(".")
+                setattr(resolve(module, owner) if owner else modules[module], name, _unshare(spec))
+                reply = None
+        except Exception as e:  # noqa: BLE001
+            conn.send(("error", type(e).__name__, str(e)))
+        else:
+            conn.send(("ok", reply))
+
+
+def _signature(doc):
+    """Argument names of an f2py routine & the in/output ones, from its docstring."""
+
+    lines = [line.strip() for line in (doc or "").splitlines() if line.strip()]
+    if not lines or "(" not in lines[0]:
+        return [], set()
+    params = lines[0][lines[0].index("(") + 1 : lines[0].rindex(")")]
+    names = [a.strip("[] ") for a in params.split(",") if a.strip("[] ")]
+    inout = {m.group(1) for m in map(re.compile(r"^(\w+) : in/output").match, lines) if m}
+    return names, inout
+
+
+class _Worker:
+    """Separate process where `%%fortran --worker` modules are loaded.
+
+    A crash of Fortran code kills only the worker; it is restarted, and
+    the modules reloaded, on the next request. Array arguments and
+    results are exchanged through memory mapped files in `/dev/shm`
+    (if available). Arrays allocated with `empty()` live there already
+    and are passed without any copy.
+    """
+
+    def __init__(self) -> None:
+        self._dir = _transport_dir()
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self._dir, True)
+        self._proc = None
+        self._conn = None
+        self._modules = {}
+        self._shared = weakref.WeakValueDictionary()
+
+    @property
+    def pid(self):
+        return self._proc.pid if self._proc is not None and self._proc.is_alive() else None
+
+    def __repr__(self) -> str:
+        return f"<Fortran worker pid={self.pid} modules={len(self._modules)}>"
+
+    def _start(self) -> None:
+        ctx = multiprocessing.get_context("spawn")
+        self._conn, child = ctx.Pipe()
+        self._proc = ctx.Process(target=_worker_main, args=(child, self._dir), daemon=True)
+        self._proc.start()
+        child.close()
+        for module, path in self._modules.items():
+            self._request("load", module, path)
+
+    def stop(self) -> None:
+        if self._proc is not None:
+            with contextlib.suppress(OSError):
+                self._conn.send(("stop",))
+            self._proc.join(5)
+            if self._proc.is_alive():
+                self._proc.kill()
+                self._proc.join()
+            self._conn.close()
+        self._proc = None
+
+    def restart(self) -> None:
+        self.stop()
+        self._start()
+
+    def _request(self, *request):
+        if self._proc is None:
+            self._start()
+        try:
+            self._conn.send(request)
+            status, *reply = self._conn.recv()
+        except (EOFError, OSError):
+            self._proc.join()
+            code = self._proc.exitcode
+            self._conn.close()
+            self._proc = None
+            raise RuntimeError(f"The Fortran worker died (exit code {code}), it restarts on the next call") from None
+        if status == "error":
+            exc_type, message = reply
+            exc = getattr(builtins, exc_type, None)
+            if not (isinstance(exc, type) and issubclass(exc, Exception)):
+                exc, message = RuntimeError, f"{exc_type}: {message}"
+            raise exc(message)
+        return reply[0]
+
+    def load(self, module, path):
+        """Load a module, return ``[(name, proxy or value)]``."""
+
+        self._modules[module] = path
+        return [(k, self._wrap(module, k, r)) for k, r in self._request("load", module, path)]
+
+    def _wrap(self, module, attr, reply):
+        if reply[0] == "proxy":
+            return _WorkerProxy(self, module, attr, reply[1])
+        return _unshare(reply)
+
+    def empty(self, shape, dtype=float, order="C"):
+        """A new array in shared memory, passed to the worker without copy."""
+
+        import numpy as np  # noqa: PLC0415
+
+        fd, path = tempfile.mkstemp(suffix=".npy", dir=self._dir)
+        os.close(fd)
+        array = np.memmap(path, dtype=dtype, mode="w+", shape=shape, order=order)
+        self._shared[id(array)] = array
+        weakref.finalize(array, _remove_quietly, path)
+        return array
+
+    def _argument(self, value, temporaries):
+        if self._shared.get(id(value)) is value:
+            return ("mmap", value.filename, value.shape, value.dtype.str, "F" if value.flags.f_contiguous else "C")
+        spec = _share(value, self._dir)
+        if spec[0] == "mmap":
+            temporaries.append((value, spec))
+        return spec
+
+    def call(self, module, attr, doc, args, kwargs):
+        names, inout = _signature(doc)
+        temporaries = []
+        try:
+            shared_args = [self._argument(a, temporaries) for a in args]
+            shared_kwargs = {k: self._argument(v, temporaries) for k, v in kwargs.items()}
+            result = self._request("call", module, attr, shared_args, shared_kwargs)
+            # Copy back the in/output arguments that were not shared
+            updated = {id(v) for n, v in (*zip(names, args, strict=False), *kwargs.items()) if n in inout}
+            for value, spec in temporaries:
+                if id(value) in updated and value.flags.writeable:
+                    value[...] = _unshare(spec)
+        finally:
+            for _, spec in temporaries:
+                _remove_quietly(spec[1])
+        return _unshare(result)
+
+
+def _remove_quietly(path) -> None:
+    with contextlib.suppress(OSError):
+        os.remove(path)
+
+
+class _WorkerProxy:
+    """Proxy of a Fortran routine or module loaded in the worker process."""
+
+    def __init__(self, worker, module, attr, doc) -> None:
+        object.__setattr__(self, "_worker", worker)
+        object.__setattr__(self, "_module", module)
+        object.__setattr__(self, "_attr", attr)
+        object.__setattr__(self, "__doc__", doc)
+
+    def __call__(self, *args, **kwargs):
+        return self._worker.call(self._module, self._attr, self.__doc__, args, kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        attr = f"{self._attr}.{name}"
+        return self._worker._wrap(self._module, attr, self._worker._request("getattr", self._module, attr))
+
+    def __setattr__(self, name, value) -> None:
+        if name.startswith("__"):
+            object.__setattr__(self, name, value)
+        else:
+            self._worker._request("setattr", self._module, f"{self._attr}.{name}", _share(value, self._worker._dir))
+
+    def __repr__(self) -> str:
+        return f"<fortran worker object {self._attr!r}>"
+
+
+# `crackfortran` state is global, e.g. for builds of several threads
+_CRACK_LOCK = threading.Lock()
+
+
+def _crack(code, fsuffix=".f90"):
+    """Parse Fortran `code` with `numpy.f2py.crackfortran`, return its blocks."""
+
+    from numpy.f2py import crackfortran  # noqa: PLC0415
+
+    with tempfile.TemporaryDirectory() as tmp, _CRACK_LOCK:
+        path = os.path.join(tmp, "cell" + fsuffix)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(code)
+        crackfortran.reset_global_f2py_vars()
+        crackfortran.quiet = 1
+        crackfortran.verbose = 0
+        with contextlib.redirect_stdout(io.StringIO()):
+            return crackfortran.crackfortran([path])
+
+
+def _procedures(blocks):
+    """Map procedure names to ``(block, module name or None)``."""
+
+    procedures = {}
+    for block in blocks:
+        if block["block"] in ("subroutine", "function"):
+            procedures[block["name"]] = (block, None)
+        elif block["block"] == "module":
+            for b in block.get("body", []):
+                if b["block"] in ("subroutine", "function"):
+                    procedures[b["name"]] = (b, block["name"])
+    return procedures
+
+
+_PREFIX_KEYWORDS = ("elemental", "pure", "impure", "recursive", "module", "non_recursive")
+
+
+def _prefix(block):
+    """Prefix keywords of a procedure, e.g. ``{"elemental"}``."""
+
+    return {w for w in block.get("prefix", "").lower().split() if w in _PREFIX_KEYWORDS}
+
+
+def _type_declaration(var, where):
+    """Fortran type of a `crackfortran` variable, e.g. ``real(kind=8)``."""
+
+    typespec = var.get("typespec")
+    if typespec in (None, "character", "type"):
+        raise UsageError(f"{where}: {typespec or 'untyped'} arguments are not supported")
+    kind = var.get("kindselector", {})
+    if "kind" in kind:
+        return f"{typespec}(kind={kind['kind']})"
+    if "*" in kind:
+        return f"{typespec}*{kind['*']}"
+    return typespec
+
+
+def _result_declaration(block):
+    """Fortran type of a function result."""
+
+    result = block.get("result", block["name"])
+    var = block["vars"].get(result, {})
+    if var.get("dimension"):
+        raise UsageError(f"{block['name']}: array valued functions are not supported")
+    # crackfortran drops the kind of `elemental real(8) function f()`
+    prefix = " ".join(w for w in block.get("prefix", "").split() if w.lower() not in _PREFIX_KEYWORDS)
+    return prefix or _type_declaration(var, block["name"])
+
+
+_NAME_RE = re.compile(r"[a-z_]\w*", re.IGNORECASE)
+
+
+def _batch_driver(blocks, name):
+    """Fortran source of `<name>_batch`, a loop calling `name` over stacked arguments.
+
+    Every argument gets a trailing `nbatch` dimension, except the ones
+    used in array bounds, which are shared by all the calls. A function
+    gets an extra output array with its results.
+    """
+
+    procedures = _procedures(blocks)
+    if name not in procedures:
+        raise UsageError(f"--batch {name}: no such subroutine or function")
+    block, module = procedures[name]
+    args, variables = block["args"], block["vars"]
+
+    shared = set()
+    for a in args:
+        for d in variables.get(a, {}).get("dimension", []):
+            if d.strip() in ("*", ":") or ":" in d:
+                raise UsageError(f"--batch {name}: assumed shape/size argument {a!r}")
+            shared |= {n.lower() for n in _NAME_RE.findall(d)} & set(args)
+
+    driver = f"{name}_batch"
+    result = None
+    if block["block"] == "function":
+        result = "result_"
+        while result in args:
+            result += "_"
+    dummies = [*args, *([result] if result else []), "nbatch"]
+
+    lines = [f"subroutine {driver}({', '.join(dummies)})"]
+    if module:
+        # The whole module: its kind parameters may declare the arguments.
+        # Its public entities named like a dummy argument are renamed.
+        (module_block,) = (b for b in blocks if b["block"] == "module" and b["name"] == module)
+        entities = {
+            *(n for n, v in module_block.get("vars", {}).items() if "private" not in v.get("attrspec", [])),
+            *(b["name"] for b in module_block.get("body", [])),
+        }
+        renames = [f"{module}_{n} => {n}" for n in sorted(entities & {*dummies, "ibatch_"})]
+        lines.append(f"    use {', '.join([module, *renames])}")
+    lines += [f"    use {u}" for u in block.get("use", {})]
+    lines += ["    implicit none", "    integer, intent(in) :: nbatch"]
+    if result and not module:
+        lines.append(f"    {_result_declaration(block)}, external :: {name}")
+    actuals = []
+    for a in args:
+        var = variables.get(a, {})
+        intent = [i for i in var.get("intent", []) if i in ("in", "out", "inout")] or ["in"]
+        dims = var.get("dimension", [])
+        decl = f"    {_type_declaration(var, f'--batch {name}')}, intent({intent[0]}) :: {a}"
+        if a in shared:
+            lines.append(decl + (f"({', '.join(dims)})" if dims else ""))
+            actuals.append(a)
+        else:
+            lines.append(f"{decl}({', '.join([*dims, 'nbatch'])})")
+            actuals.append(f"{a}({', '.join([':'] * len(dims) + ['ibatch_'])})")
+    if result:
+        lines.append(f"    {_result_declaration(block)}, intent(out) :: {result}(nbatch)")
+    lines += ["    integer :: ibatch_", "    do ibatch_ = 1, nbatch"]
+    if result:
+        lines.append(f"        {result}(ibatch_) = {name}({', '.join(actuals)})")
+    else:
+        lines.append(f"        call {name}({', '.join(actuals)})")
+    lines += ["    end do", f"end subroutine {driver}", ""]
+    return "\n".join(lines)
+
+
+# Fortran module of the `--work` arrays
+_WORK_MODULE = "workspace"
+_WORK_RE = re.compile(r"(\w+)\s*\(([\s:,]*)\)")
+
+
+def _parse_work(declarations):
+    """``[(typespec, name, rank), ...]`` of the `--work "<type> :: <name>(:,...)"` options."""
+
+    arrays = []
+    for declaration in map(unquote, declarations):
+        typespec, _, names = declaration.partition("::")
+        typespec = typespec.strip()
+        found = _WORK_RE.findall(names)
+        if not typespec or not found or _WORK_RE.sub("", names).strip(" ,"):
+            raise UsageError(f"--work {declaration}: expected <type> :: <name>(:,...), e.g. 'real(8) :: w(:,:)'")
+        arrays += [(typespec, name, dims.count(":")) for name, dims in found]
+    return arrays
+
+
+def _work_module(arrays):
+    """Fortran source of the `--work` module: the arrays and their `<name>_alloc` & `<name>_free`."""
+
+    lines = [f"module {_WORK_MODULE}", "    implicit none"]
+    for typespec, name, rank in arrays:
+        lines.append(f"    {typespec}, allocatable, target :: {name}({', '.join([':'] * rank)})")
+    lines.append("contains")
+    for typespec, name, rank in arrays:
+        bounds = [f"n{i}" for i in range(1, rank + 1)]
+        # Derived types keep their default initialization
+        kind = typespec.split("(", 1)[0].strip().lower()
+        zero = {"logical": ".false.", "character": "' '", "type": None, "class": None}.get(kind, "0")
+        lines += [
+            f"    subroutine {name}_alloc({', '.join(bounds)})",
+            f"        integer, intent(in) :: {', '.join(bounds)}",
+            f"        if (allocated({name})) then",
+            # Same shape: the array is reused
+            f"            if (all(shape({name}) == [{', '.join(bounds)}])) return",
+            f"            deallocate({name})",
+            "        end if",
+            f"        allocate({name}({', '.join(bounds)}))",
+            *([f"        {name} = {zero}"] if zero else []),
+            f"    end subroutine {name}_alloc",
+            f"    subroutine {name}_free()",
+            f"        if (allocated({name})) deallocate({name})",
+            f"    end subroutine {name}_free",
+        ]
+    lines += [f"end module {_WORK_MODULE}", ""]
+    return "\n".join(lines)
+
+
+def _work_report(workspaces):
+    """Lines of `%fortran_work`: the `--work` arrays of `workspaces` and their memory use."""
+
+    lines, total = [], 0
+    for module_name, (module, names) in workspaces.items():
+        build = module_name.removeprefix("_fortran_magic_")[:10]
+        for name in names:
+            a = getattr(module, name)
+            if a is None:
+                lines.append(f"{name:<16}  {build}  free")
+            else:
+                total += a.nbytes
+                shape = f"{a.dtype.name}({', '.join(map(str, a.shape))})"
+                lines.append(f"{name:<16}  {build}  {shape:<24}  {_size_text(a.nbytes):>9}")
+    lines.append(f"{len(lines)} work array(s), {_size_text(total)}")
+    return lines
+
+
+# NumPy type of the (type, kind) of the arguments dispatched by `--kinds`
+_KIND_DTYPES = {
+    ("real", "4"): "float32",
+    ("real", "8"): "float64",
+    ("integer", "1"): "int8",
+    ("integer", "2"): "int16",
+    ("integer", "4"): "int32",
+    ("integer", "8"): "int64",
+    ("complex", "4"): "complex64",
+    ("complex", "8"): "complex128",
+}
+_SIGNATURE_RE = re.compile(r"(\w+)\(([^)]*)\)")
+
+
+def _parse_kinds(kinds):
+    """``[(name, [kind, ...]), ...]`` of the `--kinds name=k1,k2` options."""
+
+    parsed = []
+    for option in kinds:
+        name, _, values = unquote(option).partition("=")
+        values = [v.strip() for v in values.split(",") if v.strip()]
+        if not name.strip().isidentifier() or not values or not all(v.isdigit() for v in values):
+            raise UsageError(f"--kinds {option}: expected <name>=<kind>,<kind>..., e.g. wp=4,8")
+        parsed.append((name.strip().lower(), values))
+    return parsed
+
+
+# Character literals & comments of Fortran code, left as they are by `_sub_code`
+_NONCODE_RE = re.compile(r"""'(?:[^'\n]|'')*'|"(?:[^"\n]|"")*"|![^\n]*""")
+_FIXED_NONCODE_RE = re.compile(r"^[c*][^\n]*|" + _NONCODE_RE.pattern, re.IGNORECASE | re.MULTILINE)
+
+
+def _sub_code(pattern, repl, code, fsuffix=".f90"):
+    """``re.sub(pattern, repl, code)`` outside of its strings & comments."""
+
+    noncode = _FIXED_NONCODE_RE if fsuffix == ".f" else _NONCODE_RE
+    parts, start = [], 0
+    for m in noncode.finditer(code):
+        parts += [re.sub(pattern, repl, code[start : m.start()], flags=re.IGNORECASE), m.group()]
+        start = m.end()
+    return "".join([*parts, re.sub(pattern, repl, code[start:], flags=re.IGNORECASE)])
+
+
+def _kind_variants(code, kinds, fsuffix=".f90"):
+    """Source of `code` specialized for every combination of `kinds`.
+
+    The kind names are replaced by their values, also as the kind of
+    literals (``0.5_wp``). External procedures & modules get the suffix
+    ``__<kinds>``, e.g. `total__4` & `total__8` for ``wp=4,8``, so all
+    the variants fit one extension module. Strings & comments are kept.
+    """
+
+    names = {module or name for name, (_, module) in _procedures(_crack(code, fsuffix)).items()}
+    variants = []
+    for values in itertools.product(*(v for _, v in kinds)):
+        suffix = "__" + "_".join(values)
+        variant = code
+        for (name, _), value in zip(kinds, values, strict=True):
+            # `_` is a word character: `\b` doesn't separate a literal & its kind
+            variant = _sub_code(rf"\b{name}\b|(?<=[\d.]_){name}\b", value, variant, fsuffix)
+        for name in names:
+            variant = _sub_code(rf"\b{name}\b", name + suffix, variant, fsuffix)
+        variants.append(variant)
+    return "\n".join(variants)
+
+
+class _KindDispatcher:
+    """Call the `--kinds` specialization matching the dtypes of the arguments.
+
+    The first NumPy array (or scalar) argument declared with a kind name
+    selects its value; without any, or for another dtype, the last value
+    is used and f2py converts the arguments as usual.
+    """
+
+    def __init__(self, name, variants, selectors, default) -> None:
+        # `selectors`: [(kind name index, [(position, argument, {dtype name: kind})])]
+        self.__name__ = name
+        self._variants = variants
+        self._selectors = selectors
+        self._default = default
+        self.__doc__ = variants[default].__doc__
+
+    def __repr__(self) -> str:
+        return f"<--kinds dispatcher {self.__name__} of {len(self._variants)} specializations>"
+
+    def __call__(self, *args, **kwargs):
+        key = self._default
+        for i, candidates in self._selectors:
+            for position, name, dtypes in candidates:
+                x = args[position] if position < len(args) else kwargs.get(name)
+                value = dtypes.get(getattr(getattr(x, "dtype", None), "name", None))
+                if value is not None:
+                    key = (*key[:i], value, *key[i + 1 :])
+                    break
+        return self._variants[key](*args, **kwargs)
+
+
+def _kind_variant(members, module_name, name, values):
+    """The specialization of procedure `name` for the kind `values`, or None."""
+
+    tag = "_".join(values)
+    if module_name:
+        return getattr(members.get(f"{module_name}__{tag}"), name, None)
+    return members.get(f"{name}__{tag}")
+
+
+def _kind_table(members, code, kinds, fsuffix=".f90"):
+    """Dispatch table of a module built with `--kinds`.
+
+    A list of ``(Fortran module or None, procedure, kind combinations,
+    selectors)`` of plain values, so `%fortran_export` can write it to
+    the packages it generates, see `_KindDispatcher` for the selectors.
+    """
+
+    combinations = list(itertools.product(*(v for _, v in kinds)))
+    index = {name: i for i, (name, _) in enumerate(kinds)}
+    table = []
+    for name, (block, module_name) in _procedures(_crack(code, fsuffix)).items():
+        variants = [_kind_variant(members, module_name, name, values) for values in combinations]
+        if None in variants:
+            continue  # e.g. skipped by f2py
+        match = _SIGNATURE_RE.search((variants[-1].__doc__ or "").split("\n", 1)[0])
+        parameters = [a.strip("[] ") for a in match[2].split(",")] if match else []
+        # kind name index -> candidate arguments
+        selectors = {}
+        for position, a in enumerate(parameters):
+            var = block["vars"].get(a, {})
+            kind = str(var.get("kindselector", {}).get("kind", "")).lower()
+            typespec = var.get("typespec")
+            if kind in index:
+                dtypes = {}
+                for value in kinds[index[kind]][1]:
+                    dtype = _KIND_DTYPES.get((typespec, value))
+                    if dtype:
+                        dtypes[dtype] = value
+                selectors.setdefault(index[kind], []).append((position, a, dtypes))
+        table.append((module_name, name, combinations, list(selectors.items())))
+    return table
+
+
+def _kind_dispatch(module, code, kinds, fsuffix=".f90"):
+    """Namespace of the `module` built with `--kinds`: its specializations & their dispatchers."""
+
+    members = {k: v for k, v in vars(module).items() if k[:2] != "__"}
+    modules = {}
+    for module_name, name, combinations, selectors in _kind_table(members, code, kinds, fsuffix):
+        variants = {values: _kind_variant(members, module_name, name, values) for values in combinations}
+        dispatcher = _KindDispatcher(name, variants, selectors, combinations[-1])
+        if module_name:
+            modules.setdefault(module_name, {})[name] = dispatcher
+        else:
+            members[name] = dispatcher
+    members.update({m: types.SimpleNamespace(**procedures) for m, procedures in modules.items()})
+    return types.SimpleNamespace(**members)
+
+
+def _memo_key(module_name, name, args, kwargs):
+    """Digest of a call: the contents, dtype & shape of the arguments."""
+
+    import numpy as np  # noqa: PLC0415
+
+    h = hashlib.blake2b(f"{module_name}.{name}".encode(), digest_size=20)
+    for key, x in [*enumerate(args), *sorted(kwargs.items())]:
+        if x is None or isinstance(x, (bool, int, float, complex, str, bytes)):
+            h.update(repr((key, type(x).__name__, x)).encode())
+            continue
+        a = np.asarray(x)
+        if a.dtype.hasobject:
+            raise TypeError(f"argument {key!r}: no digest of {a.dtype} arrays")
+        order = "C"
+        if not a.flags.c_contiguous:
+            # The transpose of a Fortran ordered array is hashed as is
+            a, order = (a.T, "F") if a.flags.f_contiguous else (np.ascontiguousarray(a), "C")
+        h.update(repr((key, a.dtype.str, a.shape, order)).encode())
+        h.update(a.reshape(-1).view(np.uint8).data if a.size else b"")
+    return h.hexdigest()
+
+
+def _result_copy(result):
+    if isinstance(result, tuple):
+        return tuple(map(_result_copy, result))
+    copy = getattr(result, "copy", None)
+    return copy() if copy is not None else result
+
+
+def _result_size(result):
+    if isinstance(result, tuple):
+        return sum(map(_result_size, result))
+    return getattr(result, "nbytes", None) or sys.getsizeof(result)
+
+
+# Default memory limit of the `--memoize` results, MB
+_MEMO_SIZE = 256
+
+
+class _Memo:
+    """Memory bounded LRU of the results of the `--memoize` procedures.
+
+    Results evicted from memory are written to `directory` (pickles
+    named by the call digest) while it holds less than `spill` bytes,
+    the least recently used files being removed first.
+    """
+
+    def __init__(self, limit, spill=0, directory=None) -> None:
+        self.limit = limit
+        self.spill = spill
+        self.directory = directory
+        self.size = 0
+        # digest -> (result, size, seconds to compute it), least recently used first
+        self._entries = {}
+        # routine -> {"hits", "disk", "misses", "saved"}
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def _stats(self, name):
+        return self.stats.setdefault(name, {"hits": 0, "disk": 0, "misses": 0, "saved": 0.0})
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".pickle")
+
+    def get(self, name, key):
+        """``(True, result)`` of a memoized call, ``(False, None)`` on a miss."""
+
+        import pickle  # noqa: PLC0415
+
+        with self._lock:
+            stats = self._stats(name)
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                stats["hits"] += 1
+                stats["saved"] += entry[2]
+                return True, entry[0]
+            if self.spill:
+                try:
+                    with open(self._path(key), "rb") as f:
+                        result, seconds = pickle.load(f)
+                    os.utime(self._path(key))
+                except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+                    pass
+                else:
+                    stats["disk"] += 1
+                    stats["saved"] += seconds
+                    self._add(key, result, seconds)
+                    return True, result
+            stats["misses"] += 1
+            return False, None
+
+    def put(self, key, result, seconds) -> None:
+        with self._lock:
+            self._add(key, result, seconds)
+
+    def _add(self, key, result, seconds) -> None:
+        size = _result_size(result)
+        self._entries[key] = (result, size, seconds)
+        self.size += size
+        while self.size > self.limit and self._entries:
+            evicted = next(iter(self._entries))
+            result, size, seconds = self._entries.pop(evicted)
+            self.size -= size
+            if self.spill:
+                self._write(evicted, result, seconds)
+
+    def _write(self, key, result, seconds) -> None:
+        import pickle  # noqa: PLC0415
+
+        path = self._path(key)
+        if os.path.isfile(path):
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                pickle.dump((result, seconds), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+            files = sorted(self._files(), key=lambda e: e.stat().st_mtime, reverse=True)
+            total = 0
+            for entry in files:
+                total += entry.stat().st_size
+                if total > self.spill:
+                    os.remove(entry.path)
+        except OSError as e:
+            print(f"Warning: --memoize result not written to disk: {e}", file=sys.stderr)
+
+    def _files(self):
+        if not self.directory or not os.path.isdir(self.directory):
+            return []
+        return [e for e in os.scandir(self.directory) if e.name.endswith(".pickle")]
+
+    def disk_size(self):
+        return sum(e.stat().st_size for e in self._files())
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+            self.stats.clear()
+            for entry in self._files():
+                with contextlib.suppress(OSError):
+                    os.remove(entry.path)
+
+
+def _memoized(routine, module_name, name, memo):
+    """`routine` returning the results of `memo` for the calls already made."""
+
+    def call(*args, **kwargs):
+        try:
+            key = _memo_key(module_name, name, args, kwargs)
+        except TypeError:
+            return routine(*args, **kwargs)
+        found, result = memo.get(name, key)
+        if found:
+            # The caller may modify its result in place
+            return _result_copy(result)
+        start = time.perf_counter()
+        result = routine(*args, **kwargs)
+        memo.put(key, _result_copy(result), time.perf_counter() - start)
+        return result
+
+    call.__name__ = call.__qualname__ = name
+    call.__doc__ = routine.__doc__
+    call.__wrapped__ = routine
+    return call
+
+
+def _memoize(module, code, module_name, memo, fsuffix=".f90"):
+    """Namespace of `module` with its pure procedures memoized, or None if it has none.
+
+    Procedures with an ``intent(inout)`` argument are left as is, their
+    calls have an effect. Module procedures are memoized by name.
+    """
+
+    members = {k: v for k, v in vars(module).items() if k[:2] != "__"}
+    memoized = []
+    for name, (block, fmodule) in _procedures(_crack(code, fsuffix)).items():
+        prefix = _prefix(block)
+        if not prefix & {"pure", "elemental"} or "impure" in prefix:
+            continue
+        intents = [block["vars"].get(a, {}).get("intent", []) for a in block["args"]]
+        if any("inout" in i or {"in", "out"} <= set(i) for i in intents):
+            continue
+        routine = getattr(members.get(fmodule), name, None) if fmodule else members.get(name)
+        if routine is not None:
+            members[name] = _memoized(routine, module_name, name, memo)
+            memoized.append(name)
+    return types.SimpleNamespace(**members) if memoized else None
+
+
+# NumPy type & C interoperable declaration of (type, kind) for ufunc loops
+_UFUNC_TYPES = {
+    ("real", "4"): ("NPY_FLOAT", "real(c_float)"),
+    ("real", "8"): ("NPY_DOUBLE", "real(c_double)"),
+    ("integer", "4"): ("NPY_INT32", "integer(c_int32_t)"),
+    ("integer", "8"): ("NPY_INT64", "integer(c_int64_t)"),
+    ("complex", "4"): ("NPY_CFLOAT", "complex(c_float_complex)"),
+    ("complex", "8"): ("NPY_CDOUBLE", "complex(c_double_complex)"),
+}
+_C_KINDS = {
+    "c_float": "4",
+    "c_double": "8",
+    "c_int": "4",
+    "c_int32_t": "4",
+    "c_int64_t": "8",
+    "c_long_long": "8",
+    "c_float_complex": "4",
+    "c_double_complex": "8",
+}
+
+
+def _ufunc_type(var):
+    """`_UFUNC_TYPES` entry of a scalar variable, `None` if not supported.
+
+    Default kinds are single precision; unknown named kinds (e.g. `dp`)
+    use double precision or 64 bit integers, the wrapper converts.
+    """
+
+    typespec = {"double precision": "real", "double complex": "complex"}.get(var.get("typespec"), var.get("typespec"))
+    if typespec not in ("real", "integer", "complex") or var.get("dimension"):
+        return None
+    kinds = var.get("kindselector", {})
+    kind = str(kinds.get("kind", "")).lower()
+    if "*" in kinds:
+        kind = str(int(kinds["*"]) // 2) if typespec == "complex" else str(kinds["*"])
+    if var.get("typespec", "").startswith("double"):
+        kind = "8"
+    kind = _C_KINDS.get(kind, kind) or "4"
+    if kind not in ("4", "8"):
+        kind = "4" if typespec == "integer" and kind == "2" else "8"
+    return _UFUNC_TYPES.get((typespec, kind))
+
+
+_TYPE_RE = re.compile(
+    r"(real|integer|complex|double\s*precision|double\s*complex)\s*(?:\(\s*(?:kind\s*=\s*)?(\w+)\s*\)|\*\s*(\d+))?",
+    re.IGNORECASE,
+)
+
+
+def _result_variable(block):
+    """`crackfortran` variable of a function result, typed from the prefix if needed."""
+
+    var = block["vars"].get(block.get("result", block["name"]), {})
+    # crackfortran drops the kind of `elemental real(8) function f()`
+    m = _TYPE_RE.search(block.get("prefix", ""))
+    if m is None:
+        return var
+    typespec = re.sub(r"double\s*", "double ", m[1].lower())
+    kind = {"kind": m[2]} if m[2] else {"*": m[3]} if m[3] else {}
+    return {**var, "typespec": typespec, "kindselector": kind}
+
+
+def _ufunc_signature(block):
+    """``(inputs, outputs)`` of an elemental or pure scalar procedure, or `None`."""
+
+    if not _prefix(block) & {"elemental", "pure"}:
+        return None
+    inputs, outputs = [], []
+    for a in block["args"]:
+        var = block["vars"].get(a, {})
+        intent = [i for i in var.get("intent", []) if i in ("in", "out", "inout")] or ["in"]
+        if intent[0] == "inout" or "value" in var.get("attrspec", []) or _ufunc_type(var) is None:
+            return None
+        (inputs if intent[0] == "in" else outputs).append(a)
+    if block["block"] == "function":
+        if _ufunc_type(_result_variable(block)) is None:
+            return None
+        outputs.append(None)
+    return (inputs, outputs) if inputs and outputs else None
+
+
+def _ufunc_sources(blocks, module_name):
+    """Fortran `bind(C)` wrappers & C extension `<module_name>_ufunc` for the ufunc candidates.
+
+    Return ``(fortran, c, skip)``, `skip` are the names f2py must not
+    wrap: the wrappers, and the elemental module procedures which f2py
+    cannot pass to its module setup.
+    """
+
+    fortran, loops, inits, wrappers, skip = [], [], [], [], []
+    for name, (block, module) in sorted(_procedures(blocks).items()):
+        signature = _ufunc_signature(block)
+        if signature is None:
+            continue
+        inputs, outputs = signature
+        wrapper = f"fmu_{name}"
+        wrappers.append(wrapper)
+        if module and "elemental" in _prefix(block):
+            skip.append(name)
+        variables = {**block["vars"], None: _result_variable(block)}
+        dummies = [f"a{i}_" for i in range(len(inputs) + len(outputs))]
+        lines = [f"subroutine {wrapper}({', '.join(dummies)}) bind(C, name='{wrapper}')", "    use iso_c_binding"]
+        lines += [f"    use {u}" for u in ([module] if module else []) + list(block.get("use", {}))]
+        lines.append("    implicit none")
+        for dummy, a in zip(dummies, inputs + outputs, strict=True):
+            intent = "in" if a in inputs else "out"
+            lines.append(f"    {_ufunc_type(variables[a])[1]}, intent({intent}) :: {dummy}")
+        for i, a in enumerate(block["args"]):
+            lines.append(f"    {_type_declaration(variables[a], name)} :: v{i}_")
+        if None in outputs and not module:
+            lines.append(f"    {_result_declaration(block)}, external :: {name}")
+        for dummy, a in zip(dummies, inputs, strict=False):
+            lines.append(f"    v{block['args'].index(a)}_ = {dummy}")
+        actuals = ", ".join(f"v{i}_" for i in range(len(block["args"])))
+        if None in outputs:
+            lines.append(f"    {dummies[-1]} = {name}({actuals})")
+        else:
+            lines.append(f"    call {name}({actuals})")
+        for dummy, a in zip(dummies[len(inputs) :], outputs, strict=False):
+            if a is not None:
+                lines.append(f"    {dummy} = v{block['args'].index(a)}_")
+        lines.append(f"end subroutine {wrapper}\n")
+        fortran.append("\n".join(lines))
+
+        nargs = len(dummies)
+        pointers = ", ".join(f"args[{i}]" for i in range(nargs))
+        loops.append(
+            f"extern void {wrapper}({', '.join(['void *'] * nargs)});\n"
+            f"static void loop_{name}(char **args, npy_intp const *dimensions, npy_intp const *steps, void *data)\n"
+            "{\n"
+            "    npy_intp i, k;\n"
+            "    char *p[NPY_MAXARGS];\n"
+            f"    for (k = 0; k < {nargs}; k++) p[k] = args[k];\n"
+            "    for (i = 0; i < dimensions[0]; i++) {\n"
+            f"        {wrapper}({pointers.replace('args', 'p')});\n"
+            f"        for (k = 0; k < {nargs}; k++) p[k] += steps[k];\n"
+            "    }\n"
+            "}\n"
+            f"static PyUFuncGenericFunction funcs_{name}[1] = {{&loop_{name}}};\n"
+            f"static char types_{name}[{nargs}] = {{"
+            + ", ".join(_ufunc_type(variables[a])[0] for a in inputs + outputs)
+            + "};\n"
+            f"static void *data_{name}[1] = {{NULL}};\n"
+        )
+        inits.append(
+            f"    u = PyUFunc_FromFuncAndData(funcs_{name}, data_{name}, types_{name}, 1, {len(inputs)}, "
+            f'{len(outputs)}, PyUFunc_None, "{name}", "Fortran {name} as NumPy ufunc", 0);\n'
+            f'    if (u == NULL || PyModule_AddObject(m, "{name}", u) < 0) return NULL;\n'
+        )
+    if not wrappers:
+        raise UsageError("--ufunc: no elemental or pure procedure with scalar numeric arguments")
+
+    c = (
+        "#define PY_SSIZE_T_CLEAN\n"
+        "#include <Python.h>\n"
+        "#define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION\n"
+        "#include <numpy/ndarraytypes.h>\n"
+        "#include <numpy/ufuncobject.h>\n"
+        "\n"
+        + "\n".join(loops)
+        + f'\nstatic struct PyModuleDef moduledef = {{PyModuleDef_HEAD_INIT, "{module_name}_ufunc", NULL, -1, NULL}};\n'
+        f"\nPyMODINIT_FUNC PyInit_{module_name}_ufunc(void)\n"
+        "{\n"
+        "    PyObject *m, *u;\n"
+        "    import_array();\n"
+        "    import_umath();\n"
+        "    m = PyModule_Create(&moduledef);\n"
+        "    if (m == NULL) return NULL;\n" + "".join(inits) + "    return m;\n"
+        "}\n"
+    )
+    return "\n".join(fortran), c, wrappers + skip
+
+
+def _open_array(a, mode="r"):
+    """`a`, or the memory map of the `.npy` file `a`."""
+
+    import numpy as np  # noqa: PLC0415
+
+    return np.load(a, mmap_mode=mode) if isinstance(a, (str, os.PathLike)) else a
+
+
+def _chunk_length(a, axis, chunk_bytes):
+    """Number of slices along `axis` in a chunk of about `chunk_bytes`.
+
+    The chunks start on page boundaries whenever the slice size allows it.
+    """
+
+    slice_bytes = max(1, a.itemsize * (a.size // max(1, a.shape[axis])))
+    align = mmap.PAGESIZE // math.gcd(mmap.PAGESIZE, slice_bytes)
+    length = max(1, chunk_bytes // slice_bytes)
+    return max(align, length // align * align) if length >= align else length
+
+
+def _prefetch(views) -> None:
+    """Page in `views`: kernel read-ahead, then touch one byte per page."""
+
+    import numpy as np  # noqa: PLC0415
+
+    for v in views:
+        base = v
+        while getattr(base, "base", None) is not None and not isinstance(base, mmap.mmap):
+            base = base.base
+        if isinstance(base, mmap.mmap) and hasattr(mmap, "MADV_WILLNEED"):
+            start = v.__array_interface__["data"][0] - np.frombuffer(base, np.uint8).__array_interface__["data"][0]
+            offset = start // mmap.PAGESIZE * mmap.PAGESIZE
+            with contextlib.suppress(OSError, ValueError):
+                base.madvise(mmap.MADV_WILLNEED, offset, min(len(base) - offset, v.nbytes + start - offset))
+        if v.flags.c_contiguous or v.flags.f_contiguous:
+            v.ravel(order="K").view(np.uint8)[:: mmap.PAGESIZE].sum()
+
+
+def chunked(routine, *arrays, out=None, args=(), axis=None, halo=0, chunk_bytes=64 << 20, prefetch=True):  # noqa: PLR0913
+    """Call `routine` over chunks of large (memory mapped) `arrays`.
+
+    `arrays` are arrays, `np.memmap` or `.npy` file names (opened as
+    read-only memory maps). They are split along `axis`, by default the
+    slowest varying one (0, or the last for Fortran ordered arrays), so
+    every chunk is a contiguous view of the file: it is passed to
+    `routine` without copy when its type matches the Fortran argument.
+    For 2-D C ordered arrays f2py copies each chunk, pass the transpose
+    to avoid it.
+
+    ``routine(*chunks, *args)`` is called for each chunk. With `halo`,
+    the chunks overlap by `halo` slices on each side (less at the ends),
+    as needed by stencil kernels. The result of each call, minus the
+    halo, is stored in `out`: an array, or a `.npy` file name, opened as
+    a memory map once the first result is known (created again if its
+    shape or dtype differ from the ones of the results). `out` is
+    returned, `None` if `routine` returns nothing (e.g. `intent(inout)`
+    arguments updated in place).
+
+    With `prefetch`, the pages of the next chunk are read ahead on a
+    background thread while `routine` runs.
+    """
+
+    import numpy as np  # noqa: PLC0415
+
+    if not arrays:
+        raise TypeError("chunked() needs at least one array")
+    arrays = [_open_array(a) for a in arrays]
+    first = arrays[0]
+    if axis is None:
+        axis = -1 if first.ndim > 1 and first.flags.f_contiguous and not first.flags.c_contiguous else 0
+    axis %= first.ndim
+    n = first.shape[axis]
+    if any(a.shape[axis % a.ndim] != n for a in arrays):
+        raise ValueError(f"chunked(): arrays differ in length along axis {axis}")
+    length = _chunk_length(first, axis, chunk_bytes)
+    bounds = [(lo, min(lo + length, n)) for lo in range(0, n, length)]
+
+    def views(lo, hi):
+        start, stop = max(lo - halo, 0), min(hi + halo, n)
+        return start, [a[(slice(None),) * (axis % a.ndim) + (slice(start, stop),)] for a in arrays]
+
+    pool = None
+    if prefetch and len(bounds) > 1:
+        import concurrent.futures  # noqa: PLC0415
+
+        pool = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="fortranmagic-prefetch")
+    try:
+        for i, (lo, hi) in enumerate(bounds):
+            start, chunk = views(lo, hi)
+            if pool is not None and i + 1 < len(bounds):
+                pool.submit(_prefetch, views(*bounds[i + 1])[1])
+            result = routine(*(np.asarray(c) for c in chunk), *args)
+            if result is None:
+                continue
+            result = np.asarray(result)
+            if isinstance(out, (str, os.PathLike)):
+                shape = (*result.shape[:axis], n, *result.shape[axis + 1 :])
+                existing = np.load(out, mmap_mode="r+") if os.path.isfile(out) else None
+                if existing is not None and existing.shape == shape and existing.dtype == result.dtype:
+                    out = existing
+                else:
+                    # e.g. the output of a larger run: replaced, not partly overwritten
+                    del existing
+                    out = np.lib.format.open_memmap(out, "w+", result.dtype, shape, fortran_order=result.flags.fnc)
+            elif out is None:
+                raise ValueError("chunked(): `routine` returns a result, `out` is needed")
+            index = (slice(None),) * axis
+            out[(*index, slice(lo, hi))] = result[(*index, slice(lo - start, hi - start))]
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
+
+
+_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS modules (
+    module TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    line TEXT,
+    config TEXT,
+    python TEXT,
+    f2py TEXT,
+    fc TEXT,
+    cc TEXT,
+    links TEXT,
+    code TEXT,
+    size INTEGER,
+    build_time REAL,
+    created REAL,
+    last_used REAL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    pinned INTEGER NOT NULL DEFAULT 0
+)
+"""
+# A database of its own, kept when the modules are purged & by
+# `--clean-cache`: the history outlives the builds
+_TIMINGS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS timings (
+    routine TEXT NOT NULL,
+    module TEXT NOT NULL,
+    line TEXT,
+    statement TEXT NOT NULL,
+    created REAL NOT NULL,
+    samples TEXT NOT NULL
+)
+"""
+
+
+_MB = 1e6
+
+
+def _size_text(size):
+    return f"{size / _MB:.1f} MB" if size >= _MB else f"{size / 1e3:.0f} kB"
+
+
+# Key components of a module, see `FortranMagics._fortran_build`
+_INDEX_KEY = ("line", "config", "python", "f2py", "fc", "cc", "links", "code")
+
+
+class _CacheIndex:
+    """SQLite index of the cached modules: key components & usage.
+
+    A short connection is opened per operation, so concurrent sessions
+    share the index and `--clean-cache` can remove it at any time. The
+    timings of `%fortran_bench` are kept in the `history` database.
+    """
+
+    def __init__(self, path, history=None) -> None:
+        self.path = path
+        self.history = history or path
+
+    def _connect(self, path):
+        import sqlite3  # noqa: PLC0415
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        db = sqlite3.connect(path, timeout=30)
+        db.row_factory = sqlite3.Row
+        if path == self.path:
+            db.execute(_INDEX_SCHEMA)
+        if path == self.history:
+            db.execute(_TIMINGS_SCHEMA)
+        return db
+
+    def _execute(self, sql, parameters=(), path=None):
+        with contextlib.closing(self._connect(path or self.path)) as db, db:
+            return db.execute(sql, parameters).fetchall()
+
+    @staticmethod
+    def _size(directory, module):
+        return sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory) if f.startswith(module))
+
+    def _insert(self, module, directory, components, **columns) -> None:
+        columns = {
+            "module": module,
+            "directory": directory,
+            **dict(zip(_INDEX_KEY, components, strict=True)),
+            **columns,
+        }
+        self._execute(
+            f"INSERT OR REPLACE INTO modules ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+            tuple(columns.values()),
+        )
+
+    def record(self, module, directory, components, build_time=None) -> float:
+        """Record a build (`build_time` in seconds) or a hit, return the build time saved by a hit."""
+
+        now = time.time()
+        size = self._size(directory, module)
+        if build_time is not None:
+            self._insert(module, directory, components, size=size, build_time=build_time, created=now, last_used=now)
+            return 0.0
+        rows = self._execute("SELECT build_time FROM modules WHERE module = ?", (module,))
+        if rows:
+            self._execute(
+                "UPDATE modules SET hits = hits + 1, last_used = ?, size = ? WHERE module = ?", (now, size, module)
+            )
+        else:
+            # Built before the index existed
+            self._insert(module, directory, components, size=size, created=now, last_used=now, hits=1)
+        return (rows[0]["build_time"] if rows else None) or 0.0
+
+    def entries(self, query=None):
+        """Index rows, most recently used first, filtered by a substring of the module, line or code."""
+
+        sql = "SELECT * FROM modules"
+        parameters = ()
+        if query:
+            sql += " WHERE module LIKE ? OR line LIKE ? OR code LIKE ?"
+            parameters = (f"%{query}%",) * 3
+        return self._execute(sql + " ORDER BY last_used DESC", parameters)
+
+    def pin(self, module, pinned=True):
+        """(Un)pin the modules starting with `module`, return their names."""
+
+        where = "WHERE substr(module, 1, length(?)) = ?"
+        rows = self._execute(f"SELECT module FROM modules {where}", (module, module))
+        self._execute(f"UPDATE modules SET pinned = ? {where}", (pinned, module, module))
+        return [r["module"] for r in rows]
+
+    def record_timing(self, routine, module, statement, samples) -> None:
+        """Record the per-loop times `samples` (seconds) of `statement` calling `routine` of `module`."""
+
+        rows = self._execute("SELECT line FROM modules WHERE module = ?", (module,))
+        self._execute(
+            "INSERT INTO timings (routine, module, line, statement, created, samples) VALUES (?, ?, ?, ?, ?, ?)",
+            (routine, module, rows[0]["line"] if rows else None, statement, time.time(), json.dumps(samples)),
+            self.history,
+        )
+
+    def timings(self, routine=None):
+        """Timing rows, oldest first, with the %%fortran line of their module."""
+
+        sql = "SELECT * FROM timings"
+        parameters = ()
+        if routine:
+            sql += " WHERE routine = ?"
+            parameters = (routine,)
+        return self._execute(sql + " ORDER BY created", parameters, self.history)
+
+    def purge(self, rows) -> None:
+        """Remove the files & index entries of `rows`."""
+
+        for r in rows:
+            with contextlib.suppress(FileNotFoundError):
+                for f in os.listdir(r["directory"]):
+                    if f.startswith(r["module"]):
+                        _remove_quietly(os.path.join(r["directory"], f))
+            self._execute("DELETE FROM modules WHERE module = ?", (r["module"],))
+
+
+class _DirectoryStore:
+    """Module store in a directory, local or shared by several hosts."""
+
+    def __init__(self, directory) -> None:
+        self.directory = directory
+
+    def __repr__(self) -> str:
+        return self.directory
+
+    def get(self, name, path) -> bool:
+        source = os.path.join(self.directory, name)
+        if not os.path.isfile(source):
+            return False
+        tmp = f"{path}.{os.getpid()}.tmp"
+        shutil.copyfile(source, tmp)
+        os.replace(tmp, path)
+        return True
+
+    def put(self, name, path) -> None:
+        target = os.path.join(self.directory, name)
+        if not os.path.isfile(target):
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = f"{target}.{os.getpid()}.tmp"
+            shutil.copyfile(path, tmp)
+            os.replace(tmp, target)
+
+
+class _HTTPStore:
+    """Module store of a HTTP server: ``GET``/``PUT`` of ``<url>/<name>``."""
+
+    timeout = 30
+
+    def __init__(self, url) -> None:
+        self.url = url.rstrip("/")
+
+    def __repr__(self) -> str:
+        return self.url
+
+    def get(self, name, path) -> bool:
+        import urllib.error  # noqa: PLC0415
+        import urllib.request  # noqa: PLC0415
+
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            with urllib.request.urlopen(f"{self.url}/{name}", timeout=self.timeout) as r, open(tmp, "wb") as f:
+                shutil.copyfileobj(r, f)
+        except urllib.error.HTTPError as e:
+            _remove_quietly(tmp)
+            if e.code == 404:  # noqa: PLR2004
+                return False
+            raise
+        os.replace(tmp, path)
+        return True
+
+    def put(self, name, path) -> None:
+        import urllib.request  # noqa: PLC0415
+
+        with open(path, "rb") as f:
+            request = urllib.request.Request(f"{self.url}/{name}", data=f.read(), method="PUT")
+        with urllib.request.urlopen(request, timeout=self.timeout):
+            pass
+
+
+# `--remote-cache` URL scheme: store class
+_CACHE_STORES = {"file": _DirectoryStore, "http": _HTTPStore, "https": _HTTPStore}
+
+
+def _cache_store(url):
+    """Store of a `--remote-cache` URL, a plain path is a directory."""
+
+    scheme, sep, rest = url.partition("://")
+    if not sep:
+        return _DirectoryStore(url)
+    if scheme not in _CACHE_STORES:
+        raise UsageError(f"--remote-cache: unknown scheme {scheme!r}")
+    return _CACHE_STORES[scheme](rest if scheme == "file" else url)
+
+
+def _store_call(store, method, path):
+    """``store.<method>(name, path)``, a warning & `None` on failure."""
+
+    try:
+        return getattr(store, method)(os.path.basename(path), path)
+    except OSError as e:
+        print(f"Warning: remote cache {store!r}: {e}", file=sys.stderr)
+        return None
+
+
+# Flags of builds for the CPU of the host, e.g. `-march=native`
+_NATIVE_RE = re.compile(r"=native\b|-xhost\b", re.IGNORECASE)
+
+
+@functools.cache
+def _cpu_model():
+    """Model of the CPU of the host, part of the key of `-march=native` builds."""
+
+    with contextlib.suppress(OSError), open("/proc/cpuinfo", encoding="utf-8") as f:
+        for line in f:
+            if line.startswith(("model name", "Processor", "CPU part")):
+                return line.partition(":")[2].strip()
+    return platform.processor() or platform.machine()
+
+
+def _cache_fetch(stores, path) -> bool:
+    """Copy the module `path` from the first store that has it."""
+
+    return any(_store_call(store, "get", path) for store in stores)
+
+
+def _cache_push(stores, path) -> None:
+    for store in stores:
+        _store_call(store, "put", path)
+
+
+_BIND_RE = re.compile(
+    r"\b(?:subroutine|function)\s+(\w+)\s*\([^)]*\)\s*(?:result\s*\(\s*\w+\s*\)\s*)?"
+    r"bind\s*\(\s*c\s*(?:,\s*name\s*=\s*(['\"])(.*?)\2\s*)?\)",
+    re.IGNORECASE,
+)
+_SHLIB_SUFFIX = ".dll" if sys.platform == "win32" else sysconfig.get_config_var("SHLIB_SUFFIX") or ".so"
+
+
+def _bind_names(code):
+    """Map the `bind(C)` procedures of `code` to their C names.
+
+    crackfortran misses the binding of most procedures, hence the regex.
+    """
+
+    code = re.sub(r"&[ \t]*(?:!.*)?\n\s*&?", " ", code)
+    return {m[1].lower(): m[3] or m[1].lower() for m in _BIND_RE.finditer(code)}
+
+
+# NumPy dtype (or ctypes type name, for the C types of the platform) of
+# the (type, kind) of the `bind(C)` arguments, passed as raw memory
+_BINDC_TYPES = {
+    **{("integer", k): t for k, t in (("1", "int8"), ("2", "int16"), ("4", "int32"), ("8", "int64"))},
+    **{("logical", k): t for k, t in (("1", "bool"), ("2", "int16"), ("4", "int32"), ("8", "int64"))},
+    ("real", "4"): "float32",
+    ("real", "8"): "float64",
+    ("complex", "4"): "complex64",
+    ("complex", "8"): "complex128",
+    ("integer", "c_signed_char"): "c_byte",
+    ("integer", "c_short"): "c_short",
+    ("integer", "c_int"): "c_int",
+    ("integer", "c_long"): "c_long",
+    ("integer", "c_long_long"): "c_longlong",
+    ("integer", "c_size_t"): "c_size_t",
+    ("integer", "c_intptr_t"): "c_ssize_t",
+    ("integer", "c_ptrdiff_t"): "c_ssize_t",
+    **{("integer", f"c_int{n}_t"): f"int{n}" for n in (8, 16, 32, 64)},
+    **{("integer", f"c_int_least{n}_t"): f"int{n}" for n in (8, 16, 32, 64)},
+    ("real", "c_float"): "float32",
+    ("real", "c_double"): "float64",
+    ("real", "c_long_double"): "c_longdouble",
+    ("complex", "c_float_complex"): "complex64",
+    ("complex", "c_double_complex"): "complex128",
+    ("logical", "c_bool"): "bool",
+}
+
+
+def _bindc_dtype(var, where):
+    """NumPy dtype of a `bind(C)` argument, the exact type of its memory."""
+
+    import ctypes  # noqa: PLC0415
+
+    import numpy as np  # noqa: PLC0415
+
+    typespec = var.get("typespec")
+    kinds = var.get("kindselector", {})
+    kind = str(kinds.get("kind", "")).lower()
+    if typespec in ("double precision", "double complex"):
+        typespec, kind = typespec.split()[1].replace("precision", "real"), "8"
+    elif "*" in kinds:
+        kind = str(int(kinds["*"]) // 2) if typespec == "complex" else str(kinds["*"])
+    elif not kind:
+        # Default kinds
+        kind = "4"
+    t = _BINDC_TYPES.get((typespec, kind))
+    if t is None and typespec == "logical":
+        # e.g. logical(c_int): an int of 0 or 1
+        t = _BINDC_TYPES.get(("integer", kind))
+    if t is None:
+        raise UsageError(
+            f"{where}: {typespec or 'untyped'}({kind}) arguments are not supported, use an iso_c_binding kind"
+        )
+    return np.dtype(getattr(ctypes, t) if t.startswith("c_") else t)
+
+
+def _bindc_ctype(dtype):
+    """ctypes type of scalars of `dtype`, None if ctypes has none (complex, long double)."""
+
+    import numpy as np  # noqa: PLC0415
+
+    if dtype.kind == "c":
+        return None
+    try:
+        return np.ctypeslib.as_ctypes_type(dtype)
+    except NotImplementedError:
+        return None
+
+
+def _bindc_procedure(library, symbol, block):
+    """Python function calling the `bind(C)` procedure `block` through ctypes.
+
+    The conversion of every argument is worked out once from the Fortran
+    interface and compiled into a function without per-call dispatch. Like
+    f2py, `intent(out)` arguments are not passed but returned after the
+    function result, and `intent(inout)` arguments must be arrays of the
+    exact type (Fortran contiguous, 0-d for scalars), updated in place.
+    Array sizes are not checked.
+    """
+
+    import ctypes  # noqa: PLC0415
+
+    import numpy as np  # noqa: PLC0415
+
+    def address(x):
+        # Much cheaper than `x.ctypes.data`, which is the fallback for
+        # read-only & empty arrays
+        try:
+            return ctypes.byref(ctypes.c_char.from_buffer(x))
+        except (TypeError, ValueError):
+            return x.ctypes.data
+
+    name = block["name"]
+    function = getattr(library, symbol)
+    ns = {"_f": function, "_address": address, "_byref": ctypes.byref, "_ndarray": np.ndarray}
+    ns |= {"_int": int, "_require": np.require, "_zeros": np.zeros}
+    params = {a: a + "_" if keyword.iskeyword(a) else a for a in block["args"]}
+    argtypes, inputs, outputs, doc, body, actuals, results = [], [], [], [], [], [], []
+    for a, p in params.items():
+        var = block["vars"].get(a, {})
+        dtype = _bindc_dtype(var, f"{name}({a})")
+        intent = ([i for i in var.get("intent", []) if i in ("in", "out", "inout")] or ["in"])[0]
+        ctype = _bindc_ctype(dtype)
+        ns[f"_d_{a}"], ns[f"_c_{a}"] = dtype, ctype
+        dims = var.get("dimension")
+        shape = []
+        for dim in dims if dims and intent == "out" else ():
+            d = dim.strip().lower()
+            if d.isdigit():
+                shape.append(d)
+            elif d in params and not block["vars"].get(d, {}).get("dimension"):
+                shape.append(f"_int({params[d]})")
+            else:
+                raise UsageError(f"{name}({a}): intent(out) array of shape ({', '.join(dims)}) not supported")
+        if "value" in var.get("attrspec", []):
+            if ctype is None:
+                raise UsageError(f"{name}({a}): {dtype} values are not supported, pass by reference")
+            kind = "value"
+            argtypes.append(ctype)
+            actuals.append(p)
+        else:
+            kind = ("array " if dims else "") + intent
+            argtypes.append(ctypes.c_void_p)
+            if intent == "out" and ctype is not None and not dims:
+                body.append(f"{p} = _c_{a}()")
+                actuals.append(f"_byref({p})")
+                results.append(f"{p}.value")
+            elif intent == "out":
+                body.append(f"{p} = _zeros(({''.join(s + ', ' for s in shape)}), _d_{a}, order='F')")
+                actuals.append(f"_address({p})")
+                results.append(f"{p}" if dims else f"{p}[()]")
+            elif intent == "in" and ctype is not None and not dims:
+                actuals.append(f"_byref(_c_{a}({p}))")
+            elif intent == "in":
+                body.append(f"if not (type({p}) is _ndarray and {p}.dtype is _d_{a} and {p}.flags.f_contiguous):")
+                body.append(f"    {p} = _require({p}, _d_{a}, 'F')")
+                actuals.append(f"_address({p})")
+            else:
+                body.append(f"if not (type({p}) is _ndarray and {p}.dtype == _d_{a} and {p}.flags.f_contiguous):")
+                body.append(
+                    f"    raise TypeError(\"{name}() argument '{a}': expected a Fortran contiguous {dtype} array\")"
+                )
+                actuals.append(f"_address({p})")
+        (outputs if intent == "out" else inputs).append(a)
+        doc.append(f"  {a}: {dtype} {'value' if kind == 'value' else kind}")
+    function.argtypes = argtypes
+    function.restype = None
+    if block["block"] == "function":
+        dtype = _bindc_dtype(_result_variable(block), f"{name}()")
+        function.restype = _bindc_ctype(dtype)
+        if function.restype is None:
+            raise UsageError(f"{name}(): {dtype} results are not supported")
+        outputs.insert(0, block.get("result", name))
+        results.insert(0, "_r")
+    call = f"_f({', '.join(actuals)})"
+    body.append(f"_r = {call}" if block["block"] == "function" else call)
+    body.append(f"return {', '.join(results) or 'None'}")
+    source = f"def _procedure({', '.join(params[a] for a in inputs)}):\n" + "".join(f"    {s}\n" for s in body)
+    exec(compile(source, f"<bind(C) {name}>", "exec"), ns)
+    procedure = ns["_procedure"]
+    procedure.__name__ = procedure.__qualname__ = name
+    procedure.__doc__ = f"{name}({', '.join(inputs)}) -> {', '.join(outputs) or 'None'}\n\n" + "\n".join(doc)
+    return procedure
+
+
+def _bindc_command(args, env, toolchain, fflags, sources, target):  # noqa: PLR0913, PLR0917
+    """Compiler command line of a `--backend bindc` shared library."""
+
+    fc = _tool_command(env, toolchain, "fc")
+    if not fc:
+        raise UsageError("--backend bindc: no Fortran compiler found")
+    command = [*fc, "-shared", *([] if sys.platform == "win32" else ["-fPIC"])]
+    command += ["-g"] if args.debug else ["-O3"]
+    command += [*shlex.split(fflags or ""), *sources, "-o", target]
+    for r in args.link:
+        resource = _toolchain_resource(r)
+        if not resource["found"]:
+            raise UsageError(f"--link {r}: not found by pkg-config")
+        command += shlex.split(resource["libs"] or "")
+    if args.extra:
+        command += " ".join(map(unquote, args.extra)).split()
+    return command
+
+
+def _bindc_module(code, path, fsuffix=".f90"):
+    """Namespace of the `bind(C)` procedures of `code` in the shared library `path`."""
+
+    import ctypes  # noqa: PLC0415
+
+    library = ctypes.CDLL(path)
+    names = _bind_names(code)
+    procedures = _procedures(_crack(code, fsuffix))
+    return types.SimpleNamespace(
+        **{name: _bindc_procedure(library, symbol, procedures[name][0]) for name, symbol in names.items()}
+    )
+
+
 def compose(*decorators):
     """Helper to compose decorators::
 
@@ -49,23 +2201,589 @@ def compose(*decorators):
 
     Is equivalent to::
 
-        @compose(a, b)
-        def f():
-            ...
-    """
+        @compose(a, b)
+        def f():
+            ...
+    """
+
+    def composed(f):
+        for decor in reversed(decorators):
+            f = decor(f)
+        return f
+
+    return composed
+
+
+def unquote(v):
+    if (v.startswith('"') and v.endswith('"')) or (v.startswith("'") and v.endswith("'")):
+        return v[1:-1]
+    return v
+
+
+def _notebook_fortran_cells(path):
+    """Yield ``(line, cell)`` for every `%%fortran` code cell of a notebook."""
+
+    with open(path, encoding="utf-8") as f:
+        nb = json.load(f)
+    for c in nb.get("cells", []):
+        if c.get("cell_type") != "code":
+            continue
+        source = c.get("source", "")
+        if not isinstance(source, str):
+            source = "".join(source)
+        first, _, cell = source.lstrip().partition("\n")
+        if first.startswith("%%fortran") and first[len("%%fortran") :][:1] in ("", " ", "\t"):
+            yield first[len("%%fortran") :].strip(), cell
+
+
+def _wheel_tag():
+    """Compatibility tag of the running interpreter, e.g. ``cp312-cp312-linux_x86_64``."""
+
+    impl = {"cpython": "cp", "pypy": "pp"}.get(sys.implementation.name, "py")
+    interpreter = "{}{}{}".format(impl, *sys.version_info[:2])
+    abi = interpreter + sys.abiflags if impl == "cp" else sys.implementation.cache_tag.replace("-", "_")
+    platform = sysconfig.get_platform().replace("-", "_").replace(".", "_")
+    return f"{interpreter}-{abi}-{platform}"
+
+
+def _write_wheel(wheel_dir, name, version, files):
+    """Write a binary wheel with ``files``, a mapping of archive names to contents."""
+
+    dist_info = f"{name}-{version}.dist-info"
+    tag = _wheel_tag()
+    files = dict(files)
+    files[f"{dist_info}/METADATA"] = (
+        "Metadata-Version: 2.1\n"
+        f"Name: {name}\n"
+        f"Version: {version}\n"
+        "Summary: Fortran extension modules exported by fortranmagic\n"
+        "Requires-Dist: numpy\n"
+    ).encode()
+    files[f"{dist_info}/WHEEL"] = (
+        f"Wheel-Version: 1.0\nGenerator: fortranmagic {__version__}\nRoot-Is-Purelib: false\nTag: {tag}\n"
+    ).encode()
+
+    record = []
+    for arcname, data in files.items():
+        digest = base64.urlsafe_b64encode(hashlib.sha256(data).digest()).rstrip(b"=").decode()
+        record.append(f"{arcname},sha256={digest},{len(data)}")
+    record.append(f"{dist_info}/RECORD,,")
+
+    wheel_path = os.path.join(wheel_dir, f"{name}-{version}-{tag}.whl")
+    with zipfile.ZipFile(wheel_path, "w", zipfile.ZIP_DEFLATED) as whl:
+        for arcname, data in files.items():
+            whl.writestr(arcname, data)
+        whl.writestr(f"{dist_info}/RECORD", "\n".join(record) + "\n")
+    return wheel_path
+
+
+# Compiler flags tried by `--autotune`, after those of the cell. The
+# GCC spelling is understood by gfortran, flang & nvfortran (in part);
+# the variants a compiler rejects are reported as failed builds.
+_AUTOTUNE_FLAGS = (
+    "-O2",
+    "-O2 -fno-tree-vectorize",
+    "-O3",
+    "-O3 -funroll-loops",
+    "-O3 -march=native",
+    "-O3 -march=native -funroll-loops",
+    "-O3 -march=native -ffast-math",
+    "-Ofast -march=native -funroll-loops",
+)
+_AUTOTUNE_REPEAT = 5
+
+
+def _slower_p_value(current, earlier):
+    """p-value of `current` samples being larger than `earlier` ones.
+
+    One-sided Mann-Whitney U test, normal approximation with continuity
+    & ties corrections: timings are far from normally distributed.
+    """
+
+    n1, n2 = len(current), len(earlier)
+    values = sorted([*current, *earlier])
+    ranks, ties, i = {}, 0, 0
+    while i < len(values):
+        j = i
+        while j + 1 < len(values) and values[j + 1] == values[i]:
+            j += 1
+        ranks[values[i]] = (i + j) / 2 + 1
+        ties += (j - i + 1) ** 3 - (j - i + 1)
+        i = j + 1
+    n = n1 + n2
+    u = sum(ranks[x] for x in current) - n1 * (n1 + 1) / 2
+    variance = n1 * n2 / 12 * ((n + 1) - ties / (n * (n - 1)))
+    if variance <= 0:
+        return 1.0
+    z = (u - n1 * n2 / 2 - 0.5) / math.sqrt(variance)
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def _bench_report(rows, threshold=0.05, alpha=0.05):
+    """History of `_CacheIndex.timings` rows: report lines & regressions.
+
+    Per routine & statement, the samples of the most recent build are
+    compared with those of every earlier build. A regression is a
+    slowdown of the median larger than `threshold` (relative) that is
+    significant at level `alpha`.
+    """
+
+    import statistics  # noqa: PLC0415
+
+    histories = {}
+    for r in rows:
+        builds = histories.setdefault((r["routine"], r["statement"]), {})
+        build = builds.pop(r["module"], {"samples": [], "line": r["line"]})
+        build["samples"] += json.loads(r["samples"])
+        build["created"] = r["created"]
+        builds[r["module"]] = build  # most recent last
+    lines, regressions = [], []
+    for (routine, statement), builds in histories.items():
+        lines.append(f"{routine}: {statement}")
+        lines.append(f"  {'build':<10}  {'last run':<16}  {'median':>9}  {'runs':>4}  current vs build")
+        *_, current = builds.values()
+        for module, build in builds.items():
+            median = statistics.median(build["samples"])
+            change = "current"
+            if build is not current:
+                ratio = statistics.median(current["samples"]) / median
+                p = _slower_p_value(current["samples"], build["samples"])
+                change = f"{ratio - 1:+.1%} (p={p:.3f})"
+                if ratio > 1 + threshold and p < alpha:
+                    change += " REGRESSION"
+                    regressions.append((routine, statement, module))
+            used = time.strftime("%Y-%m-%d %H:%M", time.localtime(build["created"]))
+            lines.append(
+                f"  {module.removeprefix('_fortran_magic_')[:10]:<10}  {used:<16}  {_time_text(median):>9}  "
+                f"{len(build['samples']):>4}  {change}" + (f"  [{build['line']}]" if build["line"] else "")
+            )
+    return lines, regressions
+
+
+def _time_text(seconds):
+    for unit, scale in (("s", 1.0), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.3g} {unit}"
+    return f"{seconds / 1e-9:.3g} ns"
+
+
+def _same_result(a, b):
+    """Whether `a` & `b`, results of the `--autotune` statement, agree.
+
+    Numbers & arrays are compared with the tolerance of
+    `numpy.allclose`, since flags like `-ffast-math` reorder operations.
+    """
+
+    import numpy as np  # noqa: PLC0415
+
+    if isinstance(a, tuple | list) and isinstance(b, tuple | list):
+        return len(a) == len(b) and all(_same_result(x, y) for x, y in zip(a, b, strict=True))
+    try:
+        x, y = np.asarray(a), np.asarray(b)
+        if x.dtype.kind in "biufc" and y.dtype.kind in "biufc":
+            return x.shape == y.shape and bool(np.allclose(x, y, equal_nan=True))
+    except (TypeError, ValueError):
+        pass
+    return bool(a == b)
+
+
+def _strip_option(line, option):
+    """`line` without the magic `option` & its value."""
+
+    argv, skip = [], False
+    for arg in arg_split(line):
+        if skip:
+            skip = False
+        elif arg == option:
+            skip = True
+        elif not arg.startswith(option + "="):
+            argv.append(arg)
+    return " ".join(argv)
+
+
+# Directory of the build slots shared by the kernels of the host
+_BUILD_SLOTS_DIR = None
+# Shorter waits for a build slot are not reported, seconds
+_QUEUED_REPORT = 0.5
+
+
+class _BuildSlots:
+    """Host-wide pool of build slots, so concurrent kernels don't overload the node.
+
+    A slot is a lock file of `directory` held with ``flock`` during the
+    build: the kernel of a process that dies releases it. At most `limit`
+    builds run at once; "bulk" builds (`%fortran_export`, `--autotune`)
+    leave the free slots to the "interactive" builds waiting, which
+    announce themselves with a locked ``waiting-*`` file. Without
+    ``fcntl`` (Windows) or with a `limit` of 0 builds are not limited.
+    After `max_wait` seconds without a free slot, the build runs anyway.
+    """
+
+    poll = 0.05
+
+    def __init__(self, directory, limit, max_wait=600.0) -> None:
+        self.directory = directory
+        self.limit = limit
+        self.max_wait = max_wait
+
+    @classmethod
+    def host(cls):
+        """Slots of `FORTRANMAGIC_MAX_BUILDS` (default: the CPU count).
+
+        The wait for a slot is bounded by `FORTRANMAGIC_MAX_BUILD_WAIT`
+        seconds (default: 600).
+        """
+
+        directory = _BUILD_SLOTS_DIR or os.path.join(tempfile.gettempdir(), "fortranmagic-builds")
+        try:
+            limit = int(os.environ.get("FORTRANMAGIC_MAX_BUILDS", os.cpu_count() or 1))
+        except ValueError:
+            print("Warning: FORTRANMAGIC_MAX_BUILDS is not an integer, builds are not limited", file=sys.stderr)
+            limit = 0
+        try:
+            max_wait = float(os.environ.get("FORTRANMAGIC_MAX_BUILD_WAIT", "600"))
+        except ValueError:
+            print("Warning: FORTRANMAGIC_MAX_BUILD_WAIT is not a number, using 600 s", file=sys.stderr)
+            max_wait = 600.0
+        return cls(directory, limit, max_wait)
+
+    def _open(self, name):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+            # Shared by the users of the host
+            with contextlib.suppress(OSError):
+                os.chmod(self.directory, 0o1777)
+        return os.open(os.path.join(self.directory, name), os.O_RDONLY | os.O_CREAT, 0o666)
+
+    def _try_lock(self, fd):
+        import fcntl  # noqa: PLC0415
+
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        return True
+
+    def _interactive_waiting(self, own=None):
+        for name in os.listdir(self.directory):
+            if name.startswith("waiting-") and name != own:
+                fd = self._open(name)
+                try:
+                    if not self._try_lock(fd):
+                        return True
+                finally:
+                    os.close(fd)
+                # Left by a dead process
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.join(self.directory, name))
+        return False
+
+    def _take(self, bulk, waiting):
+        if bulk and self._interactive_waiting(waiting):
+            return None
+        for i in range(self.limit):
+            fd = self._open(f"slot-{i}.lock")
+            if self._try_lock(fd):
+                return fd
+            os.close(fd)
+        return None
+
+    @contextlib.contextmanager
+    def acquire(self, priority="interactive"):
+        """Hold a slot during the ``with`` block, yield the seconds waited for it.
+
+        Past `max_wait` the block runs without a slot, with a warning.
+        """
+
+        if self.limit <= 0 or os.name == "nt":
+            yield 0.0
+            return
+        start = time.monotonic()
+        waiting = waiting_fd = None
+        fd = self._take(priority == "bulk", None)
+        try:
+            if fd is None and priority != "bulk":
+                waiting = f"waiting-{os.getpid()}-{threading.get_ident()}"
+                waiting_fd = self._open(waiting)
+                self._try_lock(waiting_fd)
+            while fd is None:
+                if time.monotonic() - start >= self.max_wait:
+                    print(
+                        f"Warning: no free build slot after {self.max_wait:g} s "
+                        "(FORTRANMAGIC_MAX_BUILD_WAIT), building without one",
+                        file=sys.stderr,
+                    )
+                    break
+                time.sleep(self.poll)
+                fd = self._take(priority == "bulk", waiting)
+        finally:
+            if waiting_fd is not None:
+                os.close(waiting_fd)
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.join(self.directory, waiting))
+        try:
+            yield time.monotonic() - start
+        finally:
+            # Closing the file releases the lock
+            if fd is not None:
+                os.close(fd)
+
+
+_EVENTS = ("cache_hit", "cache_miss", "build_started", "build_finished", "module_loaded")
+
+
+class _Events:
+    """Callbacks of the build & cache events, see `FortranMagics.events`."""
+
+    def __init__(self) -> None:
+        self.callbacks = {event: [] for event in _EVENTS}
+
+    def register(self, event, callback) -> None:
+        """Call ``callback(record)`` on `event`; `record` is a dict of the event fields."""
+
+        if event not in self.callbacks:
+            raise KeyError(f"Unknown event {event!r}, expected one of: {', '.join(_EVENTS)}")
+        self.callbacks[event].append(callback)
+
+    def unregister(self, event, callback) -> None:
+        self.callbacks[event].remove(callback)
+
+    def trigger(self, event, **fields) -> None:
+        callbacks = self.callbacks[event]
+        if callbacks:
+            record = {"event": event, "time": time.time(), "pid": os.getpid(), **fields}
+            for callback in list(callbacks):
+                _notify(callback, record)
+
+
+def _notify(callback, record) -> None:
+    # A failing callback (e.g. a full disk) must not fail the cell
+    try:
+        callback(record)
+    except Exception as e:  # noqa: BLE001
+        print(f"Warning: {record['event']} callback {callback!r} failed: {e}", file=sys.stderr)
+
+
+def _log_lines(log):
+    try:
+        with open(log, encoding="utf-8", errors="replace") as f:
+            return _ANSI_RE.sub("", f.read()).splitlines()
+    except OSError:
+        return []
+
+
+def _first_error(log):
+    return next((line.strip() for line in _log_lines(log) if _ERROR_RE.search(line)), None)
+
+
+def _failure_reason(log, timed_out=False):
+    """Coarse reason of a failed build (e.g. for metric labels) from its log."""
+
+    if timed_out:
+        return "timeout"
+    lines = _log_lines(log)
+    if any(s in line for line in lines for s in ("undefined reference", "ld returned", "Undefined symbols")):
+        return "link"
+    if any(_ERROR_RE.search(line) for line in lines):
+        return "compile"
+    return "unknown"
+
+
+class _JSONLinesExporter:
+    """Append every event as a JSON line to `path`."""
+
+    def __init__(self, path) -> None:
+        self.path = path
+
+    def __repr__(self) -> str:
+        return f"jsonl:{self.path}"
+
+    def __call__(self, record) -> None:
+        # One short append per event: lines of concurrent kernels don't mix
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+class _PrometheusExporter:
+    """Counters of the events of this process in a Prometheus text file.
+
+    The file is rewritten atomically on each event, e.g. for the textfile
+    collector of node_exporter; a ``{pid}`` in the path gives one file
+    per kernel.
+    """
+
+    metrics = (
+        ("fortranmagic_cache_lookups_total", "counter", "Cache lookups of %%fortran cells"),
+        ("fortranmagic_builds_total", "counter", "Builds of %%fortran modules"),
+        ("fortranmagic_build_seconds", "summary", "Build time of %%fortran modules"),
+        ("fortranmagic_load_seconds", "summary", "Load time of %%fortran modules"),
+        ("fortranmagic_written_bytes_total", "counter", "Bytes written to the cache by builds"),
+    )
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f"prometheus:{self.path}"
+
+    def _add(self, name, value=1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        self._values[key] = self._values.get(key, 0) + value
+
+    def __call__(self, record) -> None:
+        event = record["event"]
+        with self._lock:
+            if event in ("cache_hit", "cache_miss"):
+                self._add("fortranmagic_cache_lookups_total", result=event.removeprefix("cache_"))
+            elif event == "build_finished":
+                result = "success" if record["success"] else "failure"
+                self._add("fortranmagic_builds_total", result=result, reason=record["reason"] or "")
+                self._add("fortranmagic_build_seconds_sum", record["seconds"])
+                self._add("fortranmagic_build_seconds_count")
+                self._add("fortranmagic_written_bytes_total", record["bytes"])
+            elif event == "module_loaded":
+                self._add("fortranmagic_load_seconds_sum", record["seconds"])
+                self._add("fortranmagic_load_seconds_count")
+            else:
+                return
+            lines = []
+            for metric, kind, text in self.metrics:
+                lines += [f"# HELP {metric} {text}", f"# TYPE {metric} {kind}"]
+                for (name, labels), value in sorted(self._values.items()):
+                    if name == metric or name.removesuffix("_sum").removesuffix("_count") == metric:
+                        selector = ",".join(f'{k}="{v}"' for k, v in labels)
+                        lines.append(f"{name}{{{selector}}} {value:g}" if selector else f"{name} {value:g}")
+            path = self.path.replace("{pid}", str(os.getpid()))
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(tmp, path)
+
+
+_EXPORTERS = {"jsonl": _JSONLinesExporter, "prometheus": _PrometheusExporter}
+
+
+def _metrics_exporters(spec):
+    """Exporters of `FORTRANMAGIC_METRICS`, e.g. ``jsonl:/var/log/fm.jsonl,prometheus:/tmp/fm_{pid}.prom``."""
+
+    exporters = []
+    for item in filter(None, (i.strip() for i in spec.split(","))):
+        kind, _, path = item.partition(":")
+        if kind not in _EXPORTERS or not path:
+            print(
+                f"Warning: FORTRANMAGIC_METRICS: ignored {item!r}, expected jsonl:<path> or prometheus:<path>",
+                file=sys.stderr,
+            )
+            continue
+        exporters.append(_EXPORTERS[kind](os.path.expanduser(path)))
+    return exporters
+
+
+class _Manifest:
+    """Recently executed `%%fortran` cells of a session, preloaded on the next start."""
+
+    limit = 32
+
+    def __init__(self, path) -> None:
+        self.path = path
+
+    def entries(self):
+        """``[(line, cell), ...]``, most recent last."""
+
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return [tuple(e) for e in json.load(f)]
+        except (OSError, ValueError, TypeError):
+            return []
+
+    def add(self, line, cell) -> None:
+        """Record a cell, warning only if the manifest cannot be written."""
+
+        entries = [e for e in self.entries() if e != (line, cell)] + [(line, cell)]
+        tmp = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(entries[-self.limit :], f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"Warning: preload manifest not updated: {e}", file=sys.stderr)
+            with contextlib.suppress(OSError):
+                os.remove(tmp)
+
+
+_EXPORT_INIT = '''"""Fortran extension modules exported by fortranmagic {version}."""
+
+import importlib
+import importlib.machinery
+import importlib.util
+import types
+
+# module name -> options of its %%fortran cell
+_MODULES = {modules!r}
+
+
+class _KindDispatcher:
+    """Call the `--kinds` specialization matching the dtypes of the arguments."""
+
+    def __init__(self, name, variants, selectors, default):
+        self.__name__ = name
+        self._variants = variants
+        self._selectors = selectors
+        self._default = default
+        self.__doc__ = variants[default].__doc__
+
+    def __repr__(self):
+        return f"<--kinds dispatcher {{self.__name__}} of {{len(self._variants)}} specializations>"
+
+    def __call__(self, *args, **kwargs):
+        key = self._default
+        for i, candidates in self._selectors:
+            for position, name, dtypes in candidates:
+                x = args[position] if position < len(args) else kwargs.get(name)
+                value = dtypes.get(getattr(getattr(x, "dtype", None), "name", None))
+                if value is not None:
+                    key = (*key[:i], value, *key[i + 1 :])
+                    break
+        return self._variants[key](*args, **kwargs)
+
+
+def _variant(members, module_name, name, values):
+    tag = "_".join(values)
+    if module_name:
+        return getattr(members[f"{{module_name}}__{{tag}}"], name)
+    return members[f"{{name}}__{{tag}}"]
 
-    def composed(f):
-        for decor in reversed(decorators):
-            f = decor(f)
-        return f
 
-    return composed
+def _members(name, options):
+    module = importlib.import_module(__name__ + "." + name)
+    members = {{k: v for k, v in vars(module).items() if not k.startswith("__")}}
+    if options.get("ufunc"):
+        # The ufuncs of `--ufunc` are a second module of the same library
+        ufunc_name = f"{{__name__}}.{{name}}_ufunc"
+        loader = importlib.machinery.ExtensionFileLoader(ufunc_name, module.__spec__.origin)
+        ufuncs = importlib.util.module_from_spec(importlib.util.spec_from_loader(ufunc_name, loader))
+        loader.exec_module(ufuncs)
+        members.update({{k: v for k, v in vars(ufuncs).items() if not k.startswith("__")}})
+    # The dispatchers of `--kinds`: (Fortran module, procedure, kind combinations, selectors)
+    procedures = {{}}
+    for module_name, proc, combinations, selectors in options.get("kinds", ()):
+        variants = {{values: _variant(members, module_name, proc, values) for values in combinations}}
+        dispatcher = _KindDispatcher(proc, variants, selectors, combinations[-1])
+        if module_name:
+            procedures.setdefault(module_name, {{}})[proc] = dispatcher
+        else:
+            members[proc] = dispatcher
+    members.update({{m: types.SimpleNamespace(**p) for m, p in procedures.items()}})
+    return members
 
 
-def unquote(v):
-    if (v.startswith('"') and v.endswith('"')) or (v.startswith("'") and v.endswith("'")):
-        return v[1:-1]
-    return v
+for _name, _options in _MODULES.items():
+    globals().update(_members(_name, _options))
+del _name, _options
+'''
 
 
 @magics_class
@@ -106,6 +2824,119 @@ class FortranMagics(Magics):
             default=[],
             help="Additional string to hash of code, flags, etc.",
         ),
+        magic_arguments.argument(
+            "--timeout",
+            type=float,
+            help="""Abort the build after this number of seconds.
+                    The compiler processes are terminated and the
+                    partial build is removed. The wait for a build
+                    slot (at most FORTRANMAGIC_MAX_BUILDS builds run at
+                    once on the host, default: the CPU count) is not
+                    counted, it is bounded by FORTRANMAGIC_MAX_BUILD_WAIT
+                    (default: 600 s).""",
+        ),
+        magic_arguments.argument(
+            "--worker",
+            action="store_true",
+            help="""Load the module in a separate worker process, the
+                    injected names are proxies. See %%fortran_worker.""",
+        ),
+        magic_arguments.argument(
+            "--batch",
+            action="append",
+            default=[],
+            help="""Generate <name>_batch, calling the routine <name> in a
+                    native loop. Its arguments are stacked along an extra
+                    last axis (except the array bounds); a function
+                    returns the array of its results.""",
+        ),
+        magic_arguments.argument(
+            "--ufunc",
+            action="store_true",
+            help="""Inject the elemental and pure procedures with scalar
+                    numeric arguments as NumPy ufuncs (broadcasting,
+                    `out=`, strided loops). Module procedures are
+                    injected by name too.""",
+        ),
+        magic_arguments.argument(
+            "--remote-cache",
+            action="append",
+            default=[],
+            help="""Shared module cache: a directory (e.g. on a cluster
+                    file system) or an http(s):// URL accepting GET & PUT.
+                    Modules missing locally are fetched from it, new
+                    builds are stored to it. Builds for the host CPU
+                    (e.g. -march=native) are not shared. Save it with
+                    %%fortran_config.""",
+        ),
+        magic_arguments.argument(
+            "--compiler-launcher",
+            help="""Compiler cache prepended to the Fortran & C compilers,
+                    by default sccache or ccache if found (see %%f2py_help
+                    --toolchain), 'none' to disable. With -v the cache
+                    hits & misses of the build are shown.""",
+        ),
+        magic_arguments.argument(
+            "--kinds",
+            action="append",
+            default=[],
+            metavar="NAME=KINDS",
+            help="""Compile the cell for every kind of NAME, e.g.
+                    --kinds wp=4,8 for code using real(wp), without
+                    declaring wp. The procedures dispatch on the dtype
+                    of their NAME kind arguments, so no conversion copy
+                    is made; the specializations are also available as
+                    <procedure>__<kind>.""",
+        ),
+        magic_arguments.argument(
+            "--work",
+            action="append",
+            default=[],
+            metavar="DECLARATION",
+            help=f"""Persistent work array, e.g. --work 'real(8) :: w(:,:)',
+                    of the module `{_WORK_MODULE}` used by the cell. It
+                    is allocated (and zeroed) by <name>_alloc(n1, ...)
+                    only if its shape changes, freed by <name>_free(),
+                    and `{_WORK_MODULE}.<name>` is a NumPy view of it,
+                    invalid once freed or resized. See %%fortran_work.""",
+        ),
+        magic_arguments.argument(
+            "--memoize",
+            action="store_true",
+            help="""Cache the results of the pure and elemental procedures
+                    (without intent(inout) arguments), keyed by a digest
+                    of the contents, dtype and shape of their arguments.
+                    Module procedures are memoized when called by name.
+                    See %%fortran_memo.""",
+        ),
+        magic_arguments.argument(
+            "--autotune",
+            metavar="STATEMENT",
+            help="""Build the cell with the flag variants of optimization,
+                    vectorization, unrolling, native architecture and
+                    fast math, time the Python STATEMENT with each on
+                    copies of the arrays it names (checking its result
+                    and the arrays against the flags of the cell) and
+                    load the fastest. All the variants are cached and
+                    the ranking is printed.""",
+        ),
+        magic_arguments.argument(
+            "--backend",
+            choices=("auto", "meson", "bindc"),
+            default="auto",
+            help="""'meson': f2py wrappers built by meson. 'auto'
+                    (default): the compilers build the f2py wrappers
+                    directly, without meson, unless --link or --extra
+                    is given. 'bindc': compile
+                    only the Fortran to a shared library and call its
+                    bind(C) procedures through ctypes: much faster
+                    builds, but calls cost more than with f2py (about
+                    0.4 us plus 0.4 us per array argument, against
+                    0.1-0.2 us), so prefer f2py for routines called in
+                    tight Python loops. Arguments must have iso_c_binding
+                    or byte-sized kinds. --link and --extra flags are
+                    passed to the compiler.""",
+        ),
     )
 
     def _cache_init(self) -> None:
@@ -120,6 +2951,9 @@ class FortranMagics(Magics):
                 pass
         self.shell.db["fortranmagic_cache"] = cdir
         self._lib_dir = cdir
+        # Suffix of the modules rebuilt after `--clean-cache`, see `_stale`
+        self._generation = self.shell.db.get("fortranmagic_generation", -1) + 1
+        self.shell.db["fortranmagic_generation"] = self._generation
 
     def _cache_open(self) -> None:
         """Open cache directory on session start"""
@@ -132,6 +2966,7 @@ class FortranMagics(Magics):
             try:
                 if os.path.isdir(cdir):
                     self._lib_dir = cdir
+                    self._generation = self.shell.db.get("fortranmagic_generation", 0)
                     return
             except (TypeError, OSError):
                 pass
@@ -154,67 +2989,255 @@ class FortranMagics(Magics):
     def _cache_clean(self) -> None:
         shutil.rmtree(os.path.join(get_ipython_cache_dir(), "fortranmagic"), ignore_errors=True)
         self._cache_init()
+        # A library can't be loaded twice under one name: the modules
+        # loaded so far get the generation as suffix when rebuilt
+        self._stale = {m for m in sys.modules if m.startswith("_fortran_magic_")}
 
     def __init__(self, shell) -> None:
         super().__init__(shell=shell)
         self._reloads = {}
         self._code_cache = {}
+        self._stale = set()
+        self._worker = None
+        self._cache_stats = {"hits": 0, "builds": 0, "build_time": 0.0, "saved": 0.0}
+        # Imported objects: name -> (module name, object)
+        self._routines = {}
+        # `--work` arrays: module name -> (Fortran module, array names)
+        self._workspaces = {}
+        # Results of the `--memoize` procedures
+        memo = self.shell.db.get("fortranmagic_memo", {})
+        self._memo = _Memo(
+            memo.get("size", _MEMO_SIZE) * _MB,
+            memo.get("spill", 0) * _MB,
+            os.path.join(get_ipython_cache_dir(), "fortranmagic", "memo"),
+        )
+        # Background loads: module name -> Future, None if loaded in the foreground
+        self._preloads = {}
+        self._preload_lock = threading.Lock()
+        self._preload_thread = None
+        # Build & cache events, e.g. `magics.events.register("build_finished", callback)`
+        self.events = _Events()
+        for exporter in _metrics_exporters(os.environ.get("FORTRANMAGIC_METRICS", "")):
+            for event in _EVENTS:
+                self.events.register(event, exporter)
         self._cache_open()
 
-    def _import_all(self, module, verbosity=0, code="") -> None:
+    @property
+    def _manifest(self):
+        session = os.environ.get("JPY_SESSION_NAME") or self.shell.user_ns.get("__session__") or "default"
+        name = hashlib.md5(str(session).encode("utf-8")).hexdigest()
+        return _Manifest(os.path.join(get_ipython_cache_dir(), "fortranmagic", "manifests", name + ".json"))
+
+    def _preload(self) -> None:
+        """Load the cached modules of the manifest, in the background.
+
+        The module name of every entry is computed again, so only the
+        modules built for the current environment & configuration are
+        loaded; the others are left to the cell executions.
+        """
+        import concurrent.futures  # noqa: PLC0415
+
+        for line, cell in self._manifest.entries():
+            try:
+                built = self._fortran_build(line, cell, cached_only=True)
+            except Exception:  # noqa: BLE001
+                continue  # e.g. options of another fortranmagic version
+            if built is None or built[3].worker:
+                continue
+            module_name = built[0]
+            with self._preload_lock:
+                if module_name in self._preloads:
+                    continue
+                future = self._preloads[module_name] = concurrent.futures.Future()
+            try:
+                future.set_result(self._load(*built))
+            except Exception as e:  # noqa: BLE001
+                future.set_exception(e)
+
+    def _preload_start(self) -> None:
+        self._preload_thread = threading.Thread(target=self._preload, name="fortranmagic-preload", daemon=True)
+        self._preload_thread.start()
+
+    def _preloaded(self, module_name):
+        """Module loaded by `_preload`, waiting for it if in progress, or None."""
+
+        with self._preload_lock:
+            future = self._preloads.setdefault(module_name, None)
+        if future is None or future.exception() is not None:
+            return None
+        return future.result()
+
+    @property
+    def _index(self):
+        # The timing history is outside of the directory removed by `--clean-cache`
+        return _CacheIndex(
+            os.path.join(get_ipython_cache_dir(), "fortranmagic", "index.sqlite"),
+            os.path.join(get_ipython_cache_dir(), "fortranmagic-history.sqlite"),
+        )
+
+    def _cache_record(self, module_name, components, build_time=None) -> None:
+        """Update the cache index & the session statistics."""
+
+        stats = self._cache_stats
+        if build_time is None:
+            stats["hits"] += 1
+        else:
+            stats["builds"] += 1
+            stats["build_time"] += build_time
+        try:
+            stats["saved"] += self._index.record(module_name, self._lib_dir, components, build_time)
+        except Exception as e:  # noqa: BLE001
+            print(f"Warning: cache index not updated: {e}", file=sys.stderr)
+
+    def _import_all(self, module, verbosity=0, code="", module_name=None) -> None:
         imported = []
         for k, v in module.__dict__.items():
             if not k.startswith("__"):
-                v.__source__ = code
+                # ufuncs have no `__dict__`
+                with contextlib.suppress(AttributeError):
+                    v.__source__ = code
                 self.shell.push({k: v})
                 imported.append(k)
+                self._routines[k] = (module_name, v)
         if verbosity > 0 and imported:
             print("\nOk. The following fortran objects are ready to use: {}".format(", ".join(imported)))
 
-    def _run_f2py(self, argv, show_captured=False, verbosity=0, fflags=None):
+    def _run_f2py(  # noqa: PLR0913, PLR0917
+        self,
+        argv,
+        show_captured=False,
+        verbosity=0,
+        fflags=None,
+        log=None,
+        cwd=None,
+        timeout=None,
+        env=None,
+        deadline=None,
+    ):
         """
         Here we directly call the numpy.f2py module or the f2py executable.
+
+        The output is consumed while the build runs: it is written to
+        the `log` file, echoed at once with `show_captured` or `-vvv`,
+        and otherwise printed only if the build fails.
+
+        f2py runs in its own process group. On `timeout` or
+        `KeyboardInterrupt` the whole group (meson, ninja, compilers)
+        is terminated; a `deadline` (`time.monotonic()`) shared by several
+        build steps replaces the start of this one. `env` adds
+        environment variables.
         """
-        environ = None if fflags is None else os.environ.copy()
         if fflags is not None:
-            environ = os.environ.copy()
-            environ["FFLAGS"] = environ.get("FFLAGS", "") + " " + fflags
+            env = {**(env or {}), "FFLAGS": os.environ.get("FFLAGS", "") + " " + fflags}
+        command = [sys.executable, "-m", "numpy.f2py", *map(str, argv)]
+        return self._run_build(command, show_captured, verbosity, log, cwd, timeout, env, deadline=deadline)
+
+    def _run_direct(self, f2py_args, module_name, sources, skip, fflags, debug, toolchain, **kwargs):  # noqa: PLR0913, PLR0917
+        """Build the f2py extension `module_name` without meson.
+
+        f2py only generates the wrappers, then the compilers of the
+        toolchain build them, see `_direct_build`. `kwargs` are those of
+        `_run_build`; the build runs in ``kwargs["cwd"]``. Like the meson
+        build, only the f2py command is shown with `-vv`, the compiler
+        commands with `-vvv`. ``kwargs["timeout"]`` is the one of all
+        the steps.
+        """
+        stage = kwargs["cwd"]
+        if kwargs.get("timeout") is not None:
+            kwargs["deadline"] = time.monotonic() + kwargs["timeout"]
+        fsources = [s for s in sources if not s.endswith(".c")]
+        skip = ["skip:", *skip, ":"] if skip else []
+        # The wrappers & the object of their C depend on the interface
+        # of the cell only: they are cached under its key, as module
+        # `_fortran_magic_w<key>` whose init function is linked as the
+        # one of `module_name`.
+        key = _wrapper_key(fsources, f2py_args, skip, debug, toolchain)
+        wrapper = module_name if key is None else f"_fortran_magic_w{key}"
+        cached = key and os.path.join(get_ipython_cache_dir(), "fortranmagic", "wrappers", key)
+        files = [wrapper + s for s in ("module.c.o", *_F2PY_WRAPPERS)]
+        compiled = bool(cached) and os.path.isdir(cached)
+        if compiled:
+            for name in os.listdir(cached):
+                shutil.copy(os.path.join(cached, name), stage)
+            if kwargs.get("verbosity", 0) > 1:
+                print(f"Reusing the f2py wrappers of the same interface, {wrapper}")
         else:
-            environ = None
+            res = self._run_f2py([*f2py_args, "-m", wrapper, *fsources, *skip, "--build-dir", stage], **kwargs)
+            if res != 0:
+                return res
+        commands, fortranobject = _direct_build(
+            module_name, stage, sources, fflags, debug, kwargs["env"], toolchain, wrapper, compiled
+        )
+        if kwargs.get("verbosity", 0) <= _VERBOSITY_DEBUG:
+            kwargs["verbosity"] = 0
+        for command in commands:
+            res = self._run_build(command, **kwargs)
+            if res != 0:
+                return res
+        if fortranobject:
+            os.replace(os.path.join(stage, "fortranobject.o"), fortranobject)
+        if cached and not compiled:
+            _store_wrappers(cached, [os.path.join(stage, f) for f in files])
+        return res
 
-        command = [sys.executable, "-m", "numpy.f2py"]
-        command += map(str, argv)
+    def _run_build(  # noqa: PLR0913, PLR0917
+        self, command, show_captured=False, verbosity=0, log=None, cwd=None, timeout=None, env=None, deadline=None
+    ):
+        """Run a build `command`, see `_run_f2py`."""
 
+        environ = {**os.environ, **env} if env else None
         if verbosity > 1:
             print("Running...\n   {}".format(" ".join(command)))
 
-        p, out, err = None, None, None
         try:
-            with capture_output() as captured:
+            p = Popen(
+                command,
+                stdout=PIPE,
+                stderr=PIPE,
+                stdin=DEVNULL,
+                env=environ,
+                cwd=self._lib_dir if cwd is None else cwd,
+                **_NEW_PROCESS_GROUP,
+            )
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                print(f"Couldn't find program: {command[0]!r}")
+                return -1
+            raise
+
+        output = _BuildOutput(
+            log=log,
+            echo=show_captured or verbosity > _VERBOSITY_DEBUG,
+            live=getattr(self.shell, "kernel", None) is not None,
+        )
+        lines = queue.SimpleQueue()
+        for stream, pipe in (("out", p.stdout), ("err", p.stderr)):
+            threading.Thread(target=_read_lines, args=(pipe, stream, lines), daemon=True).start()
+        if deadline is None and timeout is not None:
+            deadline = time.monotonic() + timeout
+        try:
+            running = 2
+            while running:
                 try:
-                    p = Popen(
-                        command,
-                        stdout=PIPE,
-                        stderr=PIPE,
-                        stdin=PIPE,
-                        env=environ,
-                        cwd=self._lib_dir,
-                    )
-                except OSError as e:
-                    if e.errno == errno.ENOENT:
-                        print(f"Couldn't find program: {command[0]!r}")
-                        return -1
-                    raise
-                out, err = p.communicate(input=None)
+                    stream, line = lines.get(timeout=None if deadline is None else max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if line is None:
+                    running -= 1
+                else:
+                    output.feed(stream, line.decode(errors="replace"))
+            with contextlib.suppress(TimeoutExpired):
+                p.wait(timeout=None if deadline is None else max(deadline - time.monotonic(), 0))
+            if p.poll() is None:
+                print(f"f2py: build timed out after {timeout:g} s", file=sys.stderr, flush=True)
+                _terminate(p)
+        except BaseException:
+            _terminate(p)
+            raise
         finally:
-            if show_captured or verbosity > _VERBOSITY_DEBUG or p is None or p.returncode:
-                if err:
-                    sys.stderr.write(err.decode())
-                    sys.stderr.flush()
-                if out:
-                    sys.stdout.write(out.decode())
-                    sys.stdout.flush()
-                captured()
+            output.close(p.returncode == 0)
+        if p.returncode and not output.echo:
+            output.replay()
 
         return p.returncode
 
@@ -222,7 +3245,7 @@ class FortranMagics(Magics):
     @magic_arguments.argument(
         "--resources",
         action="store_true",
-        help="""List system resources found by system_info.py.
+        help="""List system resources found by pkg-config.
 
                 See also
                 %%f2py_help --link <resource> switch.
@@ -237,13 +3260,36 @@ class FortranMagics(Magics):
                 %%f2py_help --link <resource> switch.
                 """,
     )
+    @magic_arguments.argument(
+        "--toolchain",
+        action="store_true",
+        help="Show the discovered Fortran & C compilers and pkg-config.",
+    )
+    @magic_arguments.argument(
+        "--refresh",
+        action="store_true",
+        help="""Probe compilers and resources again. The discovery is
+                otherwise done once per environment (PATH, FC, CC, ...).""",
+    )
     @line_magic
     def f2py_help(self, line) -> None:
         args = magic_arguments.parse_argstring(self.f2py_help, line)
+        toolchain = _toolchain(refresh=args.refresh)
         if args.resources:
-            self._run_f2py(["--help-link"], True)
+            print("Resources for --link (pkg-config):")
+            for name in toolchain["packages"]:
+                print("  ", name)
         elif args.link:
-            self._run_f2py(["--help-link", args.link], True)
+            resource = _toolchain_resource(unquote(args.link))
+            if resource["found"]:
+                print(f"{args.link}: version {resource['version']}")
+                print(f"  cflags: {resource['cflags']}")
+                print(f"  libs:   {resource['libs']}")
+            else:
+                print(f"{args.link}: not found by pkg-config")
+        if args.toolchain or args.refresh:
+            for tool, _, _ in _TOOLS:
+                print(f"{tool}: {toolchain[tool]['path']}\n    {toolchain[tool]['version']}")
 
     @my_magic_arguments
     @magic_arguments.argument(
@@ -296,30 +3342,257 @@ class FortranMagics(Magics):
             self.shell.db["fortranmagic"] = line
             print(f"New default arguments for %fortran:\n\t{line}")
 
-    @my_magic_arguments
-    @cell_magic
-    def fortran(self, line, cell) -> None:
-        """Compile and import everything from a Fortran code cell, using f2py.
+    @magic_arguments.magic_arguments()
+    @magic_arguments.argument("--query", help="Only the entries with this text in their module name, line or code")
+    @magic_arguments.argument("--pin", help="Keep the module (name or hash prefix) when purging")
+    @magic_arguments.argument("--unpin", help="Undo --pin")
+    @magic_arguments.argument("--purge", action="store_true", help="Remove the unpinned entries")
+    @magic_arguments.argument("--older-than", type=float, help="Purge only the entries unused for this number of days")
+    @magic_arguments.argument("--stats", action="store_true", help="Show the cache statistics of this session")
+    @magic_arguments.argument(
+        "--preload",
+        choices=("on", "off"),
+        help="Load the cached modules of the recent cells in the background when the extension is loaded",
+    )
+    @line_magic
+    def fortran_cache(self, line) -> None:
+        """
+        Inspect the index of the %%fortran build cache.
 
-        The content of the cell is written to a `.f90` file in the
-        directory `IPYTHONDIR/fortran` using a filename with the hash of
-        the code, flags and configuration data. This file is then
-        compiled. The resulting module is imported and all of its
-        symbols are injected into the user's namespace.
+            %fortran_cache
 
+                List the cached modules: size, build time, hits, last
+                use and %%%%fortran line, most recently used first
 
-        Usage
-        =====
-        Prepend ``%%fortran`` to your fortran code in a cell::
+            %fortran_cache --query <text>
 
-        ``%%fortran
+                List the modules with <text> in their name, line or code
 
-        ! put your code here.
-        ``
+            %fortran_cache --pin <module>
+
+                Keep <module> on --purge, e.g. %fortran_cache --pin 3f2a9c
+
+            %fortran_cache --purge [--query <text>] [--older-than <days>]
+
+                Remove the unpinned modules & their sources
+
+            %fortran_cache --stats
+
+                Hit ratio & compile time saved in this session
+
+            %fortran_cache --preload on
+
+                Record the executed cells (per notebook) and, when the
+                extension is loaded after a restart, load their cached
+                modules in a background thread: executing the cells
+                again then takes no build nor load time
+        """
+
+        args = magic_arguments.parse_argstring(self.fortran_cache, line)
+        if args.preload:
+            self.shell.db["fortranmagic_preload"] = args.preload == "on"
+            if args.preload == "on":
+                manifest = self._manifest
+                for key in self._code_cache:
+                    manifest.add(key[1], key[0])
+            print(f"Preload of the recent %%fortran modules: {args.preload}")
+            return
+        index = self._index
+        if args.pin or args.unpin:
+            name = unquote(args.pin or args.unpin)
+            if not name.startswith("_fortran_magic_"):
+                name = "_fortran_magic_" + name
+            modules = index.pin(name, pinned=bool(args.pin))
+            if not modules:
+                raise UsageError(f"No cached module {name!r}")
+            print(f"{'Pinned' if args.pin else 'Unpinned'}:", ", ".join(modules))
+            return
+        if args.stats:
+            stats = self._cache_stats
+            lookups = stats["hits"] + stats["builds"]
+            ratio = stats["hits"] / lookups if lookups else 0.0
+            print(
+                f"Session: {stats['hits']} hit(s) in {lookups} lookup(s) ({ratio:.0%}), "
+                f"{stats['builds']} build(s) in {stats['build_time']:.1f} s, "
+                f"compile time saved: {stats['saved']:.1f} s"
+            )
+            return
+
+        rows = index.entries(unquote(args.query) if args.query else None)
+        if args.purge:
+            rows = [r for r in rows if not r["pinned"]]
+            if args.older_than is not None:
+                rows = [r for r in rows if time.time() - r["last_used"] > args.older_than * 86400]
+            index.purge(rows)
+            print(f"Purged {len(rows)} module(s), {_size_text(sum(r['size'] or 0 for r in rows))}")
+            return
+        if not rows:
+            print("No cached modules")
+            return
+        print(f"{'module':<10}  {'size':>8}  {'build':>7}  {'hits':>5}  {'last used':<16}  pin  line")
+        for r in rows:
+            build = f"{r['build_time']:.1f} s" if r["build_time"] is not None else "-"
+            used = time.strftime("%Y-%m-%d %H:%M", time.localtime(r["last_used"]))
+            print(
+                f"{r['module'].removeprefix('_fortran_magic_')[:10]:<10}  {_size_text(r['size'] or 0):>8}  "
+                f"{build:>7}  {r['hits']:>5}  {used:<16}  {'*' if r['pinned'] else ' ':^3}  {r['line']}"
+            )
+        print(f"{len(rows)} module(s), {_size_text(sum(r['size'] or 0 for r in rows))}")
+
+    @magic_arguments.magic_arguments()
+    @magic_arguments.argument(
+        "--routine",
+        action="append",
+        default=[],
+        help="Record the timing for this %%%%fortran object, by default those of the statement",
+    )
+    @magic_arguments.argument("-r", "--repeat", type=int, default=7, help="Number of timing runs")
+    @magic_arguments.argument(
+        "--history", action="store_true", help="Compare the builds of the routines instead of timing"
+    )
+    @magic_arguments.argument(
+        "--threshold", type=float, default=0.05, help="Relative slowdown reported as a regression"
+    )
+    @magic_arguments.argument("statement", nargs=argparse.REMAINDER, help="Python statement to time")
+    @line_magic
+    def fortran_bench(self, line) -> None:
+        """
+        Time %%%%fortran routines and track their speed across builds.
+
+            %fortran_bench total(x)
+
+                Time the statement like %timeit and record the samples
+                with the build of `total` in the cache index, then
+                report if it is significantly slower than earlier
+                builds (changed code, flags or compilers)
+
+            %fortran_bench --history [--routine total]
 
+                Compare the most recent build of every timed routine
+                with its earlier builds, statement by statement
 
+        A regression is a median slowdown above --threshold which a
+        one-sided Mann-Whitney test finds significant (p < 0.05). The
+        history is kept across sessions, cache purges and --clean-cache.
         """
 
+        args = magic_arguments.parse_argstring(self.fortran_bench, line)
+        statement = " ".join(args.statement).strip()
+        if args.history:
+            rows = [r for routine in args.routine or [None] for r in self._index.timings(routine)]
+            if statement:
+                rows = [r for r in rows if r["statement"] == statement]
+            lines, _ = _bench_report(rows, args.threshold)
+            print("\n".join(lines) if lines else "No timings recorded")
+            return
+        if not statement:
+            raise UsageError("%fortran_bench: no statement to time")
+
+        import timeit  # noqa: PLC0415
+
+        ns = self.shell.user_ns
+        names = args.routine or compile(statement, "<fortran_bench>", "exec").co_names
+        routines = {}
+        for name in names:
+            module_name, obj = self._routines.get(name, (None, None))
+            if module_name and ns.get(name) is obj:
+                routines[name] = module_name
+            elif args.routine:
+                raise UsageError(f"--routine {name}: not a %%fortran object of this session")
+        if not routines:
+            raise UsageError("%fortran_bench: the statement calls no %%fortran object, see --routine")
+
+        timer = timeit.Timer(statement, globals=ns)
+        number = timer.autorange()[0]
+        samples = [t / number for t in timer.repeat(args.repeat, number)]
+        print(
+            f"{_time_text(min(samples))} per loop (best of {args.repeat} runs, "
+            f"{number} loop{'s' if number > 1 else ''} each)"
+        )
+        index = self._index
+        for name, module_name in routines.items():
+            index.record_timing(name, module_name, statement, samples)
+        rows = [r for name in routines for r in index.timings(name) if r["statement"] == statement]
+        _, regressions = _bench_report(rows, args.threshold)
+        for routine, _, module in regressions:
+            print(
+                f"Warning: {routine} is significantly slower than with build "
+                f"{module.removeprefix('_fortran_magic_')[:10]}, see %fortran_bench --history",
+                file=sys.stderr,
+            )
+
+    @magic_arguments.magic_arguments()
+    @magic_arguments.argument("--free", action="store_true", help="Free all the work arrays")
+    @line_magic
+    def fortran_work(self, line) -> None:
+        """
+        Show the memory used by the `%%%%fortran --work` arrays.
+
+        Each array is listed with the build of its cell, its dtype and
+        shape, or `free` if not allocated. With --free, all the arrays
+        are deallocated first: the NumPy views of them are then invalid.
+        """
+
+        args = magic_arguments.parse_argstring(self.fortran_work, line)
+        if args.free:
+            for module, names in self._workspaces.values():
+                for name in names:
+                    getattr(module, f"{name}_free")()
+        print("\n".join(_work_report(self._workspaces)))
+
+    @magic_arguments.magic_arguments()
+    @magic_arguments.argument("--size", type=float, help="Memory limit of the results, MB (default: 256)")
+    @magic_arguments.argument("--spill", type=float, help="Disk limit of the results evicted from memory, MB")
+    @magic_arguments.argument("--clear", action="store_true", help="Forget the results, in memory and on disk")
+    @line_magic
+    def fortran_memo(self, line) -> None:
+        """
+        Results of the `%%%%fortran --memoize` procedures.
+
+            %fortran_memo
+
+                Hits in memory and on disk, misses and computing time
+                saved of each procedure, memory & disk use
+
+            %fortran_memo --size 1024 --spill 10000
+
+                Keep up to 1 GB of results in memory, the least recently
+                used are then written to disk, up to 10 GB. The results
+                on disk are kept across sessions. The limits are saved
+
+            %fortran_memo --clear
+
+                Forget all the results
+        """
+
+        args = magic_arguments.parse_argstring(self.fortran_memo, line)
+        memo = self._memo
+        if args.size is not None or args.spill is not None:
+            settings = dict(self.shell.db.get("fortranmagic_memo", {}))
+            if args.size is not None:
+                settings["size"] = args.size
+                memo.limit = args.size * _MB
+            if args.spill is not None:
+                settings["spill"] = args.spill
+                memo.spill = args.spill * _MB
+            self.shell.db["fortranmagic_memo"] = settings
+        if args.clear:
+            memo.clear()
+        if memo.stats:
+            print(f"{'procedure':<24}  {'hits':>6}  {'disk':>6}  {'misses':>6}  {'saved':>9}")
+        for name, stats in sorted(memo.stats.items()):
+            print(
+                f"{name:<24}  {stats['hits']:>6}  {stats['disk']:>6}  {stats['misses']:>6}  "
+                f"{_time_text(stats['saved']):>9}"
+            )
+        print(
+            f"{len(memo._entries)} result(s) in memory, {_size_text(memo.size)} of {_size_text(memo.limit)}; "
+            f"on disk: {_size_text(memo.disk_size())} of {_size_text(memo.spill)}"
+        )
+
+    def _parse_fortran_line(self, line):
+        """Parse a `%%fortran` line merged with the saved `%fortran_config`."""
+
         # verbosity is a "count" argument were each ocurrence is
         # added implicit.
         # so, for instance, -vv in %fortran_config and -vvv in %%fortran means
@@ -333,11 +3606,17 @@ class FortranMagics(Magics):
             args = magic_arguments.parse_argstring(self.fortran, f_config + " " + line)
             if sverbosity > 0:
                 args.verbosity = sverbosity
+        return args, f_config
+
+    def _f2py_args(self, args):
+        """Translate the parsed magic arguments to f2py command line arguments."""
+
+        options = {k: v for k, v in vars(args).items() if k not in _MAGIC_OPTIONS}
 
         # boolean flags
-        f2py_args = [f"--{k}" for k, v in vars(args).items() if v is True]
+        f2py_args = [f"--{k}" for k, v in options.items() if v is True]
 
-        kw = [f"--{k}={v}" for k, v in vars(args).items() if isinstance(v, str) and k not in ("f77flags", "f90flags")]
+        kw = [f"--{k}={v}" for k, v in options.items() if isinstance(v, str)]
 
         f2py_args.extend(kw)
 
@@ -353,28 +3632,78 @@ class FortranMagics(Magics):
             extras = " ".join(map(unquote, args.extra))
             extras = extras.split()
             f2py_args.extend(extras)
+        return f2py_args
+
+    def _fortran_build(self, line, cell, cached_only=False, priority="interactive"):
+        """Build the extension module of a `%%fortran` cell.
+
+        Return ``(module_name, module_path, code, args)``. The module is
+        compiled only if it is neither loaded nor present in the cache
+        directory. With `cached_only`, return None instead of building,
+        leaving the cache directory & index untouched. The build waits
+        for a slot of the host with `priority`, see `_BuildSlots`.
+        """
+
+        args, f_config = self._parse_fortran_line(line)
+        f2py_args = self._f2py_args(args)
 
         code = cell if cell.endswith("\n") else cell + "\n"
-        self._cache_check()
+        if not cached_only:
+            self._cache_check()
+        toolchain = _toolchain()
+        # No `--remote-cache` for builds tuned to the CPU of the host
+        native = bool(_NATIVE_RE.search(f"{line} {f_config}"))
         key = (
             code,
             line,
             f_config,
-            self._lib_dir,
+            sysconfig.get_platform(),
+            _cpu_model() if native else None,
             sys.version_info,
             sys.executable,
-            f2py2e.f2py_version,
+            _f2py_version(),
+            toolchain["fc"]["version"],
+            toolchain["cc"]["version"],
+            *(_toolchain_resource(r).get("version") for r in args.link),
         )
 
         module_name = "_fortran_magic_" + hashlib.md5(str(key).encode("utf-8")).hexdigest()
+        if module_name in self._stale:
+            module_name += f"_{self._generation}"
+        module_path = os.path.join(self._lib_dir, module_name + self.so_ext)
+        if args.backend == "bindc":
+            if args.batch or args.ufunc or args.worker:
+                raise UsageError("--backend bindc: --batch, --ufunc and --worker need f2py wrappers")
+            if not _bind_names(code):
+                raise UsageError("--backend bindc: no bind(C) procedure")
+            module_path = os.path.join(self._lib_dir, module_name + _SHLIB_SUFFIX)
+        if args.work and (args.worker or args.backend == "bindc"):
+            raise UsageError("--work: not supported with --worker and --backend bindc")
+        _parse_work(args.work)
+        kinds = _parse_kinds(args.kinds)
+        if kinds and (args.batch or args.ufunc or args.backend == "bindc"):
+            raise UsageError("--kinds: not supported with --batch, --ufunc and --backend bindc")
+        if cached_only:
+            return (module_name, module_path, code, args) if os.path.isfile(module_path) else None
 
-        if module_name in sys.modules:
-            module = sys.modules[module_name]
-            print("The extension", module_name, "is already loaded. To reload it, use:")
-            print("  %fortran_config --clean-cache")
+        components = (
+            line,
+            f_config,
+            sys.version.split()[0],
+            _f2py_version(),
+            toolchain["fc"]["version"],
+            toolchain["cc"]["version"],
+            json.dumps({r: _toolchain_resource(r).get("version") for r in args.link}),
+            code,
+        )
+        stores = [] if native else [_cache_store(unquote(url)) for url in args.remote_cache]
+        local = module_name in sys.modules or os.path.isfile(module_path)
+        if local or _cache_fetch(stores, module_path):
+            self.events.trigger("cache_hit", module=module_name, source="local" if local else "remote")
+            self._cache_record(module_name, components)
         else:
-            module_path = os.path.join(self._lib_dir, module_name + self.so_ext)
-
+            self.events.trigger("cache_miss", module=module_name)
+            start = time.perf_counter()
             fsuffix = ".f90"
 
             # `--f77flags` & `--f90flags`. Use `FFLAGS` workaround, see
@@ -400,21 +3729,432 @@ class FortranMagics(Magics):
             if fflags and fflags[-1] == " ":
                 fflags = fflags[:-1]
 
-            f_f90_file = os.path.join(self._lib_dir, module_name + fsuffix)
-            with open(f_f90_file, "w", encoding="utf-8") as f:
-                f.write(code)
+            generated, skip = {}, []
+            if args.batch or args.ufunc:
+                blocks = _crack(code, fsuffix)
+            if args.batch:
+                generated["_batch.f90"] = "\n".join(_batch_driver(blocks, name) for name in args.batch)
+            if args.ufunc:
+                # `bind(C)` wrappers called by the loops of a second
+                # extension module in the same library
+                generated["_ufunc.f90"], generated["_ufunc.c"], skip = _ufunc_sources(blocks, module_name)
+
+            texts = {fsuffix: _kind_variants(code, kinds, fsuffix) if kinds else code, **generated}
+            if args.work:
+                # Compiled first, the cell uses it
+                texts = {"_work.f90": _work_module(_parse_work(args.work)), **texts}
+            sources = [os.path.join(self._lib_dir, module_name + s) for s in texts]
+            slots = _BuildSlots.host()
+            slot = contextlib.ExitStack()
+            res = stage = backend = failure = None
+            try:
+                # Nothing is written before a slot is free: an interrupted
+                # wait leaves no sources behind
+                queued = slot.enter_context(slots.acquire(priority))
+                if queued >= _QUEUED_REPORT:
+                    print(f"Waited {queued:.1f} s for a build slot ({slots.limit} builds at once on this host)")
+                texts = texts.values()
+                for source, text in zip(sources, texts, strict=True):
+                    with open(source, "w", encoding="utf-8") as f:
+                        f.write(text)
 
-            res = self._run_f2py(
-                [*f2py_args, "--backend", "meson", "-m", module_name, "-c", f_f90_file],
-                verbosity=args.verbosity,
-                fflags=fflags,
+                # Build in a staging directory, only a complete module is
+                # moved to the cache directory.
+                stage = os.path.join(self._lib_dir, module_name + ".build")
+                shutil.rmtree(stage, ignore_errors=True)
+                os.makedirs(stage)
+                # The build steps append to the log of the module
+                log = os.path.join(self._lib_dir, module_name + ".log")
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(log)
+                launcher = unquote(args.compiler_launcher or "") or toolchain.get("launcher", {}).get("path")
+                if launcher == "none":
+                    launcher = None
+                stats = launcher and _launcher_stats(launcher)
+                env = _compiler_environ(toolchain, launcher, stage)
+                direct = (
+                    args.backend == "auto"
+                    and not (args.link or args.extra)
+                    and os.name != "nt"
+                    and _tool_command(env, toolchain, "fc")
+                    and _tool_command(env, toolchain, "cc")
+                )
+                backend = "direct" if direct else "meson" if args.backend == "auto" else args.backend
+                self.events.trigger("build_started", module=module_name, backend=backend, queued=queued)
+                if args.backend == "bindc":
+                    res = self._run_build(
+                        _bindc_command(args, env, toolchain, fflags, sources, os.path.basename(module_path)),
+                        verbosity=args.verbosity,
+                        log=log,
+                        cwd=stage,
+                        timeout=args.timeout,
+                        env=env,
+                    )
+                elif direct:
+                    res = self._run_direct(
+                        [arg for arg in f2py_args if arg != "--debug"],
+                        module_name,
+                        sources,
+                        skip,
+                        fflags,
+                        args.debug,
+                        toolchain,
+                        verbosity=args.verbosity,
+                        log=log,
+                        cwd=stage,
+                        timeout=args.timeout,
+                        env=env,
+                    )
+                else:
+                    res = self._run_f2py(
+                        [
+                            *f2py_args,
+                            "--backend",
+                            "meson",
+                            "--build-dir",
+                            os.path.join(stage, "bbdir"),
+                            "-m",
+                            module_name,
+                            "-c",
+                            *sources,
+                            *(["skip:", *skip, ":"] if skip else []),
+                        ],
+                        verbosity=args.verbosity,
+                        fflags=fflags,
+                        log=log,
+                        cwd=stage,
+                        timeout=args.timeout,
+                        # Spare meson the compiler search
+                        env=env,
+                    )
+                if res == 0:
+                    os.replace(os.path.join(stage, os.path.basename(module_path)), module_path)
+            except BaseException as e:
+                failure = e
+                raise
+            finally:
+                slot.close()
+                if stage is not None:
+                    shutil.rmtree(stage, ignore_errors=True)
+                if res != 0:
+                    for source in sources:
+                        with contextlib.suppress(FileNotFoundError):
+                            os.remove(source)
+                if failure is not None:
+                    # e.g. KeyboardInterrupt, OSError: the build is finished too
+                    interrupted = isinstance(failure, KeyboardInterrupt)
+                    self.events.trigger(
+                        "build_finished",
+                        module=module_name,
+                        backend=backend,
+                        success=False,
+                        reason="interrupted" if interrupted else "error",
+                        error=None if interrupted else f"{type(failure).__name__}: {failure}",
+                        seconds=time.perf_counter() - start,
+                        bytes=0,
+                    )
+            if stats and args.verbosity > 0:
+                after = _launcher_stats(launcher)
+                if after:
+                    hits, misses = after[0] - stats[0], after[1] - stats[1]
+                    print(f"{os.path.basename(launcher)}: {hits} hit(s), {misses} miss(es)")
+            seconds = time.perf_counter() - start
+            reason = None
+            if res != 0:
+                reason = _failure_reason(log, args.timeout is not None and seconds >= args.timeout)
+            self.events.trigger(
+                "build_finished",
+                module=module_name,
+                backend=backend,
+                success=res == 0,
+                reason=reason,
+                error=_first_error(log) if res != 0 else None,
+                seconds=seconds,
+                bytes=_CacheIndex._size(self._lib_dir, module_name) if res == 0 else 0,
             )
             if res != 0:
-                raise RuntimeError("f2py failed, see output")
+                raise RuntimeError(f"{'compilation' if args.backend == 'bindc' else 'f2py'} failed, see output")
+            self._cache_record(module_name, components, seconds)
+            _cache_push(stores, module_path)
+
+        self._code_cache[key] = module_name
+        return module_name, module_path, code, args
+
+    @my_magic_arguments
+    @cell_magic
+    def fortran(self, line, cell) -> None:
+        """Compile and import everything from a Fortran code cell, using f2py.
+
+        The content of the cell is written to a `.f90` file in the
+        directory `IPYTHONDIR/fortran` using a filename with the hash of
+        the code, flags and configuration data. This file is then
+        compiled. The resulting module is imported and all of its
+        symbols are injected into the user's namespace.
+
 
-            self._code_cache[key] = module_name
+        Usage
+        =====
+        Prepend ``%%fortran`` to your fortran code in a cell::
+
+        ``%%fortran
+
+        ! put your code here.
+        ``
+
+
+        """
+
+        args, _ = self._parse_fortran_line(line)
+        if args.autotune:
+            self._autotune(line, cell, args)
+            return
+        module_name, module_path, code, args = self._fortran_build(line, cell)
+        start = time.perf_counter()
+        module = self._preloaded(module_name)
+        preloaded = module is not None
+        if not preloaded:
+            module = self._load(module_name, module_path, code, args)
+        self.events.trigger(
+            "module_loaded", module=module_name, seconds=time.perf_counter() - start, preloaded=preloaded
+        )
+        self._import_all(module, verbosity=args.verbosity, code=code, module_name=module_name)
+        if args.work:
+            names = [name for _, name, _ in _parse_work(args.work)]
+            self._workspaces[module_name] = (getattr(module, _WORK_MODULE), names)
+        if self.shell.db.get("fortranmagic_preload") and not args.worker:
+            self._manifest.add(line, code)
+
+    def _load(self, module_name, module_path, code, args):
+        """Load a module built by `_fortran_build`."""
+
+        fsuffix = ".f" if "-ffixed-form" in f"{args.f77flags} {args.f90flags}" else ".f90"
+
+        if args.worker:
+            if self._worker is None:
+                self._worker = _Worker()
+            module = types.SimpleNamespace(**dict(self._worker.load(module_name, module_path)))
+        elif module_name in sys.modules:
+            module = sys.modules[module_name]
+            print("The extension", module_name, "is already loaded. To reload it, use:")
+            print("  %fortran_config --clean-cache")
+        elif args.backend == "bindc":
+            module = _bindc_module(code, module_path, fsuffix)
+        else:
             module = _imp_load_dynamic(module_name, module_path)
-        self._import_all(module, verbosity=args.verbosity, code=code)
+        if args.ufunc and not args.worker:
+            # Same library, other init function: `PyInit_<module_name>_ufunc`
+            ufunc_name = module_name + "_ufunc"
+            ufuncs = sys.modules.get(ufunc_name) or _imp_load_dynamic(ufunc_name, module_path)
+            module = types.SimpleNamespace(
+                **{k: v for k, v in {**vars(module), **vars(ufuncs)}.items() if k[:2] != "__"}
+            )
+        if args.kinds:
+            module = _kind_dispatch(module, code, _parse_kinds(args.kinds), fsuffix)
+        if args.memoize:
+            memoized = _memoize(module, code, module_name, self._memo, fsuffix)
+            if memoized is None:
+                print("Warning: --memoize: no pure procedure without intent(inout) arguments", file=sys.stderr)
+            module = memoized or module
+        return module
+
+    def _autotune(self, line, cell, args) -> None:
+        """Load the variant of `_AUTOTUNE_FLAGS` running `args.autotune` fastest.
+
+        The variants are built one after the other (`_fortran_build` is
+        not thread safe) & timed in the user namespace. The NumPy
+        arrays the statement names are replaced by copies, so the
+        routines modifying them in place don't change the user's: the
+        value of the statement & the copies after a run must agree with
+        those of the cell's own flags, without them no variant is loaded.
+        """
+        import timeit  # noqa: PLC0415
+
+        import numpy as np  # noqa: PLC0415
+
+        stmt = unquote(args.autotune)
+        try:
+            compiled = compile(stmt, "<autotune>", "eval")
+        except SyntaxError:
+            compiled = compile(stmt, "<autotune>", "exec")
+        inputs = {n: v for n in compiled.co_names if isinstance(v := self.shell.user_ns.get(n), np.ndarray)}
+        option = "f77flags" if args.f77flags is not None else "f90flags"
+        base = unquote(getattr(args, option) or "")
+        variants = [base, *(f"{base} {flags}".strip() for flags in _AUTOTUNE_FLAGS)]
+        line = _strip_option(line, "--autotune")
+
+        cached = dict(self._code_cache)
+        timings, failures, reference, best = [], [], None, None
+        for flags in variants:
+            if flags != base and reference is None:
+                # Not built: nothing to check it against
+                failures.append((flags, "unchecked, the cell's own flags failed"))
+                continue
+            try:
+                module_name, module_path, code, vargs = self._fortran_build(
+                    f"{line} --{option} '{flags}'", cell, priority="bulk"
+                )
+                module = self._load(module_name, module_path, code, vargs)
+            except (RuntimeError, UsageError, ImportError) as e:
+                failures.append((flags, f"build failed: {e}"))
+                continue
+            namespace = {**self.shell.user_ns, **{k: v for k, v in vars(module).items() if k[:2] != "__"}}
+            try:
+                copies = {n: a.copy(order="K") for n, a in inputs.items()}
+                outcome = (eval(compiled, {**namespace, **copies}), [copies[n] for n in sorted(copies)])
+                if flags == base:
+                    reference = outcome
+                elif not _same_result(outcome, reference):
+                    failures.append((flags, "wrong result"))
+                    continue
+                namespace.update({n: a.copy(order="K") for n, a in inputs.items()})
+                timer = timeit.Timer(stmt, globals=namespace)
+                number = timer.autorange()[0]
+                seconds = min(timer.repeat(_AUTOTUNE_REPEAT, number)) / number
+            except Exception as e:  # noqa: BLE001
+                failures.append((flags, f"{type(e).__name__}: {e}"))
+                continue
+            timings.append((seconds, flags))
+            if best is None or seconds < best[0]:
+                best = (seconds, module, code, module_name, f"{line} --{option} '{flags}'")
+        # Only the loaded variant is a module of the session, e.g. for
+        # `%fortran_export` & `%fortran_cache --preload`
+        self._code_cache = {k: v for k, v in self._code_cache.items() if k in cached or (best and v == best[3])}
+        timings.sort()
+        print(f"autotune: {stmt}")
+        for rank, (seconds, flags) in enumerate(timings, 1):
+            print(f"{rank:4d}. {_time_text(seconds):>9}  {flags or '(no flags)'}")
+        for flags, reason in failures:
+            print(f"    - {reason:>9}  {flags or '(no flags)'}")
+        if best is None:
+            raise RuntimeError("--autotune: no variant could be built, checked and timed, see output")
+        print("Loaded the fastest variant. To use its flags for every cell:")
+        print(f"  %fortran_config --{option} '{timings[0][1]}'")
+        self._import_all(best[1], verbosity=args.verbosity, code=best[2], module_name=best[3])
+        if self.shell.db.get("fortranmagic_preload") and not args.worker:
+            self._manifest.add(best[4], best[2])
+
+    @magic_arguments.magic_arguments()
+    @magic_arguments.argument(
+        "--notebook",
+        help="""Build and export the %%%%fortran cells of this notebook
+                instead of the modules built in the current session.""",
+    )
+    @magic_arguments.argument("--name", default="fortran_cells", help="Name of the exported package")
+    @magic_arguments.argument("--output", default=".", help="Output directory")
+    @magic_arguments.argument("--wheel", action="store_true", help="Build an installable wheel")
+    @magic_arguments.argument("--version", default="0.0.0", help="Version of the wheel")
+    @line_magic
+    def fortran_export(self, line) -> None:
+        """
+        Export prebuilt %%fortran modules as a Python package.
+
+            %fortran_export --name mypkg
+
+                Copy the extension modules built in this session to
+                the package directory `./mypkg`
+
+            %fortran_export --notebook analysis.ipynb --name mypkg --wheel
+
+                Build every %%fortran cell of the notebook (reusing
+                the cache) and write `mypkg-0.0.0-<tag>.whl`
+
+        All the Fortran objects are importable from the package, e.g.
+        ``from mypkg import f1``, with the ufuncs of --ufunc and the
+        dispatchers of --kinds. The exported modules are exactly the
+        cached ones, so nothing is compiled at import time. Cells built
+        with --backend bindc can't be exported.
+        """
+
+        args = magic_arguments.parse_argstring(self.fortran_export, line)
+        name = unquote(args.name)
+        if not name.isidentifier():
+            raise UsageError(f"Invalid package name: {name!r}")
+
+        # module name -> (path, code, parsed %%fortran arguments)
+        modules = {}
+        if args.notebook:
+            for cline, cell in _notebook_fortran_cells(unquote(args.notebook)):
+                module_name, module_path, code, fargs = self._fortran_build(cline, cell, priority="bulk")
+                modules[module_name] = (module_path, code, fargs)
+        else:
+            for key, module_name in self._code_cache.items():
+                fargs = magic_arguments.parse_argstring(self.fortran, f"{key[2]} {key[1]}")
+                modules[module_name] = (os.path.join(self._lib_dir, module_name + self.so_ext), key[0], fargs)
+        bindc = [m for m, (_, _, fargs) in modules.items() if fargs.backend == "bindc"]
+        if bindc:
+            raise UsageError(
+                f"--backend bindc modules are not extension modules and can't be exported: {', '.join(bindc)}"
+            )
+        modules = {m: v for m, v in modules.items() if os.path.isfile(v[0])}
+        if not modules:
+            raise UsageError("No %%fortran modules to export")
+
+        files = {}
+        options = {}
+        for module_name, (module_path, code, fargs) in modules.items():
+            options[module_name] = {"ufunc": fargs.ufunc}
+            if fargs.kinds:
+                fsuffix = ".f" if "-ffixed-form" in f"{fargs.f77flags} {fargs.f90flags}" else ".f90"
+                module = sys.modules.get(module_name) or _imp_load_dynamic(module_name, module_path)
+                members = {k: v for k, v in vars(module).items() if k[:2] != "__"}
+                options[module_name]["kinds"] = _kind_table(members, code, _parse_kinds(fargs.kinds), fsuffix)
+            for path in (module_path, *(os.path.join(self._lib_dir, module_name + s) for s in (".f90", ".f"))):
+                if os.path.isfile(path):
+                    with open(path, "rb") as f:
+                        files[f"{name}/{os.path.basename(path)}"] = f.read()
+        init = _EXPORT_INIT.format(version=__version__, modules=options)
+        files[f"{name}/__init__.py"] = init.encode()
+
+        output = unquote(args.output)
+        os.makedirs(output, exist_ok=True)
+        if args.wheel:
+            target = _write_wheel(output, name, unquote(args.version), files)
+        else:
+            target = os.path.join(output, name)
+            shutil.rmtree(target, ignore_errors=True)
+            os.makedirs(target)
+            for arcname, data in files.items():
+                with open(os.path.join(output, arcname), "wb") as f:
+                    f.write(data)
+        print(f"Exported {len(modules)} module(s) to {target}")
+
+    @magic_arguments.magic_arguments()
+    @magic_arguments.argument("--restart", action="store_true", help="Restart the worker, reload its modules")
+    @magic_arguments.argument("--stop", action="store_true", help="Stop the worker process")
+    @line_magic
+    def fortran_worker(self, line):
+        """
+        Handle the worker process of `%%fortran --worker` cells.
+
+            %fortran_worker
+
+                Return the worker, its repr shows the process and the
+                number of modules
+
+            %fortran_worker --restart
+
+                Restart the worker: its memory is released and the
+                modules are loaded again
+
+            %fortran_worker --stop
+
+                Stop the worker, it starts again on the next call
+
+        The worker isolates crashes (a segmentation fault in Fortran
+        kills the worker, not the kernel) and shared libraries that can
+        not be unloaded. The returned worker allocates arrays that are
+        passed without copy: ``w = %fortran_worker`` then
+        ``a = w.empty((1000, 1000), order="F")``.
+        """
+
+        args = magic_arguments.parse_argstring(self.fortran_worker, line)
+        if self._worker is None:
+            self._worker = _Worker()
+        if args.stop:
+            self._worker.stop()
+        elif args.restart:
+            self._worker.restart()
+        return self._worker
 
     @property
     def so_ext(self):
@@ -431,7 +4171,15 @@ __doc__ = __doc__.format(FORTRAN_DOC=" " * 8 + FortranMagics.fortran.__doc__)
 
 def load_ipython_extension(ip) -> None:
     """Load the extension in IPython."""
-    ip.register_magics(FortranMagics)
+    magics = FortranMagics(ip)
+    ip.register_magics(magics)
+    if ip.db.get("fortranmagic_preload"):
+        magics._preload_start()
+
+    # Only a notebook frontend can use the highlight patch below,
+    # terminal and headless sessions have no kernel.
+    if getattr(ip, "kernel", None) is None:
+        return
 
     # enable fortran highlight
     patch = """
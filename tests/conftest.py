@@ -46,6 +46,8 @@ def isolate_ipython_dir(tmp_path_factory):
     ipdir = tmp_path_factory.mktemp("ipython")
     mp = pytest.MonkeyPatch()
     mp.setenv("IPYTHONDIR", str(ipdir))
+    # `get_ipython_cache_dir()` is under $XDG_CACHE_HOME, not $IPYTHONDIR, on Linux
+    mp.setenv("XDG_CACHE_HOME", str(tmp_path_factory.mktemp("cache")))
     yield
     mp.undo()
 
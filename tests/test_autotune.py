@@ -0,0 +1,95 @@
+"""Compiler flag autotuning: `%%fortran --autotune <statement>`"""
+
+import IPython.core.interactiveshell as ici
+import numpy as np
+import pytest
+
+import fortranmagic
+
+pytestmark = pytest.mark.requires_fortran
+
+AUTOTUNE_PRG = """%%fortran --f90flags '-cpp' --autotune 'value(3)'
+real(8) function value(n)
+    integer, intent(in) :: n
+#ifdef WRONG
+    value = -n
+#else
+    value = n
+#endif
+end function value
+"""
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_autotune(monkeypatch, capsys) -> None:
+    """Variants are ranked, wrong results rejected, the fastest loaded"""
+
+    monkeypatch.setattr(fortranmagic, "_AUTOTUNE_FLAGS", ("-O1", "-DWRONG", "-no-such-flag"))
+    monkeypatch.setattr(fortranmagic, "_AUTOTUNE_REPEAT", 1)
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    ish.run_cell("%fortran_config --defaults")
+    assert ish.run_cell(AUTOTUNE_PRG).success
+    out = capsys.readouterr().out
+
+    assert "autotune: value(3)" in out
+    assert "1. " in out
+    assert "2. " in out
+    assert "3. " not in out
+    assert "wrong result  -cpp -DWRONG" in out
+    assert "build failed" in out
+    assert "%fortran_config --f90flags '-cpp" in out
+    assert ish.user_ns["value"](3) == 3.0
+    # Only the loaded variant is exported
+    magics = ish.magics_manager.registry["FortranMagics"]
+    assert list(magics._code_cache.values()) == [magics._routines["value"][0]]
+
+
+INPLACE_PRG = """%%fortran --f90flags '-cpp' --autotune 'bump(y)'
+subroutine bump(y, n)
+    integer, intent(in) :: n
+    real(8), intent(inout) :: y(n)
+#ifdef WRONG
+    y = y + 2
+#else
+    y = y + 1
+#endif
+end subroutine bump
+"""
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_autotune_inplace(monkeypatch, capsys) -> None:
+    """Arrays modified in place are compared on copies"""
+
+    monkeypatch.setattr(fortranmagic, "_AUTOTUNE_FLAGS", ("-O1", "-DWRONG"))
+    monkeypatch.setattr(fortranmagic, "_AUTOTUNE_REPEAT", 1)
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    ish.run_cell("%fortran_config --defaults")
+    y = np.zeros(3)
+    ish.user_ns["y"] = y
+    assert ish.run_cell(INPLACE_PRG).success
+    out = capsys.readouterr().out
+    assert "wrong result  -cpp -DWRONG" in out
+    assert "2. " in out
+    np.testing.assert_array_equal(y, 0.0)
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_autotune_no_reference(monkeypatch, capsys) -> None:
+    """Without a result of the cell's own flags, no variant is loaded"""
+
+    monkeypatch.setattr(fortranmagic, "_AUTOTUNE_FLAGS", ("-DFIXED",))
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    ish.run_cell("%fortran_config --defaults")
+    magics = ish.magics_manager.registry["FortranMagics"]
+    builds = []
+    build = magics._fortran_build
+    monkeypatch.setattr(magics, "_fortran_build", lambda line, *a, **kw: builds.append(line) or build(line, *a, **kw))
+    cell = AUTOTUNE_PRG.replace("#ifdef WRONG", "#ifndef FIXED").replace("value = -n", "value = ")
+    assert not ish.run_cell(cell).success
+    assert "unchecked, the cell's own flags failed  -cpp -DFIXED" in capsys.readouterr().out
+    # The variants are not built
+    assert len(builds) == 1
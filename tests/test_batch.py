@@ -0,0 +1,87 @@
+"""Native batch drivers: `%%fortran --batch <routine>`"""
+
+import IPython.core.interactiveshell as ici
+import numpy as np
+import pytest
+
+pytestmark = pytest.mark.requires_fortran
+
+BATCH_PRG = """%%fortran --batch axpy --batch norm2 --batch sq
+subroutine axpy(a, x, y, n)
+    integer, intent(in) :: n
+    real(8), intent(in) :: a
+    real(8), intent(in) :: x(n)
+    real(8), intent(inout) :: y(n)
+    y = y + a * x
+end subroutine axpy
+
+real(8) function norm2(x, n)
+    integer, intent(in) :: n
+    real(8), intent(in) :: x(n)
+    norm2 = sqrt(sum(x**2))
+end function norm2
+
+module m
+contains
+    function sq(i) result(r)
+        integer, intent(in) :: i
+        integer :: r
+        r = i * i
+    end function sq
+end module m
+"""
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_batch() -> None:
+    """Stacked arguments along the last axis, bounds are shared"""
+
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    ish.run_cell("%fortran_config --defaults")
+    assert ish.run_cell(BATCH_PRG).success
+    ns = ish.user_ns
+
+    a = np.array([1.0, 2.0, 3.0])
+    x = np.arange(6.0).reshape(3, 2)
+    y = np.ones((3, 2))
+    ns["axpy_batch"](a, x.T, y.T)
+    np.testing.assert_allclose(y, 1 + a[:, None] * x)
+
+    np.testing.assert_allclose(ns["norm2_batch"](x.T), np.linalg.norm(x, axis=1))
+    np.testing.assert_array_equal(ns["sq_batch"](np.arange(5)), np.arange(5) ** 2)
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_batch_unknown() -> None:
+    """Unknown routines are reported before compilation"""
+
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    r = ish.run_cell("%%fortran --batch nope\nsubroutine yes()\nend subroutine yes\n")
+    assert not r.success
+    assert "--batch nope: no such subroutine or function" in str(r.error_in_exec)
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_batch_module_kinds() -> None:
+    """Arguments declared with the kind parameters of the module"""
+
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    ish.run_cell("%fortran_config --defaults")
+    cell = """%%fortran --batch twice
+module mk
+    integer, parameter :: wp = selected_real_kind(15)
+    real(wp) :: x = 0
+contains
+    subroutine twice(x, y)
+        real(wp), intent(in) :: x
+        real(wp), intent(out) :: y
+        y = 2 * x
+    end subroutine twice
+end module mk
+"""
+    assert ish.run_cell(cell).success
+    x = np.arange(4.0)
+    np.testing.assert_array_equal(ish.user_ns["twice_batch"](x), 2 * x)
@@ -0,0 +1,64 @@
+"""Timing history of %%fortran routines: `%fortran_bench`"""
+
+import IPython.core.interactiveshell as ici
+import numpy as np
+import pytest
+
+import fortranmagic
+
+pytestmark = pytest.mark.requires_fortran
+
+BENCH_PRG = """%%fortran
+real(8) function work(x, n)
+    integer, intent(in) :: n
+    real(8), intent(in) :: x(n)
+    integer :: i
+    work = 0
+    do i = 1, {repeat}
+        work = work + sum(sqrt(x + i))
+    end do
+end function work
+"""
+
+
+def test_slower_p_value() -> None:
+    """One-sided test: small p only if the first samples are larger"""
+
+    fast, slow = [1.0, 1.1, 0.9, 1.05, 0.95], [2.0, 2.1, 1.9, 2.05, 1.95]
+    assert fortranmagic._slower_p_value(slow, fast) < 0.01
+    assert fortranmagic._slower_p_value(fast, slow) > 0.99
+    assert fortranmagic._slower_p_value(fast, fast) > 0.4
+    assert fortranmagic._slower_p_value([1.0, 1.0], [1.0, 1.0]) == 1.0
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_bench_history(capsys) -> None:
+    """A slower build of the same routine is reported as a regression"""
+
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    ish.run_cell("%fortran_config --defaults")
+    ish.user_ns["x"] = np.ones(1000)
+
+    assert ish.run_cell(BENCH_PRG.format(repeat=1)).success
+    assert ish.run_cell("%fortran_bench -r 5 work(x)").success
+    assert "per loop" in capsys.readouterr().out
+
+    assert ish.run_cell(BENCH_PRG.format(repeat=100)).success
+    assert ish.run_cell("%fortran_bench -r 5 work(x)").success
+    assert "work is significantly slower than with build" in capsys.readouterr().err
+
+    assert ish.run_cell("%fortran_bench --history --routine work").success
+    out = capsys.readouterr().out
+    assert "work: work(x)" in out
+    assert "current" in out
+    assert "REGRESSION" in out
+
+    # The history outlives the cache
+    ish.run_cell("%fortran_config --clean-cache")
+    assert ish.run_cell("%fortran_bench --history --routine work").success
+    assert "REGRESSION" in capsys.readouterr().out
+
+    r = ish.run_cell("%fortran_bench len(x)")
+    assert not r.success
+    assert "calls no %%fortran object" in str(r.error_in_exec)
@@ -0,0 +1,129 @@
+"""Shared libraries of `bind(C)` procedures: `%%fortran --backend bindc`"""
+
+import IPython.core.interactiveshell as ici
+import numpy as np
+import pytest
+
+pytestmark = pytest.mark.requires_fortran
+
+BINDC_PRG = """%%fortran --backend bindc
+subroutine axpy(n, a, x, y) bind(C, name="c_axpy")
+    use iso_c_binding
+    integer(c_int), value :: n
+    real(c_double), value :: a
+    real(c_double), intent(in) :: x(n)
+    real(c_double), intent(inout) :: y(n)
+    y = y + a * x
+end subroutine axpy
+
+real(c_double) function total(n, x) &
+        bind(C)
+    use iso_c_binding
+    integer(c_int), intent(in) :: n
+    real(c_double), intent(in) :: x(n)
+    total = sum(x)
+end function total
+
+module m
+    use iso_c_binding
+contains
+    subroutine sq(x, r, v, k) bind(C)
+        real(c_float), value :: x
+        real(c_float), intent(out) :: r
+        integer(c_int), value :: k
+        integer(c_int), intent(out) :: v(k)
+        r = x * x
+        v = 2
+    end subroutine sq
+end module m
+"""
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_bindc() -> None:
+    """Values, references, in/output arrays & function results"""
+
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    ish.run_cell("%fortran_config --defaults")
+    assert ish.run_cell(BINDC_PRG).success
+    ns = ish.user_ns
+
+    y = np.ones(3)
+    assert ns["axpy"](3, 2.0, np.arange(3.0), y) is None
+    np.testing.assert_allclose(y, [1.0, 3.0, 5.0])
+    assert ns["total"](3, [1, 2, 3]) == 6.0
+
+    r, v = ns["sq"](3.0, 4)
+    assert r == 9.0
+    np.testing.assert_array_equal(v, [2, 2, 2, 2])
+    assert v.dtype == np.int32
+    assert ns["sq"].__doc__.startswith("sq(x, k) -> r, v")
+
+    with pytest.raises(TypeError, match="expected a Fortran contiguous float64 array"):
+        ns["axpy"](3, 2.0, np.arange(3.0), [1.0, 2.0, 3.0])
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_bindc_usage() -> None:
+    """Cells without bind(C) procedures are rejected before compilation"""
+
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    r = ish.run_cell("%%fortran --backend bindc\nsubroutine nobind()\nend subroutine nobind\n")
+    assert not r.success
+    assert "no bind(C) procedure" in str(r.error_in_exec)
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_bindc_kinds() -> None:
+    """Arrays are passed as raw memory of the exact C type"""
+
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    ish.run_cell("%fortran_config --defaults")
+    cell = """%%fortran --backend bindc
+subroutine kinds(n, s, b, m) bind(C)
+    use iso_c_binding
+    integer(c_int), value :: n
+    integer(c_short), intent(inout) :: s(n)
+    integer(c_int8_t), intent(inout) :: b(n)
+    logical(c_int), intent(out) :: m(n)
+    s = s + 1
+    b = b * 2
+    m = s > 2
+end subroutine kinds
+"""
+    assert ish.run_cell(cell).success
+    s, b = np.arange(1, 5, dtype=np.int16), np.arange(4, dtype=np.int8)
+    m = ish.user_ns["kinds"](4, s, b)
+    np.testing.assert_array_equal(s, [2, 3, 4, 5])
+    np.testing.assert_array_equal(b, [0, 2, 4, 6])
+    assert m.dtype == np.intc
+    np.testing.assert_array_equal(m, [0, 1, 1, 1])
+
+    r = ish.run_cell(
+        "%%fortran --backend bindc\nsubroutine q(x) bind(C)\n    real(16), intent(inout) :: x(2)\nend subroutine q\n"
+    )
+    assert "real(16) arguments are not supported" in str(r.error_in_exec)
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_bindc_inout_scalar() -> None:
+    """intent(inout) scalars are 0-d arrays updated in place"""
+
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    ish.run_cell("%fortran_config --defaults")
+    cell = (
+        "subroutine bump(n) bind(C)\n    use iso_c_binding\n"
+        "    integer(c_int), intent(inout) :: n\n    n = n + 1\nend subroutine bump\n"
+    )
+    assert ish.run_cell("%%fortran --backend bindc\n" + cell).success
+    bump = ish.user_ns["bump"]
+    n = np.array(41, np.int32)
+    assert bump(n) is None
+    assert n == 42
+    for wrong in (41, np.array(41)):
+        with pytest.raises(TypeError, match="expected a Fortran contiguous int32 array"):
+            bump(wrong)
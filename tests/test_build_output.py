@@ -0,0 +1,83 @@
+"""Streaming of the build output"""
+
+import glob
+import io
+import os
+import sys
+
+import IPython.core.interactiveshell as ici
+import pytest
+
+import fortranmagic
+
+BUG_PRG = """
+subroutine hj(x)
+    x = ?-+1+-?
+end subroutine hj
+"""
+
+GFORTRAN_LOG = [
+    ("out", "Reading fortran codes...\n"),
+    ("out", "The Meson build system\n"),
+    ("out", "[1/7] Compiling C object m.so.p/mmodule.c.o\n"),
+    ("out", "FAILED: [code=1] m.so.p/m.f90.o \n"),
+    ("out", "../m.f90:2:10:\n"),
+    ("out", "\n"),
+    ("out", "\x1b[01m\x1b[KError:\x1b[m\x1b[K Invalid character in name at (1)\n"),
+    ("err", "subprocess.CalledProcessError: Command 'meson compile' returned non-zero exit status 1.\n"),
+]
+
+
+def test_build_output_first_error(tmp_path, capsys) -> None:
+    """Parse phases & first error, log everything, replay on failure"""
+
+    log = tmp_path / "build.log"
+    output = fortranmagic._BuildOutput(log=str(log))
+    for stream, line in GFORTRAN_LOG:
+        output.feed(stream, line)
+    output.close(False)
+
+    assert output.first_error == "../m.f90:2:10: Error: Invalid character in name at (1)"
+    assert log.read_text(encoding="utf-8") == "".join(line for _, line in GFORTRAN_LOG)
+    c = capsys.readouterr()
+    assert c.out == ""
+    assert c.err == "f2py: error: " + output.first_error + "\n"
+
+    output.replay()
+    c = capsys.readouterr()
+    assert c.out.count("\n") == 7
+    assert c.err.count("\n") == 1
+
+
+def test_build_output_terminal(monkeypatch) -> None:
+    """The phases are shown in place on a terminal, then cleared"""
+
+    class Terminal(io.StringIO):
+        def isatty(self) -> bool:
+            return True
+
+    stderr = Terminal()
+    monkeypatch.setattr(sys, "stderr", stderr)
+    output = fortranmagic._BuildOutput()
+    for stream, line in GFORTRAN_LOG[:3]:
+        output.feed(stream, line)
+    assert stderr.getvalue().endswith("\r\x1b[Kf2py: compiling 1/7")
+    output.close(True)
+    assert stderr.getvalue().endswith("\r\x1b[K")
+
+
+@pytest.mark.requires_fortran
+@pytest.mark.usefixtures("use_fortran_config")
+def test_build_log(capfd) -> None:
+    """The failed build leaves its log in the cache directory"""
+
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    ish.run_cell("%fortran_config --clean-cache")
+    assert not ish.run_cell("%%fortran\n" + BUG_PRG).success
+    assert "f2py: error:" in capfd.readouterr().err
+
+    lib_dir = ish.db["fortranmagic_cache"]
+    (log,) = glob.glob(os.path.join(lib_dir, "*.log"))
+    with open(log, encoding="utf-8") as f:
+        assert "Invalid character" in f.read()
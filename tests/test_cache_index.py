@@ -0,0 +1,59 @@
+"""Index of the build cache: `%fortran_cache`"""
+
+import os
+
+import IPython.core.interactiveshell as ici
+import pytest
+
+pytestmark = pytest.mark.requires_fortran
+
+PRG = """%%fortran
+subroutine f{i}(x)
+    real(8), intent(out) :: x
+    x = {i}
+end subroutine f{i}
+"""
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_cache_index(capsys) -> None:
+    """Builds & hits are recorded, pinned modules survive purge"""
+
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    ish.run_cell("%fortran_config --defaults")
+    ish.run_cell("%fortran_config --clean-cache")
+    magics = ish.magics_manager.registry["FortranMagics"]
+    magics._cache_stats.update(hits=0, builds=0, build_time=0.0, saved=0.0)
+    for i in (1, 2, 1, 1):
+        assert ish.run_cell(PRG.format(i=i)).success
+    capsys.readouterr()
+
+    rows = {r["code"]: r for r in magics._index.entries()}
+    one, two = rows[PRG.format(i=1).split("\n", 1)[1]], rows[PRG.format(i=2).split("\n", 1)[1]]
+    assert (one["hits"], two["hits"]) == (2, 0)
+    assert one["build_time"] > 0
+    assert one["size"] > 0
+    assert one["line"] == ""
+    assert one["last_used"] >= one["created"]
+
+    ish.run_line_magic("fortran_cache", "--stats")
+    out = capsys.readouterr().out
+    assert "2 hit(s) in 4 lookup(s) (50%)" in out
+    assert f"compile time saved: {2 * one['build_time']:.1f} s" in out
+
+    ish.run_line_magic("fortran_cache", "--query 'x = 2'")
+    out = capsys.readouterr().out
+    assert "1 module(s)" in out
+    assert two["module"].removeprefix("_fortran_magic_")[:10] in out
+
+    ish.run_line_magic("fortran_cache", "--pin " + one["module"].removeprefix("_fortran_magic_")[:6])
+    ish.run_line_magic("fortran_cache", "--purge")
+    assert "Purged 1 module(s)" in capsys.readouterr().out
+    assert [r["module"] for r in magics._index.entries()] == [one["module"]]
+    lib_dir = ish.db["fortranmagic_cache"]
+    assert not [f for f in os.listdir(lib_dir) if f.startswith(two["module"])]
+    assert [f for f in os.listdir(lib_dir) if f.startswith(one["module"])]
+
+    r = ish.run_cell("%fortran_cache --pin nope")
+    assert "No cached module" in str(r.error_in_exec)
@@ -0,0 +1,78 @@
+"""Chunked execution over memory mapped arrays: `fortranmagic.chunked`"""
+
+import IPython.core.interactiveshell as ici
+import numpy as np
+import pytest
+
+import fortranmagic
+
+SMOOTH_PRG = """%%fortran
+subroutine smooth(a, n, b)
+    integer, intent(in) :: n
+    real(8), intent(in) :: a(n)
+    real(8), intent(out) :: b(n)
+    b = a
+    b(2:n-1) = (a(1:n-2) + a(2:n-1) + a(3:n)) / 3
+end subroutine smooth
+
+subroutine scale(a, n)
+    integer, intent(in) :: n
+    real(8), intent(inout) :: a(n)
+    a = 2 * a
+end subroutine scale
+"""
+
+
+def test_chunked_bounds(tmp_path) -> None:
+    """Page aligned contiguous chunks, halo, `.npy` input & output"""
+
+    a = np.arange(10000.0).reshape(2500, 4)
+    np.save(tmp_path / "a.npy", a)
+    chunks = []
+
+    def routine(x):
+        assert x.flags.c_contiguous
+        chunks.append(x.shape[0])
+        return x + 1
+
+    out = fortranmagic.chunked(routine, tmp_path / "a.npy", out=tmp_path / "b.npy", halo=2, chunk_bytes=8192)
+    assert isinstance(out, np.memmap)
+    np.testing.assert_array_equal(np.load(tmp_path / "b.npy"), a + 1)
+    assert chunks[0] == 256 + 2  # 256 rows of 32 bytes are 2 pages
+    assert chunks[1] == 256 + 4
+    assert sum(chunks) == 2500 + 4 * (len(chunks) - 1)
+
+
+def test_chunked_stale_out(tmp_path) -> None:
+    """An existing `.npy` output of another shape or dtype is replaced"""
+
+    np.save(tmp_path / "b.npy", np.full(5000, -1, dtype=np.int32))
+    a = np.arange(1000.0)
+    out = fortranmagic.chunked(lambda x: x * 2, a, out=tmp_path / "b.npy", chunk_bytes=4096)
+    assert out.shape == a.shape
+    assert out.dtype == a.dtype
+    del out
+    np.testing.assert_array_equal(np.load(tmp_path / "b.npy"), a * 2)
+
+
+@pytest.mark.requires_fortran
+@pytest.mark.usefixtures("use_fortran_config")
+def test_chunked_fortran(tmp_path) -> None:
+    """Stencil with halo, in place update of a writable memory map"""
+
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    ish.run_cell("%fortran_config --defaults")
+    assert ish.run_cell(SMOOTH_PRG).success
+    smooth, scale = ish.user_ns["smooth"], ish.user_ns["scale"]
+
+    a = np.random.default_rng(0).random(100000)
+    out = np.empty_like(a)
+    fortranmagic.chunked(smooth, a, out=out, halo=1, chunk_bytes=1 << 14)
+    np.testing.assert_allclose(out, smooth(a))
+
+    m = np.lib.format.open_memmap(tmp_path / "m.npy", "w+", np.float64, (100000,))
+    m[:] = a
+    assert fortranmagic.chunked(scale, m, chunk_bytes=1 << 14) is None
+    m.flush()
+    np.testing.assert_allclose(np.load(tmp_path / "m.npy"), 2 * a)
@@ -0,0 +1,103 @@
+"""Builds without meson: `%%fortran --backend auto`"""
+
+import glob
+import os
+import shutil
+
+import IPython.core.interactiveshell as ici
+import IPython.paths
+import numpy as np
+import pytest
+
+pytestmark = pytest.mark.requires_fortran
+
+DIRECT_PRG = """
+module direct
+contains
+    real(8) function total(n, x)
+        integer, intent(in) :: n
+        real(8), intent(in) :: x(n)
+        total = sum(x)
+    end function total
+end module direct
+
+subroutine twice(x, y)
+    real(8), intent(in) :: x
+    real(8), intent(out) :: y
+    y = 2 * x
+end subroutine twice
+"""
+
+
+@pytest.fixture
+def ish():
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    ish.run_cell("%fortran_config --defaults")
+    return ish
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_direct(ish, capsys) -> None:
+    """Simple cells are compiled directly, `fortranobject.c` once"""
+
+    objects = os.path.join(IPython.paths.get_ipython_cache_dir(), "fortranmagic", "fortranobject-*.o")
+    for path in glob.glob(objects):
+        os.remove(path)
+
+    assert ish.run_cell("%%fortran -vvv\n" + DIRECT_PRG).success
+    out = capsys.readouterr().out
+    assert "--backend meson" not in out
+    assert "fortranobject.c" in out
+    assert ish.user_ns["direct"].total([1.0, 2.0]) == 3.0
+    assert ish.user_ns["twice"](2.0) == 4.0
+    assert glob.glob(objects)
+
+    assert ish.run_cell("%%fortran -vvv\n" + DIRECT_PRG.replace("2 * x", "3 * x")).success
+    assert "fortranobject.c" not in capsys.readouterr().out
+    assert ish.user_ns["twice"](2.0) == 6.0
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_direct_fallback(ish, capsys) -> None:
+    """--backend meson & --extra flags build with meson"""
+
+    for options in ("--backend meson", "--extra '-DUNUSED'"):
+        assert ish.run_cell(f"%%fortran -vv {options}\n" + DIRECT_PRG.replace("2 * x", "4 * x")).success
+        assert "--backend meson" in capsys.readouterr().out
+        np.testing.assert_allclose(ish.user_ns["direct"].total(np.ones(3)), 3.0)
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_direct_wrappers(ish, capsys) -> None:
+    """The f2py wrappers are reused while the interface is unchanged"""
+
+    shutil.rmtree(os.path.join(IPython.paths.get_ipython_cache_dir(), "fortranmagic", "wrappers"), ignore_errors=True)
+    prg = DIRECT_PRG.replace("twice", "wtwice")
+    assert ish.run_cell("%%fortran -vv\n" + prg).success
+    assert "numpy.f2py" in capsys.readouterr().out
+
+    body = prg.replace("    y = 2 * x", "    real(8) :: t\n    t = x\n    y = 5 * t")
+    assert ish.run_cell("%%fortran -vv\n" + body).success
+    out = capsys.readouterr().out
+    assert "numpy.f2py" not in out
+    assert "Reusing the f2py wrappers" in out
+    assert ish.user_ns["wtwice"](2.0) == 10.0
+    assert ish.user_ns["direct"].total([1.0, 2.0]) == 3.0
+
+    interface = prg.replace("intent(out) :: y", "intent(inout) :: y")
+    assert ish.run_cell("%%fortran -vv\n" + interface).success
+    assert "numpy.f2py" in capsys.readouterr().out
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_direct_wrappers_common(ish, capsys) -> None:
+    """Common blocks are part of the interface"""
+
+    shutil.rmtree(os.path.join(IPython.paths.get_ipython_cache_dir(), "fortranmagic", "wrappers"), ignore_errors=True)
+    prg = "subroutine fill_w()\n    real(8) :: a({0})\n    common /blk_w/ a\n    a = {0}\nend subroutine\n"
+    for n in (10, 20):
+        assert ish.run_cell("%%fortran -vv\n" + prg.format(n)).success
+        assert "numpy.f2py" in capsys.readouterr().out
+        ish.user_ns["fill_w"]()
+        np.testing.assert_array_equal(ish.user_ns["blk_w"].a, np.full(n, n))
@@ -0,0 +1,104 @@
+"""Build & cache events: callbacks, `FORTRANMAGIC_METRICS` exporters"""
+
+import json
+import uuid
+
+import IPython.core.interactiveshell as ici
+import pytest
+
+pytestmark = pytest.mark.requires_fortran
+
+
+def _shell():
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    ish.run_cell("%fortran_config --defaults")
+    return ish, ish.magics_manager.registry["FortranMagics"]
+
+
+def _cell(tag):
+    # A new cell for each run, so the first execution is a cache miss
+    return f"%%fortran\nsubroutine ev_{tag}(x)\n    real(8), intent(inout) :: x\n    x = x + 1\nend subroutine\n"
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_events() -> None:
+    """Miss, build & load, then a hit; failures have a reason"""
+
+    ish, magics = _shell()
+    records = []
+    for event in ("cache_hit", "cache_miss", "build_started", "build_finished", "module_loaded"):
+        magics.events.register(event, records.append)
+    with pytest.raises(KeyError):
+        magics.events.register("nope", records.append)
+
+    cell = _cell(uuid.uuid4().hex[:8])
+    assert ish.run_cell(cell).success
+    assert [r["event"] for r in records] == ["cache_miss", "build_started", "build_finished", "module_loaded"]
+    finished = records[2]
+    assert finished["success"]
+    assert finished["reason"] is None
+    assert finished["seconds"] > 0
+    assert finished["bytes"] > 0
+    assert len({r["module"] for r in records}) == 1
+
+    records.clear()
+    assert ish.run_cell(cell).success
+    assert [r["event"] for r in records] == ["cache_hit", "module_loaded"]
+    assert records[0]["source"] == "local"
+
+    records.clear()
+    assert not ish.run_cell(f"%%fortran\nsubroutine ev_{uuid.uuid4().hex[:8]}()\n    x = \nend subroutine\n").success
+    finished = records[-1]
+    assert finished["event"] == "build_finished"
+    assert not finished["success"]
+    assert finished["reason"] == "compile"
+    assert "Error" in finished["error"]
+
+    # A failing callback only warns
+    magics.events.register("cache_hit", lambda record: 1 / 0)
+    assert ish.run_cell(cell).success
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_metrics_exporters(tmp_path, monkeypatch, capsys) -> None:
+    """JSON lines & Prometheus text files"""
+
+    jsonl, prom = tmp_path / "events.jsonl", tmp_path / "fm_{pid}.prom"
+    monkeypatch.setenv("FORTRANMAGIC_METRICS", f"jsonl:{jsonl},prometheus:{prom},nope:x")
+    ish, _ = _shell()
+    assert "ignored 'nope:x'" in capsys.readouterr().err
+
+    cell = _cell(uuid.uuid4().hex[:8])
+    assert ish.run_cell(cell).success
+    assert ish.run_cell(cell).success
+
+    events = [json.loads(line)["event"] for line in jsonl.read_text().splitlines()]
+    assert events == ["cache_miss", "build_started", "build_finished", "module_loaded", "cache_hit", "module_loaded"]
+
+    (text,) = (p.read_text() for p in tmp_path.glob("fm_*.prom"))
+    assert 'fortranmagic_cache_lookups_total{result="hit"} 1' in text
+    assert 'fortranmagic_cache_lookups_total{result="miss"} 1' in text
+    assert 'fortranmagic_builds_total{reason="",result="success"} 1' in text
+    assert "fortranmagic_load_seconds_count 2" in text
+    assert "# TYPE fortranmagic_build_seconds summary" in text
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_events_exception(monkeypatch) -> None:
+    """Any exception of the build finishes it"""
+
+    ish, magics = _shell()
+    records = []
+    magics.events.register("build_finished", records.append)
+
+    def fail(*args, **kwargs):
+        raise OSError(2, "No such file or directory")
+
+    for step in ("_run_f2py", "_run_build", "_run_direct"):
+        monkeypatch.setattr(magics, step, fail)
+    assert not ish.run_cell(_cell(uuid.uuid4().hex[:8])).success
+    (finished,) = records
+    assert not finished["success"]
+    assert finished["reason"] == "error"
+    assert finished["error"] == "FileNotFoundError: [Errno 2] No such file or directory"
@@ -0,0 +1,122 @@
+"""Test `%fortran_export` of prebuilt modules"""
+
+import json
+import subprocess
+import sys
+import zipfile
+
+import IPython.core.interactiveshell as ici
+import pytest
+
+pytestmark = pytest.mark.requires_fortran
+
+CELL = """
+subroutine add1(x, y)
+    real(8), intent(in) :: x
+    real(8), intent(out) :: y
+    y = x + 1
+end subroutine add1
+"""
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_export_notebook(tmp_path) -> None:
+    """Export a notebook as package & wheel, import it without compiler"""
+
+    nb = {
+        "cells": [
+            {"cell_type": "markdown", "metadata": {}, "source": ["%%fortran\n"]},
+            {"cell_type": "code", "metadata": {}, "source": ["%%fortran --f90flags '-O0'\n", CELL]},
+            {"cell_type": "code", "metadata": {}, "source": "print(add1(1))"},
+        ],
+        "metadata": {},
+        "nbformat": 4,
+        "nbformat_minor": 5,
+    }
+    nb_path = tmp_path / "cells.ipynb"
+    nb_path.write_text(json.dumps(nb), encoding="utf-8")
+
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    for opt in ("", "--wheel"):
+        res = ish.run_cell(f"%fortran_export --notebook {nb_path} --name mycells --output {tmp_path} {opt}")
+        assert res.success
+
+    out = subprocess.check_output(
+        [sys.executable, "-c", "import mycells; print(mycells.add1(2))"],
+        cwd=tmp_path,
+        text=True,
+    )
+    assert float(out) == 3.0
+
+    (whl,) = tmp_path.glob("mycells-0.0.0-*.whl")
+    with zipfile.ZipFile(whl) as z:
+        names = z.namelist()
+    assert "mycells/__init__.py" in names
+    assert "mycells-0.0.0.dist-info/RECORD" in names
+    assert any(n.startswith("mycells/_fortran_magic_") and n.endswith(".f90") for n in names)
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_export_nothing(tmp_path) -> None:
+    """Export without built modules is an error"""
+
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    ish.run_cell("%fortran_config --clean-cache")
+    res = ish.run_cell(f"%fortran_export --output {tmp_path}")
+    assert not res.success
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_export_bindc(tmp_path) -> None:
+    """--backend bindc libraries are not extension modules"""
+
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    ish.run_cell("%fortran_config --defaults")
+    cell = "subroutine e1(x) bind(C)\n    use iso_c_binding\n    real(c_double) :: x\n    x = 1\nend subroutine e1\n"
+    assert ish.run_cell("%%fortran --backend bindc\n" + cell).success
+    res = ish.run_cell(f"%fortran_export --name bpkg --output {tmp_path}")
+    assert "--backend bindc modules are not extension modules" in str(res.error_in_exec)
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_export_ufunc(tmp_path) -> None:
+    """The --ufunc ufuncs are exported with their module"""
+
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    ish.run_cell("%fortran_config --defaults")
+    cell = "elemental real(8) function usq(x)\n    real(8), intent(in) :: x\n    usq = x * x\nend function usq\n"
+    assert ish.run_cell("%%fortran --ufunc\n" + cell).success
+    assert ish.run_cell(f"%fortran_export --name upkg --output {tmp_path}").success
+    out = subprocess.check_output(
+        [sys.executable, "-c", "import upkg; print(type(upkg.usq).__name__, upkg.usq([1.0, 3.0]).sum())"],
+        cwd=tmp_path,
+        text=True,
+    )
+    assert out.split() == ["ufunc", "10.0"]
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_export_kinds(tmp_path) -> None:
+    """The --kinds dispatchers are exported with their specializations"""
+
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    ish.run_cell("%fortran_config --defaults")
+    cell = (
+        "module kstats\ncontains\n    integer function kx(x, n)\n        integer, intent(in) :: n\n"
+        "        real(wp), intent(in) :: x(n)\n        kx = kind(x)\n    end function kx\nend module kstats\n"
+        "integer function ky(x)\n    real(wp), intent(in) :: x\n    ky = kind(x)\nend function ky\n"
+    )
+    assert ish.run_cell("%%fortran --kinds wp=4,8\n" + cell).success
+    assert ish.run_cell(f"%fortran_export --name kpkg --output {tmp_path}").success
+    script = (
+        "import numpy as np, kpkg\n"
+        "print(kpkg.kstats.kx(np.ones(2, np.float32)), kpkg.kstats.kx(np.ones(2)),"
+        " kpkg.ky(np.float32(1)), kpkg.ky(1.0), kpkg.ky__4(1.0))"
+    )
+    out = subprocess.check_output([sys.executable, "-c", script], cwd=tmp_path, text=True)
+    assert out.split() == ["4", "8", "4", "8", "4"]
@@ -0,0 +1,38 @@
+"""Import time of `fortranmagic` and `%load_ext fortranmagic`"""
+
+import subprocess
+import sys
+
+# Cumulative import time limit of `fortranmagic` itself (IPython preloaded)
+IMPORT_LIMIT_US = 300_000
+
+PROBE = """
+import sys
+import IPython.core.interactiveshell as ici
+
+import fortranmagic
+
+ish = ici.InteractiveShell()
+assert ish.run_cell("%load_ext fortranmagic").success
+print(" ".join(m for m in sys.modules if m == "numpy" or m.startswith("numpy.")))
+"""
+
+
+def test_import_time() -> None:
+    """`import fortranmagic` & loading the extension must not import NumPy"""
+
+    p = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert p.stdout.strip() == "", "eagerly imported: " + p.stdout
+
+    cumulative = None
+    for line in p.stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == "fortranmagic":
+            cumulative = int(fields[1])
+    assert cumulative is not None, p.stderr
+    assert cumulative < IMPORT_LIMIT_US, f"import fortranmagic: {cumulative} us"
@@ -0,0 +1,68 @@
+"""Kind specializations: `%%fortran --kinds wp=4,8`"""
+
+import IPython.core.interactiveshell as ici
+import numpy as np
+import pytest
+
+import fortranmagic
+
+pytestmark = pytest.mark.requires_fortran
+
+KINDS_PRG = """%%fortran --kinds wp=4,8 --kinds ik=4,8
+subroutine scale(x, n, s, k)
+    integer(ik), intent(in) :: n
+    real(wp), intent(inout) :: x(n)
+    real(wp), intent(in) :: s
+    integer, intent(out) :: k
+    x = x * s * 1.0_wp  ! 1.0_wp: the kind of a literal
+    k = 10 * kind(x) + kind(n)
+end subroutine scale
+
+module stats
+contains
+    real(wp) function mean(x, n)
+        integer, intent(in) :: n
+        real(wp), intent(in) :: x(n)
+        mean = sum(x) / n
+    end function mean
+end module stats
+"""
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_kinds() -> None:
+    """The dtypes of the arguments select the specialization, no copy"""
+
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    ish.run_cell("%fortran_config --defaults")
+    assert ish.run_cell(KINDS_PRG).success
+    ns = ish.user_ns
+
+    # intent(inout) arrays are updated in place: no conversion
+    x4, x8 = np.ones(3, np.float32), np.ones(3)
+    assert ns["scale"](x4, 2.0) == 48
+    np.testing.assert_array_equal(x4, [2.0, 2.0, 2.0])
+    assert ns["scale"](x8, 3.0) == 88
+    np.testing.assert_array_equal(x8, [3.0, 3.0, 3.0])
+    assert ns["scale"](x4, 2.0, n=np.int32(3)) == 44
+
+    assert ns["stats"].mean(np.arange(4, dtype=np.float32)) == 1.5
+    assert ns["stats"].mean([1, 2]) == 1.5
+    assert ns["scale__4_8"](x4, 0.5) == 48
+    assert "scale" in repr(ns["scale"])
+
+    r = ish.run_cell("%%fortran --kinds wp\nsubroutine s()\nend subroutine s\n")
+    assert not r.success
+    assert "expected <name>=<kind>" in str(r.error_in_exec)
+
+
+def test_kind_variants() -> None:
+    """Kinds of literals are replaced, strings & comments are kept"""
+
+    code = "subroutine p(x)\n    real(wp) :: x\n    x = 2.5_wp + 1e-3_wp  ! wp\n    print *, 'wp _wp', x\nend\n"
+    variant = fortranmagic._kind_variants(code, [("wp", ["8"])])
+    assert "real(8) :: x" in variant
+    assert "x = 2.5_8 + 1e-3_8  ! wp" in variant
+    assert "'wp _wp'" in variant
+    assert "subroutine p__8(x)" in variant
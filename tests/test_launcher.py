@@ -0,0 +1,60 @@
+"""Compiler cache launcher: `%%fortran --compiler-launcher`"""
+
+import os
+import sys
+
+import IPython.core.interactiveshell as ici
+import pytest
+
+import fortranmagic
+
+pytestmark = [
+    pytest.mark.requires_fortran,
+    pytest.mark.skipif(sys.platform == "win32", reason="POSIX shell launcher"),
+]
+
+# Counts the compilations as hits
+FAKE_CCACHE = """#!/bin/sh
+if [ "$1" = "--print-stats" ]; then
+    printf 'direct_cache_hit\\t%s\\ncache_miss\\t1\\n' "$(cat "$0.log" 2>/dev/null | wc -l)"
+    exit 0
+fi
+echo "$@" >> "$0.log"
+exec "$@"
+"""
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_launcher(tmp_path, capsys) -> None:
+    """Both compilers run through the launcher, its counters are reported"""
+
+    launcher = tmp_path / "ccache"
+    launcher.write_text(FAKE_CCACHE)
+    launcher.chmod(0o755)
+    assert fortranmagic._launcher_stats(str(launcher)) == (0, 1)
+
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    ish.run_cell("%fortran_config --defaults")
+    cell = f"%%fortran -v --compiler-launcher {launcher}\nsubroutine launched(x)\n    x = 1\nend subroutine launched\n"
+    assert ish.run_cell(cell).success
+
+    calls = (tmp_path / "ccache.log").read_text().splitlines()
+    assert any(os.path.basename(c.split()[0]) == "gfortran" for c in calls)
+    assert any(c.split()[0] == fortranmagic._toolchain()["cc"]["path"] for c in calls)
+    assert f"ccache: {len(calls)} hit(s), 0 miss(es)" in capsys.readouterr().out
+
+
+def test_compiler_environ(monkeypatch) -> None:
+    """The launcher is prepended once, cache variables are not overridden"""
+
+    monkeypatch.setenv("FC", "ccache gfortran")
+    monkeypatch.delenv("CC", raising=False)
+    monkeypatch.setenv("CCACHE_BASEDIR", "/mine")
+    toolchain = {"fc": {"path": "/usr/bin/gfortran"}, "cc": {"path": "/usr/bin/cc"}}
+    env = fortranmagic._compiler_environ(toolchain, "/usr/bin/ccache", "/stage")
+    assert "FC" not in env
+    assert env["CC"] == "/usr/bin/ccache /usr/bin/cc"
+    assert "CCACHE_BASEDIR" not in env
+    assert env["CCACHE_NOHASHDIR"] == "true"
+    assert fortranmagic._compiler_environ(toolchain, None, "/stage") == {"CC": "/usr/bin/cc"}
@@ -0,0 +1,89 @@
+"""Memoized pure procedures: `%%fortran --memoize` & `%fortran_memo`"""
+
+import IPython.core.interactiveshell as ici
+import numpy as np
+import pytest
+
+pytestmark = pytest.mark.requires_fortran
+
+MEMO_PRG = """%%fortran --memoize
+pure function total(x, n) result(s)
+    integer, intent(in) :: n
+    real(8), intent(in) :: x(n)
+    real(8) :: s
+    s = sum(x)
+end function total
+
+pure subroutine twice(x, n, y)
+    integer, intent(in) :: n
+    real(8), intent(in) :: x(n)
+    real(8), intent(out) :: y(n)
+    y = 2 * x
+end subroutine twice
+
+pure subroutine bump(x)
+    real(8), intent(inout) :: x(:)
+    x = x + 1
+end subroutine bump
+
+module memo_m
+contains
+    elemental real(8) function sq(x)
+        real(8), intent(in) :: x
+        sq = x * x
+    end function sq
+end module memo_m
+"""
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_memoize(tmp_path, capsys) -> None:
+    """Hits for equal contents, copies of the results, spill to disk"""
+
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    ish.run_cell("%fortran_config --defaults")
+    assert ish.run_cell(MEMO_PRG).success
+    ns, memo = ish.user_ns, ish.magics_manager.registry["FortranMagics"]._memo
+    memo.clear()
+
+    x = np.arange(4.0)
+    assert ns["total"](x) == 6.0
+    assert ns["total"](x.copy()) == 6.0
+    assert ns["total"](x.astype(np.float32)) == 6.0
+    x[0] = 1.0
+    assert ns["total"](x) == 7.0
+    assert memo.stats["total"] == {"hits": 1, "disk": 0, "misses": 3, "saved": memo.stats["total"]["saved"]}
+
+    y = ns["twice"](x)
+    y[:] = 0.0
+    np.testing.assert_allclose(ns["twice"](x), 2 * x)
+    assert memo.stats["twice"]["hits"] == 1
+
+    assert ns["sq"](3.0) == 9.0
+    assert ns["sq"](3.0) == 9.0
+    assert memo.stats["sq"]["hits"] == 1
+
+    # intent(inout): not memoized
+    ns["bump"](x)
+    ns["bump"](x)
+    np.testing.assert_allclose(x, [3.0, 3.0, 4.0, 5.0])
+    assert "bump" not in memo.stats
+
+    # Results evicted from memory are read from disk
+    memo.limit, memo.spill, memo.directory = 1, 10**6, str(tmp_path)
+    z = np.linspace(0, 1, 100)
+    np.testing.assert_allclose(ns["twice"](z), 2 * z)
+    assert memo.size == 0
+    assert memo.disk_size() > 0
+    np.testing.assert_allclose(ns["twice"](z), 2 * z)
+    assert memo.stats["twice"]["disk"] == 1
+
+    capsys.readouterr()
+    ish.run_line_magic("fortran_memo", "")
+    out = capsys.readouterr().out
+    assert "twice" in out
+    assert "on disk" in out
+    ish.run_line_magic("fortran_memo", "--clear")
+    assert memo.stats == {}
+    assert memo.disk_size() == 0
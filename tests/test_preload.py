@@ -0,0 +1,58 @@
+"""Background preload of the recent cells: `%fortran_cache --preload on`"""
+
+import IPython.core.interactiveshell as ici
+import pytest
+
+import fortranmagic
+
+PRELOAD_PRG = """%%fortran
+subroutine preloaded(x, y)
+    real(8), intent(in) :: x
+    real(8), intent(out) :: y
+    y = 3 * x
+end subroutine preloaded
+"""
+
+
+@pytest.mark.requires_fortran
+@pytest.mark.usefixtures("use_fortran_config")
+def test_preload() -> None:
+    """A new session loads the modules of the manifest before the cells run"""
+
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    ish.run_cell("%fortran_config --defaults")
+    assert ish.run_cell(PRELOAD_PRG).success
+    assert ish.run_cell("%fortran_cache --preload on").success
+    try:
+        # "Restart": a new shell loading the extension
+        ish = ici.InteractiveShell()
+        assert ish.run_cell("%load_ext fortranmagic").success
+        magics = ish.magics_manager.registry["FortranMagics"]
+        magics._preload_thread.join(timeout=60)
+        assert magics._preloads
+
+        assert ish.run_cell(PRELOAD_PRG).success
+        module_name = magics._routines["preloaded"][0]
+        assert ish.user_ns["preloaded"] is magics._preloads[module_name].result().preloaded
+        assert ish.user_ns["preloaded"](2.0) == 6.0
+    finally:
+        assert ish.run_cell("%fortran_cache --preload off").success
+        ish = ici.InteractiveShell()
+        assert ish.run_cell("%load_ext fortranmagic").success
+        assert ish.magics_manager.registry["FortranMagics"]._preload_thread is None
+
+
+def test_manifest_write_error(tmp_path, capsys) -> None:
+    """An unwritable manifest warns instead of failing the cell"""
+
+    (tmp_path / "file").write_text("")
+    manifest = fortranmagic._Manifest(str(tmp_path / "file" / "preload.json"))
+    manifest.add("", "%%fortran")
+    assert "preload manifest not updated" in capsys.readouterr().err
+    assert manifest.entries() == []
+
+    manifest = fortranmagic._Manifest(str(tmp_path / "preload.json"))
+    manifest.add("--opt=-O3", "%%fortran")
+    assert manifest.entries() == [("--opt=-O3", "%%fortran")]
+    assert [p.name for p in tmp_path.iterdir() if p.suffix == ".tmp"] == []
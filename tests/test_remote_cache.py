@@ -0,0 +1,96 @@
+"""Shared module stores: `%%fortran --remote-cache`"""
+
+import functools
+import http.server
+import os
+import threading
+
+import IPython.core.interactiveshell as ici
+import pytest
+from IPython.core.error import UsageError
+
+import fortranmagic
+
+pytestmark = pytest.mark.requires_fortran
+
+PRG = """
+subroutine shared(x)
+    real(8), intent(out) :: x
+    x = 42
+end subroutine shared
+"""
+
+
+class _PutHandler(http.server.SimpleHTTPRequestHandler):
+    def do_PUT(self) -> None:
+        with open(self.translate_path(self.path), "wb") as f:
+            f.write(self.rfile.read(int(self.headers["Content-Length"])))
+        self.send_response(201)
+        self.end_headers()
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def http_store(tmp_path):
+    handler = functools.partial(_PutHandler, directory=str(tmp_path))
+    with http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler) as server:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        yield tmp_path, f"http://127.0.0.1:{server.server_address[1]}/"
+        server.shutdown()
+
+
+@pytest.mark.parametrize("kind", ["directory", "http"])
+@pytest.mark.usefixtures("use_fortran_config")
+def test_remote_cache(kind, http_store, tmp_path, monkeypatch) -> None:
+    """A build is stored remotely, then fetched instead of compiled"""
+
+    store_dir, url = http_store if kind == "http" else (tmp_path / "store", str(tmp_path / "store"))
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    ish.run_cell("%fortran_config --defaults")
+    ish.run_cell("%fortran_config --clean-cache")
+    magics = ish.magics_manager.registry["FortranMagics"]
+
+    line = f"--remote-cache {url}"
+    module_name, module_path, _, _ = magics._fortran_build(line, PRG)
+    assert os.path.isfile(os.path.join(store_dir, os.path.basename(module_path)))
+
+    os.remove(module_path)
+
+    def no_build(*args, **kwargs):
+        pytest.fail("compiled instead of fetched")
+
+    monkeypatch.setattr(fortranmagic.FortranMagics, "_run_f2py", no_build)
+    assert magics._fortran_build(line, PRG)[:2] == (module_name, module_path)
+    assert os.path.isfile(module_path)
+    assert fortranmagic._imp_load_dynamic(module_name, module_path).shared() == 42
+
+
+def test_remote_cache_unreachable(tmp_path, capsys) -> None:
+    """Store failures are warnings"""
+
+    store = fortranmagic._cache_store("http://127.0.0.1:9/nowhere")
+    assert not fortranmagic._cache_fetch([store], str(tmp_path / "m.so"))
+    assert "Warning: remote cache http://127.0.0.1:9/nowhere" in capsys.readouterr().err
+    with pytest.raises(UsageError):
+        fortranmagic._cache_store("ftp://host/cache")
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_remote_cache_native(tmp_path) -> None:
+    """Builds for the host CPU are not shared, the others survive --clean-cache"""
+
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    ish.run_cell("%fortran_config --defaults")
+    magics = ish.magics_manager.registry["FortranMagics"]
+    cell = PRG.replace("shared", "shared_native")
+    magics._fortran_build(f"--remote-cache {tmp_path} --f90flags '-O2 -march=native'", cell)
+    assert not os.listdir(tmp_path)
+
+    module_name = magics._fortran_build(f"--remote-cache {tmp_path}", cell)[0]
+    assert os.listdir(tmp_path) == [module_name + magics.so_ext]
+    ish.run_cell("%fortran_config --clean-cache")
+    assert magics._fortran_build(f"--remote-cache {tmp_path}", cell)[0] == module_name
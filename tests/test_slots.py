@@ -0,0 +1,117 @@
+"""Host-wide build slots: `FORTRANMAGIC_MAX_BUILDS`"""
+
+import os
+import threading
+import time
+import uuid
+
+import IPython.core.interactiveshell as ici
+import pytest
+
+import fortranmagic
+
+pytestmark = pytest.mark.skipif(os.name == "nt", reason="no flock")
+
+
+def test_slots(tmp_path) -> None:
+    """Waits for a free slot, bulk builds give way to interactive ones"""
+
+    slots = fortranmagic._BuildSlots(str(tmp_path), 1)
+    order = []
+
+    def build(priority, delay=0.0):
+        time.sleep(delay)
+        with slots.acquire(priority) as queued:
+            order.append((priority, queued))
+            time.sleep(0.2)
+
+    with slots.acquire() as queued:
+        assert queued < 0.1
+        threads = [
+            threading.Thread(target=build, args=("bulk",)),
+            threading.Thread(target=build, args=("interactive", 0.1)),
+        ]
+        for t in threads:
+            t.start()
+        time.sleep(0.3)
+        assert order == []
+    for t in threads:
+        t.join()
+    assert [p for p, _ in order] == ["interactive", "bulk"]
+    assert order[0][1] > 0.15
+    assert order[1][1] > 0.4
+    assert not [name for name in os.listdir(tmp_path) if name.startswith("waiting-")]
+
+    with fortranmagic._BuildSlots(str(tmp_path), 0).acquire() as queued:
+        assert queued == 0.0
+
+
+@pytest.mark.requires_fortran
+@pytest.mark.usefixtures("use_fortran_config")
+def test_slots_build(tmp_path, monkeypatch, capsys) -> None:
+    """The wait for a slot is reported"""
+
+    monkeypatch.setattr(fortranmagic, "_BUILD_SLOTS_DIR", str(tmp_path))
+    monkeypatch.setenv("FORTRANMAGIC_MAX_BUILDS", "1")
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    ish.run_cell("%fortran_config --defaults")
+    magics = ish.magics_manager.registry["FortranMagics"]
+    started = []
+    magics.events.register("build_started", started.append)
+
+    held = threading.Event()
+
+    def hold():
+        with fortranmagic._BuildSlots.host().acquire():
+            held.set()
+            time.sleep(1.0)
+
+    t = threading.Thread(target=hold)
+    t.start()
+    held.wait()
+    cell = f"%%fortran\nsubroutine slot_{uuid.uuid4().hex[:8]}()\nend subroutine\n"
+    assert ish.run_cell(cell).success
+    t.join()
+    assert "for a build slot (1 builds at once on this host)" in capsys.readouterr().out
+    assert started[-1]["queued"] > 0.5
+
+
+def test_slots_max_wait(tmp_path, capsys) -> None:
+    """Past `max_wait` the build runs without a slot"""
+
+    slots = fortranmagic._BuildSlots(str(tmp_path), 1, max_wait=0.2)
+    with slots.acquire(), slots.acquire() as queued:
+        assert queued >= 0.2
+    assert "no free build slot after 0.2 s" in capsys.readouterr().err
+    with slots.acquire() as queued:
+        assert queued < 0.1
+
+
+@pytest.mark.requires_fortran
+@pytest.mark.usefixtures("use_fortran_config")
+def test_slots_interrupted(tmp_path, monkeypatch) -> None:
+    """An interrupted wait leaves no sources and finishes the build"""
+
+    monkeypatch.setattr(fortranmagic, "_BUILD_SLOTS_DIR", str(tmp_path))
+    monkeypatch.setenv("FORTRANMAGIC_MAX_BUILDS", "1")
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    ish.run_cell("%fortran_config --defaults")
+    magics = ish.magics_manager.registry["FortranMagics"]
+    finished = []
+    magics.events.register("build_finished", finished.append)
+
+    take = fortranmagic._BuildSlots._take
+
+    def interrupt(self, bulk, waiting):
+        if waiting is not None:
+            raise KeyboardInterrupt
+        return take(self, bulk, waiting)
+
+    monkeypatch.setattr(fortranmagic._BuildSlots, "_take", interrupt)
+    before = set(os.listdir(magics._lib_dir))
+    with fortranmagic._BuildSlots.host().acquire():
+        assert not ish.run_cell(f"%%fortran\nsubroutine slot_{uuid.uuid4().hex[:8]}()\nend subroutine\n").success
+    assert set(os.listdir(magics._lib_dir)) == before
+    assert finished[-1]["reason"] == "interrupted"
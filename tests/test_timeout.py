@@ -0,0 +1,78 @@
+"""Build timeout & interrupted builds leave a consistent cache"""
+
+import os
+
+import IPython.core.interactiveshell as ici
+import pytest
+
+import fortranmagic
+
+pytestmark = pytest.mark.requires_fortran
+
+GOOD_PRG = """
+subroutine hj(x)
+    x = 1.
+end subroutine hj
+"""
+
+
+@pytest.fixture
+def ish():
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    ish.run_cell("%fortran_config --defaults")
+    ish.run_cell("%fortran_config --clean-cache")
+    return ish
+
+
+def _leftovers(ish):
+    lib_dir = ish.db["fortranmagic_cache"]
+    return sorted(f for f in os.listdir(lib_dir) if not f.endswith(".log"))
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_timeout(ish, capfd) -> None:
+    """A build longer than `--timeout` fails and is removed"""
+
+    assert not ish.run_cell("%%fortran --timeout 0.1\n" + GOOD_PRG).success
+    assert "build timed out after 0.1 s" in capfd.readouterr().err
+    assert _leftovers(ish) == []
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_keyboard_interrupt(ish, monkeypatch) -> None:
+    """Interrupt terminates the compilers, then the cell is buildable"""
+
+    started = []
+
+    def interrupt(self, stream, line):
+        started.append(line)
+        raise KeyboardInterrupt
+
+    with monkeypatch.context() as m:
+        m.setattr(fortranmagic._BuildOutput, "feed", interrupt)
+        assert not ish.run_cell("%%fortran\n" + GOOD_PRG).success
+    assert started
+    assert _leftovers(ish) == []
+
+    assert ish.run_cell("%%fortran\n" + GOOD_PRG).success
+    assert len(_leftovers(ish)) == 2  # source & module
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_timeout_steps(ish, monkeypatch) -> None:
+    """The f2py & compiler steps share the deadline of `--timeout`"""
+
+    magics = ish.magics_manager.registry["FortranMagics"]
+    deadlines = []
+    run_build = magics._run_build
+
+    def record(command, *args, **kwargs):
+        deadlines.append(kwargs.get("deadline"))
+        return run_build(command, *args, **kwargs)
+
+    monkeypatch.setattr(magics, "_run_build", record)
+    assert ish.run_cell("%%fortran --backend auto --timeout 60\n" + GOOD_PRG).success
+    assert len(deadlines) > 1
+    assert len(set(deadlines)) == 1
+    assert deadlines[0] is not None
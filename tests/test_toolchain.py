@@ -0,0 +1,72 @@
+"""Memoized discovery of compilers & pkg-config resources"""
+
+import os
+
+import IPython.core.interactiveshell as ici
+import IPython.paths
+import pytest
+
+import fortranmagic
+
+
+def test_toolchain_cache(monkeypatch) -> None:
+    """Probe once per environment, reuse the disk cache, refresh on demand"""
+
+    calls = []
+    probe = fortranmagic._probe_toolchain
+
+    def counting_probe():
+        calls.append(os.environ.get("FC"))
+        return probe()
+
+    monkeypatch.setattr(fortranmagic, "_probe_toolchain", counting_probe)
+    monkeypatch.setattr(fortranmagic, "_TOOLCHAINS", {})
+    monkeypatch.setenv("FC", "_no_such_fortran_")
+
+    toolchain = fortranmagic._toolchain(refresh=True)
+    assert toolchain["fc"] == {"path": None, "version": None}
+    assert fortranmagic._toolchain() is toolchain
+    assert len(calls) == 1
+
+    # A new session reads the disk cache
+    monkeypatch.setattr(fortranmagic, "_TOOLCHAINS", {})
+    assert fortranmagic._toolchain() == toolchain
+    assert len(calls) == 1
+    assert os.path.isfile(os.path.join(IPython.paths.get_ipython_cache_dir(), "fortranmagic", "toolchain.json"))
+
+    # Other environment, other toolchain
+    monkeypatch.setenv("FC", "_other_fortran_")
+    fortranmagic._toolchain()
+    assert calls == ["_no_such_fortran_", "_other_fortran_"]
+
+
+@pytest.mark.skipif(os.name == "nt", reason="shell script compiler")
+def test_toolchain_upgrade(tmp_path, monkeypatch) -> None:
+    """A compiler upgraded in place is probed again"""
+
+    fc = tmp_path / "myfortran"
+    fc.write_text("#!/bin/sh\necho 'MyFortran 1.0'\n")
+    fc.chmod(0o755)
+    monkeypatch.setattr(fortranmagic, "_TOOLCHAINS", {})
+    monkeypatch.setenv("FC", str(fc))
+    assert fortranmagic._toolchain()["fc"]["version"] == "MyFortran 1.0"
+
+    fc.write_text("#!/bin/sh\necho 'MyFortran 2.0.1'\n")
+    assert fortranmagic._toolchain()["fc"]["version"] == "MyFortran 2.0.1"
+    monkeypatch.setattr(fortranmagic, "_TOOLCHAINS", {})
+    assert fortranmagic._toolchain()["fc"]["version"] == "MyFortran 2.0.1"
+
+
+def test_f2py_help(capsys) -> None:
+    """%f2py_help uses the discovery cache"""
+
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    assert ish.run_cell("%f2py_help --refresh").success
+    out = capsys.readouterr().out
+    assert "fc: " in out
+    assert "pkg-config: " in out
+
+    assert ish.run_cell("%f2py_help --link _no_such_resource_").success
+    assert "_no_such_resource_: not found" in capsys.readouterr().out
+    assert fortranmagic._toolchain()["resources"]["_no_such_resource_"] == {"found": False}
@@ -0,0 +1,75 @@
+"""Elemental & pure procedures as NumPy ufuncs: `%%fortran --ufunc`"""
+
+import IPython.core.interactiveshell as ici
+import numpy as np
+import pytest
+
+pytestmark = pytest.mark.requires_fortran
+
+UFUNC_PRG = """%%fortran --ufunc
+elemental real(8) function hyp(x, y)
+    real(8), intent(in) :: x, y
+    hyp = sqrt(x**2 + y**2)
+end function hyp
+
+module m
+    integer, parameter :: dp = kind(1d0)
+contains
+    elemental subroutine polar(x, y, r, t)
+        real(dp), intent(in) :: x, y
+        real(dp), intent(out) :: r, t
+        r = hypot(x, y)
+        t = atan2(y, x)
+    end subroutine polar
+
+    pure integer function twice(i)
+        integer, intent(in) :: i
+        twice = 2 * i
+    end function twice
+
+    integer function plain(i)
+        integer, intent(in) :: i
+        plain = i
+    end function plain
+end module m
+"""
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_ufunc() -> None:
+    """Broadcasting, `out=`, strides, several outputs & type loops"""
+
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    ish.run_cell("%fortran_config --defaults")
+    assert ish.run_cell(UFUNC_PRG).success
+    ns = ish.user_ns
+
+    hyp = ns["hyp"]
+    assert isinstance(hyp, np.ufunc)
+    assert hyp.types == ["dd->d"]
+    x, y = np.array([3.0, 5.0])[:, None], np.array([4.0, 12.0, 0.0, 0.0])[::2]
+    np.testing.assert_allclose(hyp(x, y), np.hypot(x, y))
+    out = np.empty((2, 2))
+    assert hyp(x, y, out=out) is out
+    np.testing.assert_allclose(out, np.hypot(x, y))
+
+    r, t = ns["polar"](np.array([1.0, 0.0]), 1.0)
+    np.testing.assert_allclose(r, [np.sqrt(2), 1.0])
+    np.testing.assert_allclose(t, [np.pi / 4, np.pi / 2])
+
+    assert ns["twice"].types == ["i->i"]
+    np.testing.assert_array_equal(ns["twice"](np.arange(4, dtype=np.int32)), [0, 2, 4, 6])
+    assert not isinstance(ns["m"].plain, np.ufunc)
+    assert "plain" not in ns
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_ufunc_none() -> None:
+    """Cells without candidate are reported before compilation"""
+
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    r = ish.run_cell("%%fortran --ufunc\nsubroutine s(a)\n    real, intent(inout) :: a\nend subroutine s\n")
+    assert not r.success
+    assert "--ufunc: no elemental or pure procedure" in str(r.error_in_exec)
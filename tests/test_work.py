@@ -0,0 +1,89 @@
+"""Persistent work arrays: `%%fortran --work` & `%fortran_work`"""
+
+import IPython.core.interactiveshell as ici
+import numpy as np
+import pytest
+
+import fortranmagic
+
+pytestmark = pytest.mark.requires_fortran
+
+WORK_PRG = """%%fortran --work 'real(8) :: t(:), w(:,:)' --work 'integer :: k(:)'
+subroutine smooth(n, x)
+    use workspace
+    integer, intent(in) :: n
+    real(8), intent(inout) :: x(n)
+    call t_alloc(n)
+    t(2:n-1) = 0.5d0 * (x(1:n-2) + x(3:n))
+    x(2:n-1) = t(2:n-1)
+end subroutine smooth
+"""
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_work(capsys) -> None:
+    """Allocated once, reused, zero-copy views, freed"""
+
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    ish.run_cell("%fortran_config --defaults")
+    assert ish.run_cell(WORK_PRG).success
+    ws, smooth = ish.user_ns["workspace"], ish.user_ns["smooth"]
+    assert ws.t is None
+
+    x = np.array([0.0, 1.0, 4.0, 9.0])
+    smooth(x)
+    np.testing.assert_allclose(x, [0.0, 2.0, 5.0, 9.0])
+    t = ws.t
+    np.testing.assert_allclose(t, [0.0, 2.0, 5.0, 0.0])
+    smooth(x)
+    assert ws.t.ctypes.data == t.ctypes.data
+    t[:] = -1.0
+    np.testing.assert_allclose(ws.t, -1.0)
+
+    ws.w_alloc(3, 2)
+    assert ws.w.shape == (3, 2)
+    assert ws.w.dtype == np.float64
+    assert not ws.w.any()
+
+    capsys.readouterr()
+    ish.run_line_magic("fortran_work", "")
+    out = capsys.readouterr().out
+    assert "float64(4)" in out
+    assert "float64(3, 2)" in out
+    assert "3 work array(s), 0 kB" in out
+
+    ish.run_line_magic("fortran_work", "--free")
+    assert ws.t is None
+    assert ws.w is None
+    assert capsys.readouterr().out.count("free") == 3
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_work_usage() -> None:
+    """Invalid declarations are reported before compilation"""
+
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    r = ish.run_cell("%%fortran --work 'real(8) w(:)'\nsubroutine s()\nend subroutine s\n")
+    assert "expected <type> :: <name>(:,...)" in str(r.error_in_exec)
+    r = ish.run_cell("%%fortran --work 'real(8) :: w(:)' --worker\nsubroutine s()\nend subroutine s\n")
+    assert "--work: not supported with --worker" in str(r.error_in_exec)
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_work_types() -> None:
+    """Logical, character & derived type arrays are initialized by type"""
+
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    ish.run_cell("%fortran_config --defaults")
+    assert ish.run_cell("%%fortran --work 'logical :: mask(:)'\nsubroutine nop()\nend subroutine nop\n").success
+    ws = ish.user_ns["workspace"]
+    ws.mask_alloc(3)
+    assert ws.mask.shape == (3,)
+    assert not ws.mask.any()
+
+    source = fortranmagic._work_module([("character(len=4)", "c", 1), ("type(point)", "p", 1)])
+    assert "c = ' '" in source
+    assert "p = " not in source
@@ -0,0 +1,76 @@
+"""Fortran modules loaded in a worker process: `%%fortran --worker`"""
+
+import IPython.core.interactiveshell as ici
+import numpy as np
+import pytest
+
+pytestmark = pytest.mark.requires_fortran
+
+WORKER_PRG = """%%fortran --worker
+subroutine scale(a, n, s, b)
+    integer, intent(in) :: n
+    real(8), intent(inout) :: a(n)
+    real(8), intent(in) :: s
+    real(8), intent(out) :: b(n)
+    a = a * s
+    b = a + 1
+end subroutine scale
+
+subroutine crash()
+    call abort()
+end subroutine crash
+
+module counter
+    integer :: hits = 0
+end module counter
+"""
+
+
+@pytest.fixture(scope="module")
+def ish():
+    ish = ici.InteractiveShell()
+    assert ish.run_cell("%load_ext fortranmagic").success
+    ish.run_cell("%fortran_config --defaults")
+    assert ish.run_cell(WORKER_PRG).success
+    yield ish
+    ish.run_line_magic("fortran_worker", "--stop")
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_worker_call(ish) -> None:
+    """Arguments, in/output arrays, results & module data"""
+
+    scale, counter = ish.user_ns["scale"], ish.user_ns["counter"]
+    a = np.arange(4.0)
+    np.testing.assert_allclose(scale(a, 2.0), [1.0, 3.0, 5.0, 7.0])
+    np.testing.assert_allclose(a, [0.0, 2.0, 4.0, 6.0])
+
+    counter.hits = 3
+    assert counter.hits == 3
+    assert "in/output" in scale.__doc__
+
+    with pytest.raises(TypeError):
+        scale("a", 1.0)
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_worker_shared_array(ish) -> None:
+    """Arrays of the worker memory are updated in place"""
+
+    worker = ish.run_line_magic("fortran_worker", "")
+    a = worker.empty(3)
+    a[:] = 1.0
+    np.testing.assert_allclose(ish.user_ns["scale"](a, 3.0), [4.0, 4.0, 4.0])
+    np.testing.assert_allclose(a, [3.0, 3.0, 3.0])
+
+
+@pytest.mark.usefixtures("use_fortran_config")
+def test_worker_crash(ish) -> None:
+    """A crash kills the worker, not the kernel; next call restarts it"""
+
+    worker = ish.run_line_magic("fortran_worker", "")
+    pid = worker.pid
+    with pytest.raises(RuntimeError, match="worker died"):
+        ish.user_ns["crash"]()
+    np.testing.assert_allclose(ish.user_ns["scale"](np.ones(2), 2.0), [3.0, 3.0])
+    assert worker.pid not in (None, pid)